@@ -0,0 +1,102 @@
+"""Requests per second and CPU use of one core with the WSGI and the ASGI workers.
+
+    python benchmarks/asgi_concurrency_benchmark.py [--s3-ms 40] [--cpu-ms 25] [--clients 1 4 16 64]
+
+Replays the shape of an /invocations request on one CPU: an S3 download and an
+upload of --s3-ms each, and --cpu-ms of decoding, inference and rendering
+(numpy work that releases the GIL like TFLite and OpenCV do). A sync worker
+(MODEL_SERVER_MODE=wsgi) serves one request at a time, an ASGI worker awaits
+the S3 round trips on its event loop and runs the CPU work on an executor of
+--executor-threads threads (MODEL_SERVER_EXECUTOR_THREADS). Every mode is run
+with the given numbers of closed-loop clients for --duration seconds.
+"""
+import os
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def _cpu_work(cpu_ms, size=128):
+    """Runs matrix products for about cpu_ms milliseconds."""
+    matrix = np.random.rand(size, size)
+    deadline = time.perf_counter() + cpu_ms / 1000.0
+    while time.perf_counter() < deadline:
+        matrix = np.tanh(matrix @ matrix)
+    return matrix
+
+
+def _summary(latencies, duration, cpu_seconds):
+    p50, p95 = np.percentile(latencies, [50, 95]) * 1000 if latencies else (np.nan, np.nan)
+    return {"throughput": len(latencies) / duration, "p50_ms": float(p50), "p95_ms": float(p95),
+            "cpu": cpu_seconds / duration}
+
+
+def run_wsgi(clients, duration, s3_ms, cpu_ms):
+    """Sync worker: the clients queue for the single request slot of the worker."""
+    latencies = []
+    stop_at = time.perf_counter() + duration
+    started_cpu = time.process_time()
+
+    def request():
+        time.sleep(s3_ms / 1000.0)
+        _cpu_work(cpu_ms)
+        time.sleep(s3_ms / 1000.0)
+
+    # The queued clients wait in the listen backlog; a request's latency includes that wait.
+    queued = [time.perf_counter()] * clients
+    while time.perf_counter() < stop_at:
+        request()
+        now = time.perf_counter()
+        latencies.append(now - queued.pop(0))
+        queued.append(now)
+    return _summary(latencies, duration, time.process_time() - started_cpu)
+
+
+def run_asgi(clients, duration, s3_ms, cpu_ms, executor_threads=1):
+    """ASGI worker: S3 waits on the event loop, the CPU work on a bounded executor."""
+    executor = ThreadPoolExecutor(max_workers=executor_threads)
+    latencies = []
+
+    async def client(stop_at):
+        loop = asyncio.get_running_loop()
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            await asyncio.sleep(s3_ms / 1000.0)
+            await loop.run_in_executor(executor, _cpu_work, cpu_ms)
+            await asyncio.sleep(s3_ms / 1000.0)
+            latencies.append(time.perf_counter() - started)
+
+    async def main():
+        stop_at = time.perf_counter() + duration
+        await asyncio.gather(*(client(stop_at) for _ in range(clients)))
+
+    started_cpu = time.process_time()
+    started = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    executor.shutdown()
+    return _summary(latencies, elapsed, time.process_time() - started_cpu)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--s3-ms", type=float, default=40, help="duration of the download and of the upload")
+    parser.add_argument("--cpu-ms", type=float, default=25, help="duration of the CPU-bound stages")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=3)
+    parser.add_argument("--executor-threads", type=int, default=1)
+    args = parser.parse_args()
+
+    # One core, the per-core throughput of a worker; BLAS must not spread the work over more.
+    os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    print(f"{'mode':>6} {'clients':>8} {'requests/s':>11} {'p50 ms':>9} {'p95 ms':>9} {'core busy':>10}")
+    for clients in args.clients:
+        for mode, run in (("wsgi", lambda: run_wsgi(clients, args.duration, args.s3_ms, args.cpu_ms)),
+                          ("asgi", lambda: run_asgi(clients, args.duration, args.s3_ms, args.cpu_ms,
+                                                    args.executor_threads))):
+            result = run()
+            print(f"{mode:>6} {clients:>8} {result['throughput']:>11.1f} {result['p50_ms']:>9.1f} "
+                  f"{result['p95_ms']:>9.1f} {result['cpu']:>10.0%}")
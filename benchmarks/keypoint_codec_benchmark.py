@@ -0,0 +1,54 @@
+"""Size and throughput of the keypoint response formats compared with JSON.
+
+    python benchmarks/keypoint_codec_benchmark.py [num_poses ...]
+
+Encodes and decodes random [N, 17, 3] keypoints with every format and prints
+the payload size and the encode/decode rates.
+"""
+import os
+import sys
+import json
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src', 'inference_webserver'))
+import keypoint_codec
+
+
+def _rate(fn, min_seconds=0.5):
+    count = 0
+    started = time.perf_counter()
+    while True:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return count / elapsed
+
+
+def formats():
+    yield 'json', (lambda kp: json.dumps({'keypoints': kp.tolist(), 'image_height': 720, 'image_width': 1280}).encode(),
+                   lambda data: np.asarray(json.loads(data)['keypoints'], dtype=np.float32))
+    for dtype in ('float16', 'float32'):
+        yield f'binary-{dtype}', (
+            lambda kp, dtype=dtype: keypoint_codec.encode_keypoints(kp, 720, 1280, 'benchmark', dtype=dtype),
+            keypoint_codec.decode_keypoints)
+    if keypoint_codec.msgpack is not None:
+        yield 'msgpack', (lambda kp: keypoint_codec.encode_msgpack(kp, 720, 1280, 'benchmark'),
+                          keypoint_codec.decode_msgpack)
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1, 16, 256]
+    print(f"{'format':>16} {'poses':>6} {'bytes':>9} {'vs json':>8} {'encode/s':>11} {'decode/s':>11} {'max err':>9}")
+    for num_poses in sizes:
+        keypoints = np.random.rand(num_poses, 17, 3).astype(np.float32)
+        json_size = None
+        for name, (encode, decode) in formats():
+            data = encode(keypoints)
+            decoded = decode(data)
+            decoded = decoded['keypoints'] if isinstance(decoded, dict) else decoded
+            json_size = json_size or len(data)
+            error = float(np.max(np.abs(decoded.reshape(keypoints.shape) - keypoints)))
+            print(f"{name:>16} {num_poses:>6} {len(data):>9} {len(data) / json_size:>8.2f} "
+                  f"{_rate(lambda: encode(keypoints)):>11.0f} {_rate(lambda: decode(data)):>11.0f} {error:>9.1e}")
@@ -0,0 +1,36 @@
+"""Throughput of the pose analytics on batches of poses.
+
+    python benchmarks/pose_analytics_benchmark.py [num_poses ...]
+
+Computes the joint angles, limb lengths, torso orientation and visibility of
+random [N, 17, 3] keypoints and prints the rate in poses per second, for the
+arrays (analyze) and for the JSON response (analyze and to_json).
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src', 'inference_webserver'))
+import pose_analytics
+
+
+def _rate(fn, num_poses, min_seconds=0.5):
+    count = 0
+    started = time.perf_counter()
+    while True:
+        fn()
+        count += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds:
+            return count * num_poses / elapsed
+
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1, 256, 10000]
+    print(f"{'poses':>8} {'analyze poses/s':>16} {'json poses/s':>14}")
+    for num_poses in sizes:
+        keypoints = np.random.rand(num_poses, 17, 3).astype(np.float32)
+        analyze_rate = _rate(lambda: pose_analytics.analyze(keypoints), num_poses)
+        json_rate = _rate(lambda: pose_analytics.to_json(pose_analytics.analyze(keypoints)), num_poses)
+        print(f"{num_poses:>8} {analyze_rate:>16.0f} {json_rate:>14.0f}")
@@ -0,0 +1,138 @@
+"""Per-worker memory report of the gunicorn inference server.
+
+Run inside the inference container once the server is up and has served at least
+one request per worker (interpreters are created lazily), e.g.
+
+    MODEL_SERVER_WORKERS=4 MODEL_SERVER_PRELOAD=true serve &
+    python worker_memory.py
+
+Compare the totals of the same worker count with and without MODEL_SERVER_PRELOAD.
+RSS counts shared pages in every worker, PSS splits them between the processes
+sharing them, so the PSS sum is the actual memory used by the server.
+
+With --sweep the script starts serve itself for every worker count, with and
+without preload, waits until the warmed-up workers are ready and prints one
+summary line per run (the container must not be serving already):
+
+    python worker_memory.py --sweep 1 4 16
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import subprocess
+import urllib.request
+
+
+def _read_cmdline(pid):
+    with open(f"/proc/{pid}/cmdline", "rb") as infile:
+        return infile.read().replace(b"\0", b" ").decode("utf-8", errors="replace")
+
+
+def _read_ppid(pid):
+    with open(f"/proc/{pid}/stat", "r") as infile:
+        return int(infile.read().rsplit(")", 1)[1].split()[1])
+
+
+def memory_kb(pid):
+    """Returns the Rss, Pss and Private memory of a process in kB from smaps_rollup."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as infile:
+        for line in infile:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                fields[parts[0][:-1]] = int(parts[1])
+    private = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+    return fields.get("Rss", 0), fields.get("Pss", 0), private
+
+
+def gunicorn_processes():
+    """Returns the pid of the gunicorn master and the pids of its workers."""
+    pids = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+    gunicorn = {}
+    for pid in pids:
+        try:
+            if "gunicorn" in _read_cmdline(pid):
+                gunicorn[pid] = _read_ppid(pid)
+        except OSError:
+            continue
+    masters = [pid for pid, ppid in gunicorn.items() if ppid not in gunicorn]
+    if not masters:
+        sys.exit("No gunicorn process found")
+    master = masters[0]
+    workers = sorted(pid for pid, ppid in gunicorn.items() if ppid == master)
+    return master, workers
+
+
+def report():
+    """Prints the memory of the master and of every worker of the running server."""
+    master, workers = gunicorn_processes()
+    print(f"{'process':>16} {'rss_mb':>10} {'pss_mb':>10} {'private_mb':>12}")
+    totals = [0, 0, 0]
+    for name, pid in [("master", master)] + [(f"worker {pid}", pid) for pid in workers]:
+        values = memory_kb(pid)
+        totals = [total + value for total, value in zip(totals, values)]
+        print(f"{name:>16} " + " ".join(f"{value / 1024:>10.1f}" for value in values))
+    print(f"{'total':>16} " + " ".join(f"{value / 1024:>10.1f}" for value in totals))
+    print(f"workers: {len(workers)}, pss per worker: {totals[1] / 1024 / max(len(workers), 1):.1f} MB")
+
+
+def _wait_ready(workers, timeout, settle, url="http://localhost:8080/ping"):
+    """Waits until /ping answers and the server runs the given number of workers, then settle seconds."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                ready = response.status == 200
+        except OSError:
+            ready = False
+        try:
+            running = len(gunicorn_processes()[1]) if ready else 0
+        except SystemExit:
+            running = 0
+        if running == workers:
+            # /ping is answered by the first warm worker, the others may still be warming up.
+            time.sleep(settle)
+            return
+        time.sleep(1)
+    raise TimeoutError(f"Server with {workers} workers not ready within {timeout}s")
+
+
+def measure_serve(workers, preload, timeout=600, settle=20):
+    """Starts serve with the given workers and preload, and returns its worker and total memory in kB."""
+    env = dict(os.environ, MODEL_SERVER_WORKERS=str(workers), MODEL_SERVER_PRELOAD=str(preload).lower(),
+               MODEL_SERVER_WARMUP="true")
+    server = subprocess.Popen(["serve"], env=env)
+    try:
+        _wait_ready(workers, timeout, settle)
+        master, pids = gunicorn_processes()
+        per_worker = [memory_kb(pid) for pid in pids]
+        total_pss = memory_kb(master)[1] + sum(values[1] for values in per_worker)
+        return {"rss": sum(values[0] for values in per_worker) / len(pids),
+                "pss": sum(values[1] for values in per_worker) / len(pids), "total_pss": total_pss}
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=120)
+
+
+def sweep(worker_counts, timeout, settle):
+    print(f"{'workers':>8} {'preload':>8} {'rss_mb/worker':>14} {'pss_mb/worker':>14} {'total_pss_mb':>13}")
+    for workers in worker_counts:
+        for preload in (False, True):
+            result = measure_serve(workers, preload, timeout, settle)
+            print(f"{workers:>8} {str(preload).lower():>8} {result['rss'] / 1024:>14.1f} "
+                  f"{result['pss'] / 1024:>14.1f} {result['total_pss'] / 1024:>13.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-worker memory report of the gunicorn inference server.")
+    parser.add_argument("--sweep", type=int, nargs="+", metavar="WORKERS",
+                        help="start serve with each worker count, with and without preload, and report each run")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds a server may take to start")
+    parser.add_argument("--settle", type=float, default=20, help="seconds to wait after the workers are up")
+    args = parser.parse_args()
+    if args.sweep:
+        sweep(args.sweep, args.timeout, args.settle)
+    else:
+        report()
@@ -0,0 +1,65 @@
+import os
+import sys
+import yaml
+import logging
+from docker_utils import build_and_push_docker_images
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "realtime_endpoint_deployment"))
+from deploy_engine import deployment_version  # noqa: E402
+
+cwd = os.getcwd()
+logging.basicConfig(
+    filename='{}/build_images.log'.format(cwd), level=logging.INFO)
+
+
+def read_config(config_path):
+    with open(os.path.expanduser(config_path), 'r') as stream:
+        project_params = yaml.safe_load(stream)
+    return project_params
+
+
+def build_images(project_params, inference_docker_file_path, monitoring_docker_file_path, version):
+    """Builds and pushes the inference and the monitoring images concurrently.
+
+    Both images are pushed as latest and under the immutable version tag, the
+    returned URIs reference the version tag.
+
+    Args:
+        project_params: A dictionary containing the project parameters loaded from config.yml.
+        inference_docker_file_path: A string representing the file path to the inference Dockerfile.
+        monitoring_docker_file_path: A string representing the file path to the monitoring Dockerfile.
+        version: A string, the deployment version the images are tagged with.
+
+    Returns:
+        image_uris: A dictionary with the INFERENCE_IMAGE_URI and MONITORING_IMAGE_URI of the pushed images.
+    """
+    ecrInferenceImageName = project_params["InferenceConfig"]["ecrInferenceImageName"]
+    monitoringImageName = project_params["ModelMonitoring"]["monitoringImageName"]
+    ecr_tags = build_and_push_docker_images({
+        ecrInferenceImageName: inference_docker_file_path,
+        monitoringImageName: monitoring_docker_file_path,
+    }, version=version)
+    image_uris = {
+        "INFERENCE_IMAGE_URI": ecr_tags[ecrInferenceImageName],
+        "MONITORING_IMAGE_URI": ecr_tags[monitoringImageName],
+    }
+    logging.info(f"Image URIs, {image_uris}")
+    return image_uris
+
+
+if __name__ == '__main__':
+    # Builds both images up-front, the deployment scripts pick the URIs up from the environment
+    config_path = os.path.join(cwd, "deployment", "config.yml")
+    inference_docker_file_path = os.path.join(cwd, "docker", "inference", "Dockerfile")
+    monitoring_docker_file_path = os.path.join(cwd, "docker", "monitoring", "Dockerfile")
+    project_params = read_config(config_path)
+    # The deployment scripts run as later steps, they reuse this version for the models and configs.
+    version = deployment_version()
+    image_uris = build_images(project_params, inference_docker_file_path, monitoring_docker_file_path, version)
+    image_uris["DEPLOYMENT_VERSION"] = version
+    github_env = os.environ.get("GITHUB_ENV")
+    for name, uri in image_uris.items():
+        print(f"{name}: {uri}")
+        if github_env:
+            with open(github_env, "a") as outfile:
+                outfile.write(f"{name}={uri}\n")
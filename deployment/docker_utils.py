@@ -2,6 +2,8 @@ from __future__ import absolute_import
 
 import base64
 import contextlib
+import datetime
+import functools
 import os
 import time
 import shlex
@@ -9,6 +11,8 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import json
@@ -19,30 +23,109 @@ access_key = os.environ['AWS_ACCESS_KEY_ID']
 secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
 region = os.environ['region']
 
-def build_and_push_docker_image(repository_name, dockerfile, build_args={}):
+BUILDX_BUILDER = "pose-detection-builder"
+CACHE_TAG = "buildcache"
+# Re-login this long before the ECR authorization token actually expires.
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+_ecr_logins = {}
+_login_lock = threading.Lock()
+_builder_lock = threading.Lock()
+_output_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _session():
+    return boto3.Session(aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)
+
+
+@functools.lru_cache(maxsize=None)
+def _ecr_client():
+    return _session().client('ecr', region_name=region)
+
+
+@functools.lru_cache(maxsize=None)
+def _account_id():
+    return _session().client('sts', region_name=region).get_caller_identity()['Account']
+
+
+def build_and_push_docker_image(repository_name, dockerfile, build_args={}, use_cache=True, output_prefix=None,
+                                version=None):
     """Builds a docker image from the specified dockerfile, and pushes it to
     ECR.  Handles things like ECR login, creating the repository.
 
-    Returns the name of the created docker image in ECR
+    With use_cache the image is built with BuildKit, using the ':buildcache' tag of
+    the ECR repository as registry cache source and destination. With version the
+    image is also pushed under that immutable tag.
+
+    Returns the name of the created docker image in ECR, with the version tag if given
     """
     base_image = _find_base_image_in_dockerfile(dockerfile)
     _ecr_login_if_needed(base_image)
-    _build_from_dockerfile(repository_name, dockerfile, build_args)
-    ecr_tag = push(repository_name)
+    cache_ref = None
+    if use_cache:
+        aws_account = _account_id()
+        _create_ecr_repo(_ecr_client(), repository_name)
+        _ecr_login(_ecr_client(), aws_account)
+        cache_ref = '%s.dkr.ecr.%s.amazonaws.com/%s:%s' % (aws_account, region, repository_name, CACHE_TAG)
+    _build_from_dockerfile(repository_name, dockerfile, build_args, cache_ref=cache_ref, output_prefix=output_prefix)
+    ecr_tag = push(repository_name, output_prefix=output_prefix, version=version)
     return ecr_tag
 
 
-def _build_from_dockerfile(repository_name, dockerfile='Dockerfile', build_args={}):
-    build_cmd = ['docker', 'build', '-t',
-                 repository_name, '-f', dockerfile, '.']
+def build_and_push_docker_images(images, use_cache=True, version=None):
+    """Builds and pushes several docker images concurrently.
+
+    The output of every build is prefixed with the repository name so that the
+    interleaved logs stay readable.
+
+    Args:
+        images (dict): repository name -> dockerfile path
+        use_cache (bool): build with the registry cache of every repository
+        version (string): immutable tag pushed next to latest
+
+    Returns:
+        (dict): repository name -> ECR image that was pushed
+    """
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        futures = {
+            repository_name: executor.submit(build_and_push_docker_image, repository_name, dockerfile,
+                                             use_cache=use_cache, output_prefix=repository_name, version=version)
+            for repository_name, dockerfile in images.items()
+        }
+        return {repository_name: future.result() for repository_name, future in futures.items()}
+
+
+def _build_from_dockerfile(repository_name, dockerfile='Dockerfile', build_args={}, cache_ref=None,
+                           output_prefix=None):
+    if cache_ref:
+        _ensure_buildx_builder()
+        build_cmd = ['docker', 'buildx', 'build', '--builder', BUILDX_BUILDER, '--load',
+                     '--cache-from', 'type=registry,ref=%s' % cache_ref,
+                     '--cache-to', 'type=registry,ref=%s,mode=max,image-manifest=true,oci-mediatypes=true' % cache_ref,
+                     '-t', repository_name, '-f', dockerfile, '.']
+    else:
+        build_cmd = ['docker', 'build', '-t',
+                     repository_name, '-f', dockerfile, '.']
     for k, v in build_args.items():
         build_cmd += ['--build-arg', '%s=%s' % (k, v)]
 
     print("Building docker image %s from %s" % (repository_name, dockerfile))
-    _execute(build_cmd)
+    _execute(build_cmd, prefix=output_prefix)
     print("Done building docker image %s" % repository_name)
 
 
+def _ensure_buildx_builder():
+    """
+    Registry cache export needs a docker-container BuildKit builder, create it once.
+    """
+    with _builder_lock:
+        try:
+            _check_output('docker buildx inspect %s' % BUILDX_BUILDER)
+        except Exception:
+            _execute(['docker', 'buildx', 'create', '--name', BUILDX_BUILDER, '--driver', 'docker-container'])
+
+
 def _find_base_image_in_dockerfile(dockerfile):
     dockerfile_lines = open(dockerfile).readlines()
     from_line = list(filter(lambda line: line.startswith(
@@ -51,7 +134,7 @@ def _find_base_image_in_dockerfile(dockerfile):
     return base_image
 
 
-def push(tag, aws_account=None, aws_region=None):
+def push(tag, aws_account=None, aws_region=None, output_prefix=None, version=None):
     """
     Push the builded tag to ECR.
 
@@ -59,33 +142,38 @@ def push(tag, aws_account=None, aws_region=None):
         tag (string): tag which you named your algo
         aws_account (string): aws account of the ECR repo
         aws_region (string): aws region where the repo is located
+        output_prefix (string): prefix for the lines of the docker output
+        version (string): also push the image as <repository>:<version>
 
     Returns:
-        (string): ECR repo image that was pushed
+        (string): ECR repo image that was pushed, the versioned one if version is given
     """
-    session = boto3.Session(aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)
-    aws_account = aws_account or session.client("sts", aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region).get_caller_identity()['Account'] 
-    aws_region = aws_region or session.region_name
+    aws_account = aws_account or _account_id()
+    aws_region = aws_region or _session().region_name
     try:
         repository_name, version = tag.split(':')
     except ValueError:  # split failed because no :
         repository_name = tag
         version = "latest"
-    ecr_client = session.client('ecr', aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)
+    ecr_client = _ecr_client()
 
     _create_ecr_repo(ecr_client, repository_name)
     _ecr_login(ecr_client, aws_account)
-    ecr_tag = _push(aws_account, aws_region, tag)
+    ecr_tag = _push(aws_account, aws_region, tag, output_prefix=output_prefix)
+    if version:
+        # Models reference this tag, so a config rolled back to keeps its image when latest moves on.
+        ecr_tag = _push(aws_account, aws_region, tag, output_prefix=output_prefix,
+                        remote_tag='%s:%s' % (repository_name, version))
 
     return ecr_tag
 
 
-def _push(aws_account, aws_region, tag):
+def _push(aws_account, aws_region, tag, output_prefix=None, remote_tag=None):
     ecr_repo = '%s.dkr.ecr.%s.amazonaws.com' % (aws_account, aws_region)
-    ecr_tag = '%s/%s' % (ecr_repo, tag)
-    _execute(['docker', 'tag', tag, ecr_tag])
-    print("Pushing docker image to ECR repository %s/%s\n" % (ecr_repo, tag))
-    _execute(['docker', 'push', ecr_tag])
+    ecr_tag = '%s/%s' % (ecr_repo, remote_tag or tag)
+    _execute(['docker', 'tag', tag, ecr_tag], prefix=output_prefix)
+    print("Pushing docker image to ECR repository %s\n" % ecr_tag)
+    _execute(['docker', 'push', ecr_tag], prefix=output_prefix)
     print("Done pushing %s" % ecr_tag)
     return ecr_tag
 
@@ -102,20 +190,30 @@ def _create_ecr_repo(ecr_client, repository_name):
 
 
 def _ecr_login(ecr_client, aws_account):
-    auth = ecr_client.get_authorization_token(registryIds=[aws_account])
-    authorization_data = auth['authorizationData'][0]
+    """
+    Log docker into the ECR registry of the account, unless the token of a previous login is still valid.
+    """
+    with _login_lock:
+        expires_at = _ecr_logins.get(aws_account)
+        if expires_at is not None and \
+                datetime.datetime.now(expires_at.tzinfo) + TOKEN_EXPIRY_MARGIN < expires_at:
+            return
+
+        auth = ecr_client.get_authorization_token(registryIds=[aws_account])
+        authorization_data = auth['authorizationData'][0]
 
-    raw_token = base64.b64decode(authorization_data['authorizationToken'])
-    token = raw_token.decode('utf-8').strip('AWS:')
-    ecr_url = auth['authorizationData'][0]['proxyEndpoint']
+        raw_token = base64.b64decode(authorization_data['authorizationToken'])
+        token = raw_token.decode('utf-8').strip('AWS:')
+        ecr_url = auth['authorizationData'][0]['proxyEndpoint']
 
-    cmd = ['docker', 'login', '-u', 'AWS', '-p', token, ecr_url]
-    _execute(cmd, quiet=True)
-    print("Logged into ECR")
+        cmd = ['docker', 'login', '-u', 'AWS', '-p', token, ecr_url]
+        _execute(cmd, quiet=True)
+        _ecr_logins[aws_account] = authorization_data['expiresAt']
+        print("Logged into ECR")
 
 
 def _ecr_login_if_needed(image):
-    ecr_client = boto3.client('ecr',aws_access_key_id=access_key, aws_secret_access_key=secret_key, region_name=region)
+    ecr_client = _ecr_client()
 
     # Only ECR images need login
     if not ('dkr.ecr' in image and 'amazonaws.com' in image):
@@ -150,14 +248,15 @@ def _tmpdir(suffix='', prefix='tmp', dir=None):  # type: (str, str, str) -> None
     shutil.rmtree(tmp)
 
 
-def _execute(command, quiet=False):
+def _execute(command, quiet=False, prefix=None):
     if not quiet:
         print("$ %s" % ' '.join(command))
     process = subprocess.Popen(command,
                                stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT)
+                               stderr=subprocess.STDOUT,
+                               env=dict(os.environ, DOCKER_BUILDKIT='1'))
     try:
-        _stream_output(process)
+        _stream_output(process, prefix)
     except RuntimeError as e:
         # _stream_output() doesn't have the command line. We will handle the exception
         # which contains the exit code and append the command line to it.
@@ -165,7 +264,7 @@ def _execute(command, quiet=False):
         raise RuntimeError(msg)
 
 
-def _stream_output(process):
+def _stream_output(process, prefix=None):
     """Stream the output of a process to stdout
 
     This function takes an existing process that will be polled for output. Only stdout
@@ -174,15 +273,18 @@ def _stream_output(process):
     Args:
         process(subprocess.Popen): a process that has been started with
             stdout=PIPE and stderr=STDOUT
+        prefix(str): if set, every line is written as "[prefix] line" so that the
+            output of concurrent builds stays separated
 
     Returns (int): process exit code
     """
-    exit_code = None
-
-    while exit_code is None:
-        stdout = process.stdout.readline().decode("utf-8")
-        sys.stdout.write(stdout)
-        exit_code = process.poll()
+    for line in iter(process.stdout.readline, b''):
+        line = line.decode("utf-8", errors="replace")
+        if prefix:
+            line = "[%s] %s" % (prefix, line)
+        with _output_lock:
+            sys.stdout.write(line)
+    exit_code = process.wait()
 
     if exit_code != 0:
         raise RuntimeError("Process exited with code: %s" % exit_code)
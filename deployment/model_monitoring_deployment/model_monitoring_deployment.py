@@ -42,6 +42,12 @@ def construct_monitoring_image_uri(project_params, docker_file_path):
         "123456789012.dkr.ecr.us-west-2.amazonaws.com/my_ecr_repo:latest"
     """
 
+    # Image already built and pushed by deployment/build_images.py
+    if os.environ.get("MONITORING_IMAGE_URI"):
+        monitoring_image_uri = os.environ["MONITORING_IMAGE_URI"]
+        logging.info(f"Monitoring Image URI, {monitoring_image_uri}")
+        return monitoring_image_uri
+
     ecr_monitoring_imageName = build_push_docker_image(project_params,docker_file_path)
     monitoring_image_uri = f"{ecr_monitoring_imageName}:latest"
     logging.info(f"Monitoring Image URI, {monitoring_image_uri}")
@@ -54,13 +60,31 @@ def _attach_model_monitoring(project_params, monitoring_image_uri):
     instanceCount = project_params["Instance"]["instanceCount"]
     instanceType = project_params["Instance"]["instanceType"]
     threshold = project_params["ModelMonitoring"]["threshold"]
+    lookbackHours = project_params["ModelMonitoring"].get("lookbackHours", "10")
+    bucketName = project_params["S3Config"]["bucketName"]
+    _s3Prefix = project_params["S3Config"]["s3Prefix"] + project_params["S3Config"]["realtimeS3Prefix"]
+    stateS3Uri = f's3://'+bucketName+"/"+_s3Prefix+project_params["ModelMonitoring"]["stateS3Prefix"]
+    variantComparison = project_params["ModelMonitoring"].get("variantComparison") or {}
+    variantEnv = {
+        'BASELINE_VARIANT': variantComparison.get("baselineVariant"),
+        'MAX_LATENCY_REGRESSION': variantComparison.get("maxLatencyRegression"),
+        'MIN_SAMPLE_COUNT': variantComparison.get("minSampleCount"),
+        'MAX_MEMORY_UTILIZATION': variantComparison.get("maxMemoryUtilization"),
+    }
+    # The job evaluates all the endpoints of the fleet, by default the one it is attached to.
+    endpoints = project_params["ModelMonitoring"].get("endpoints") or [project_params["EndpointConfig"]["endpointName"]]
+    fleetEnv = {
+        'ENDPOINT_NAMES': ",".join(endpoints),
+        'MAX_CONCURRENT_ENDPOINTS': project_params["ModelMonitoring"].get("maxConcurrentEndpoints"),
+    }
     monitor = ModelMonitor(
         base_job_name= baseJobName,
         role=roleArn,
         image_uri=monitoring_image_uri,
         instance_count=instanceCount,
         instance_type=instanceType,
-        env={ 'THRESHOLD':threshold },
+        env={ 'THRESHOLD':threshold, 'STATE_S3_URI':stateS3Uri, 'LOOKBACK_HOURS':str(lookbackHours),
+              **{key: str(value) for key, value in {**variantEnv, **fleetEnv}.items() if value is not None} },
     )
     return monitor
 
@@ -0,0 +1,206 @@
+import logging
+
+SERVICE_NAMESPACE = 'sagemaker'
+SCALABLE_DIMENSION = 'sagemaker:variant:DesiredInstanceCount'
+DEFAULT_VARIANT_NAME = 'AllTraffic'
+
+
+def resource_id(endpoint_name, variant_name=DEFAULT_VARIANT_NAME):
+    """Returns the Application Auto Scaling resource id of an endpoint variant."""
+    return f"endpoint/{endpoint_name}/variant/{variant_name}"
+
+
+def _policy_name(endpoint_name, variant_name, metric):
+    return f"{endpoint_name}-{variant_name}-{metric}"
+
+
+def _invocations_per_instance_policy(policy, scale_in_cooldown, scale_out_cooldown):
+    return {
+        'TargetValue': float(policy['targetValue']),
+        'PredefinedMetricSpecification': {'PredefinedMetricType': 'SageMakerVariantInvocationsPerInstance'},
+        'ScaleInCooldown': int(policy.get('scaleInCooldown', scale_in_cooldown)),
+        'ScaleOutCooldown': int(policy.get('scaleOutCooldown', scale_out_cooldown)),
+        'DisableScaleIn': bool(policy.get('disableScaleIn', False)),
+    }
+
+
+def _model_latency_policy(policy, endpoint_name, variant_name, scale_in_cooldown, scale_out_cooldown):
+    # ModelLatency has no predefined metric type, it is tracked as a customized CloudWatch metric.
+    return {
+        'TargetValue': float(policy['targetValue']),
+        'CustomizedMetricSpecification': {
+            'MetricName': 'ModelLatency',
+            'Namespace': 'AWS/SageMaker',
+            'Dimensions': [
+                {'Name': 'EndpointName', 'Value': endpoint_name},
+                {'Name': 'VariantName', 'Value': variant_name},
+            ],
+            'Statistic': policy.get('statistic', 'Average'),
+            'Unit': 'Microseconds',
+        },
+        'ScaleInCooldown': int(policy.get('scaleInCooldown', scale_in_cooldown)),
+        'ScaleOutCooldown': int(policy.get('scaleOutCooldown', scale_out_cooldown)),
+        'DisableScaleIn': bool(policy.get('disableScaleIn', False)),
+    }
+
+
+def target_tracking_policies(autoscaling_params, endpoint_name, variant_name=DEFAULT_VARIANT_NAME):
+    """Builds the target tracking policies configured in the AutoScaling section.
+
+    Args:
+        autoscaling_params: A dictionary, the AutoScaling section of config.yml.
+        endpoint_name: A string representing the name of the SageMaker endpoint.
+        variant_name: A string representing the name of the production variant.
+
+    Returns:
+        A dictionary mapping the policy names to their TargetTrackingScalingPolicyConfiguration.
+    """
+    policies = autoscaling_params.get('policies') or {}
+    scale_in_cooldown = autoscaling_params.get('scaleInCooldown', 300)
+    scale_out_cooldown = autoscaling_params.get('scaleOutCooldown', 60)
+    configurations = {}
+    if policies.get('invocationsPerInstance'):
+        configurations[_policy_name(endpoint_name, variant_name, 'InvocationsPerInstance')] = \
+            _invocations_per_instance_policy(policies['invocationsPerInstance'], scale_in_cooldown,
+                                             scale_out_cooldown)
+    if policies.get('modelLatency'):
+        configurations[_policy_name(endpoint_name, variant_name, 'ModelLatency')] = \
+            _model_latency_policy(policies['modelLatency'], endpoint_name, variant_name, scale_in_cooldown,
+                                  scale_out_cooldown)
+    return configurations
+
+
+def register_scalable_target(client, endpoint_name, min_capacity, max_capacity,
+                             variant_name=DEFAULT_VARIANT_NAME):
+    """Registers (or updates) the instance count of the endpoint variant as a scalable target."""
+    if min_capacity > max_capacity:
+        raise ValueError(f"minCapacity {min_capacity} is larger than maxCapacity {max_capacity}")
+    client.register_scalable_target(
+        ServiceNamespace=SERVICE_NAMESPACE,
+        ResourceId=resource_id(endpoint_name, variant_name),
+        ScalableDimension=SCALABLE_DIMENSION,
+        MinCapacity=min_capacity,
+        MaxCapacity=max_capacity,
+    )
+    logging.info(f"Scalable target {resource_id(endpoint_name, variant_name)}, capacity {min_capacity}-{max_capacity}")
+
+
+def deregister_scalable_target(client, endpoint_name, variant_name=DEFAULT_VARIANT_NAME):
+    """Deregisters the endpoint variant, together with its policies and scheduled actions.
+
+    SageMaker refuses endpoint updates that change the instance type of a scalable
+    variant, so the deployment deregisters the variants before an update and
+    configure_autoscaling registers them again afterwards.
+
+    Returns:
+        True if the variant was registered.
+    """
+    try:
+        client.deregister_scalable_target(ServiceNamespace=SERVICE_NAMESPACE,
+                                          ResourceId=resource_id(endpoint_name, variant_name),
+                                          ScalableDimension=SCALABLE_DIMENSION)
+    except client.exceptions.ObjectNotFoundException:
+        return False
+    logging.info(f"Deregistered scalable target {resource_id(endpoint_name, variant_name)}")
+    return True
+
+
+def put_scaling_policy(client, endpoint_name, policy_name, configuration, variant_name=DEFAULT_VARIANT_NAME):
+    """Creates or replaces a target tracking scaling policy of the endpoint variant."""
+    response = client.put_scaling_policy(
+        PolicyName=policy_name,
+        ServiceNamespace=SERVICE_NAMESPACE,
+        ResourceId=resource_id(endpoint_name, variant_name),
+        ScalableDimension=SCALABLE_DIMENSION,
+        PolicyType='TargetTrackingScaling',
+        TargetTrackingScalingPolicyConfiguration=configuration,
+    )
+    logging.info(f"Scaling policy {policy_name}, {response['PolicyARN']}")
+    return response['PolicyARN']
+
+
+def put_scheduled_action(client, endpoint_name, action, variant_name=DEFAULT_VARIANT_NAME):
+    """Creates or replaces a scheduled action changing the capacity range of the endpoint variant.
+
+    Args:
+        client: An application-autoscaling boto3 client.
+        endpoint_name: A string representing the name of the SageMaker endpoint.
+        action: A dictionary with name, schedule (at(), rate() or cron() expression), optional
+            timezone, minCapacity and/or maxCapacity.
+        variant_name: A string representing the name of the production variant.
+    """
+    scalable_target_action = {}
+    if 'minCapacity' in action:
+        scalable_target_action['MinCapacity'] = action['minCapacity']
+    if 'maxCapacity' in action:
+        scalable_target_action['MaxCapacity'] = action['maxCapacity']
+    params = {
+        'ServiceNamespace': SERVICE_NAMESPACE,
+        'ScheduledActionName': action['name'],
+        'ResourceId': resource_id(endpoint_name, variant_name),
+        'ScalableDimension': SCALABLE_DIMENSION,
+        'Schedule': action['schedule'],
+        'ScalableTargetAction': scalable_target_action,
+    }
+    if action.get('timezone'):
+        params['Timezone'] = action['timezone']
+    client.put_scheduled_action(**params)
+    logging.info(f"Scheduled action {action['name']}, {action['schedule']} {scalable_target_action}")
+
+
+def _delete_stale(client, endpoint_name, variant_name, policy_names, action_names):
+    """Removes the policies and scheduled actions of the variant that are no longer configured."""
+    target = resource_id(endpoint_name, variant_name)
+    policies = client.describe_scaling_policies(
+        ServiceNamespace=SERVICE_NAMESPACE, ResourceId=target, ScalableDimension=SCALABLE_DIMENSION)
+    for policy in policies['ScalingPolicies']:
+        if policy['PolicyName'] not in policy_names:
+            client.delete_scaling_policy(PolicyName=policy['PolicyName'], ServiceNamespace=SERVICE_NAMESPACE,
+                                         ResourceId=target, ScalableDimension=SCALABLE_DIMENSION)
+            logging.info(f"Deleted scaling policy {policy['PolicyName']}")
+    actions = client.describe_scheduled_actions(
+        ServiceNamespace=SERVICE_NAMESPACE, ResourceId=target, ScalableDimension=SCALABLE_DIMENSION)
+    for action in actions['ScheduledActions']:
+        if action['ScheduledActionName'] not in action_names:
+            client.delete_scheduled_action(ServiceNamespace=SERVICE_NAMESPACE,
+                                           ScheduledActionName=action['ScheduledActionName'],
+                                           ResourceId=target, ScalableDimension=SCALABLE_DIMENSION)
+            logging.info(f"Deleted scheduled action {action['ScheduledActionName']}")
+
+
+def configure_autoscaling(client, project_params, variant_name=DEFAULT_VARIANT_NAME):
+    """Applies the AutoScaling section of config.yml to the endpoint variant.
+
+    Every call converges the variant to the configuration: the scalable target,
+    policies and scheduled actions are upserted, and policies or scheduled actions
+    that were removed from the configuration are deleted, so re-running the
+    deployment is safe. The endpoint has to be InService. Keys under
+    AutoScaling.variants.<variant name> override the section for that variant.
+
+    Args:
+        client: An application-autoscaling boto3 client (or a stubbed one).
+        project_params: A dictionary containing the project parameters.
+        variant_name: A string representing the name of the production variant.
+
+    Returns:
+        A list with the ARNs of the scaling policies, empty if autoscaling is disabled.
+    """
+    autoscaling_params = dict(project_params.get("AutoScaling") or {})
+    autoscaling_params.update((autoscaling_params.pop("variants", None) or {}).get(variant_name) or {})
+    if not autoscaling_params.get("enabled", False):
+        logging.info(f"Autoscaling disabled for variant {variant_name}")
+        return []
+    endpoint_name = project_params["EndpointConfig"]["endpointName"]
+    min_capacity = int(autoscaling_params["minCapacity"])
+    max_capacity = int(autoscaling_params["maxCapacity"])
+
+    register_scalable_target(client, endpoint_name, min_capacity, max_capacity, variant_name)
+    configurations = target_tracking_policies(autoscaling_params, endpoint_name, variant_name)
+    policy_arns = [put_scaling_policy(client, endpoint_name, policy_name, configuration, variant_name)
+                   for policy_name, configuration in configurations.items()]
+    scheduled_actions = autoscaling_params.get("scheduledActions") or []
+    for action in scheduled_actions:
+        put_scheduled_action(client, endpoint_name, action, variant_name)
+    _delete_stale(client, endpoint_name, variant_name, set(configurations),
+                  {action['name'] for action in scheduled_actions})
+    return policy_arns
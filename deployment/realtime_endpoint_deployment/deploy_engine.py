@@ -0,0 +1,442 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from botocore.exceptions import ClientError
+
+from autoscaling import configure_autoscaling, deregister_scalable_target
+
+# SageMaker model, endpoint config and endpoint names are limited to 63 characters.
+MAX_NAME_LENGTH = 63
+
+CORS_CONFIGURATION = {
+    "CORSRules": [
+        {
+            "AllowedHeaders": [
+                "Authorization",
+                "Content-Range",
+                "Accept",
+                "Content-Type",
+                "Origin",
+                "Range",
+            ],
+            "AllowedMethods": ["GET", "PUT"],
+            "AllowedOrigins": ["*"],
+            "ExposeHeaders": ["Content-Range", "Content-Length", "ETag"],
+            "MaxAgeSeconds": 3000,
+        }
+    ]
+}
+
+
+class StepFailed(Exception):
+    """Raised by DeployEngine.run when a step failed, the steps depending on it were skipped."""
+
+    def __init__(self, step, error):
+        super().__init__(f"Deploy step {step} failed: {error}")
+        self.step = step
+        self.error = error
+
+
+class DeployEngine:
+    """Runs deploy steps concurrently as soon as the steps they require are done.
+
+    Every step is a callable receiving the results of its required steps as
+    keyword arguments named after them. Independent steps (e.g. the bucket setup
+    and the image build) overlap; the timing of every step is recorded.
+
+    Usage:
+        engine = DeployEngine()
+        engine.add("image", build_image)
+        engine.add("model", lambda image: create_model(image), requires=("image",))
+        results = engine.run()
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._steps = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._started = None
+
+    def add(self, name, fn, requires=()):
+        for required in requires:
+            if required not in self._steps:
+                raise ValueError(f"Step {name} requires the unknown step {required}")
+        self._steps[name] = (fn, tuple(requires))
+
+    def _run_step(self, name, fn, kwargs):
+        started = time.monotonic()
+        status = "failed"
+        try:
+            result = fn(**kwargs)
+            status = "done"
+            return result
+        finally:
+            finished = time.monotonic()
+            with self._lock:
+                self.timings[name] = {"start": started - self._started, "seconds": finished - started,
+                                      "status": status}
+            logging.info(f"Deploy step {name} {status} in {finished - started:.1f}s")
+
+    def run(self):
+        """Runs all steps and returns their results by step name.
+
+        Raises:
+            StepFailed: for the first failing step, once the steps already running have finished.
+        """
+        self._started = time.monotonic()
+        results = {}
+        pending = dict(self._steps)
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if failure is None:
+                    for name, (fn, requires) in list(pending.items()):
+                        if all(required in results for required in requires):
+                            kwargs = {required: results[required] for required in requires}
+                            running[executor.submit(self._run_step, name, fn, kwargs)] = name
+                            del pending[name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        logging.exception(f"Deploy step {name} failed")
+                        if failure is None:
+                            failure = StepFailed(name, e)
+        for name in pending:
+            self.timings[name] = {"start": None, "seconds": None, "status": "skipped"}
+        self.timings["total"] = {"start": 0.0, "seconds": time.monotonic() - self._started,
+                                 "status": "failed" if failure else "done"}
+        if failure is not None:
+            raise failure
+        return results
+
+    def report(self):
+        """Returns the step timings as a table, in the order the steps started."""
+        lines = [f"{'step':<20}{'status':<10}{'start s':>10}{'duration s':>12}"]
+        for name, timing in sorted(self.timings.items(),
+                                   key=lambda item: (item[0] == "total", item[1]["start"] is None,
+                                                     item[1]["start"] or 0.0)):
+            start = "-" if timing["start"] is None else f"{timing['start']:.1f}"
+            seconds = "-" if timing["seconds"] is None else f"{timing['seconds']:.1f}"
+            lines.append(f"{name:<20}{timing['status']:<10}{start:>10}{seconds:>12}")
+        return "\n".join(lines)
+
+
+def deployment_version():
+    """Returns the version suffix of the deployed resources.
+
+    DEPLOYMENT_VERSION if set, otherwise the UTC time of the deployment followed by
+    the short commit SHA when running in GitHub Actions.
+    """
+    if os.environ.get("DEPLOYMENT_VERSION"):
+        return os.environ["DEPLOYMENT_VERSION"]
+    version = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    if os.environ.get("GITHUB_SHA"):
+        version += "-" + os.environ["GITHUB_SHA"][:7]
+    return version
+
+
+def versioned_name(name, version):
+    """Appends the version to a resource name, shortening the name to fit the 63 character limit."""
+    suffix = "-" + version
+    return name[:MAX_NAME_LENGTH - len(suffix)].rstrip("-") + suffix
+
+
+def production_variants(project_params):
+    """Returns the production variants of the endpoint.
+
+    The variants come from EndpointConfig.productionVariants; without it the endpoint
+    has a single AllTraffic variant sized by the Instance section. Every variant gets
+    a modelName (EndpointConfig.modelName by default), an instanceType, instanceCount,
+    initialWeight and the optional environment and imageUri of its model.
+    """
+    variants = project_params["EndpointConfig"].get("productionVariants")
+    if not variants:
+        variants = [{"variantName": "AllTraffic"}]
+    resolved = []
+    for variant in variants:
+        resolved.append({
+            "variantName": variant["variantName"],
+            "modelName": variant.get("modelName", project_params["EndpointConfig"]["modelName"]),
+            "instanceType": variant.get("instanceType", project_params["Instance"]["instanceType"]),
+            "instanceCount": variant.get("instanceCount", project_params["Instance"]["instanceCount"]),
+            "initialWeight": variant.get("initialWeight", 1),
+            "environment": variant.get("environment") or {},
+            "imageUri": variant.get("imageUri"),
+        })
+    return resolved
+
+
+def _error_code(error):
+    return error.response.get("Error", {}).get("Code")
+
+
+class EndpointDeployer:
+    """Idempotent deploy steps of the realtime endpoint.
+
+    Models and endpoint configs are immutable in SageMaker, so every deployment
+    creates them under versioned names (<name>-<version>) and then points the
+    endpoint at the new config: create_endpoint the first time, update_endpoint
+    with a blue/green deployment afterwards, so the old fleet keeps serving until
+    the new one is healthy. Re-running a deployment with the same version reuses
+    the resources that already exist. The previous versions are kept, pointing the
+    endpoint back at the previous config is the manual rollback.
+
+    The boto3 clients are passed in, so the steps can run against botocore Stubbers.
+    """
+
+    def __init__(self, project_params, sm_client, s3_client, autoscaling_client, region, version=None):
+        self.project_params = project_params
+        self.sm_client = sm_client
+        self.s3_client = s3_client
+        self.autoscaling_client = autoscaling_client
+        self.region = region
+        self.version = version or deployment_version()
+        self.endpoint_name = project_params["EndpointConfig"]["endpointName"]
+
+    def ensure_bucket(self):
+        """Creates the input bucket and folder unless they exist, and sets its CORS rules."""
+        bucketName = self.project_params["S3Config"]["bucketName"]
+        folderName = self.project_params["S3Config"]["inputDir"]
+        try:
+            self.s3_client.head_bucket(Bucket=bucketName)
+        except ClientError as e:
+            if _error_code(e) not in ("404", "NoSuchBucket"):
+                raise
+            params = {"Bucket": bucketName}
+            # us-east-1 is the default location and must not be given as constraint.
+            if self.region != "us-east-1":
+                params["CreateBucketConfiguration"] = {"LocationConstraint": self.region}
+            self.s3_client.create_bucket(**params)
+            logging.info(f"Bucket created, {bucketName}")
+        self.s3_client.put_object(Bucket=bucketName, Key=folderName)
+        self.s3_client.put_bucket_cors(Bucket=bucketName, CORSConfiguration=CORS_CONFIGURATION)
+        return bucketName
+
+    def _model_exists(self, model_name):
+        try:
+            self.sm_client.describe_model(ModelName=model_name)
+            return True
+        except ClientError as e:
+            if _error_code(e) != "ValidationException":
+                raise
+            return False
+
+    def create_model(self, model_name, image_uri, environment=None):
+        """Creates a model of this version unless it already exists, and returns its name."""
+        versioned_model_name = versioned_name(model_name, self.version)
+        if self._model_exists(versioned_model_name):
+            logging.info(f"Model exists, {versioned_model_name}")
+            return versioned_model_name
+        bucketName = self.project_params["S3Config"]["bucketName"]
+        _s3Prefix = self.project_params["S3Config"]["s3Prefix"] + self.project_params["S3Config"]["realtimeS3Prefix"]
+        asyncJobsDir = self.project_params["S3Config"]["asyncJobsDir"]
+        deployment = self.project_params.get("Deployment") or {}
+        reloadEnv = {}
+        if deployment.get("modelReload"):
+            # Versions uploaded as <modelDir><version>/model.tflite are picked up without a redeploy.
+            reloadEnv = {
+                'MODEL_RELOAD_SOURCE': f's3://'+bucketName+"/"+_s3Prefix+self.project_params["S3Config"]["modelDir"],
+                'MODEL_RELOAD_INTERVAL': str(deployment.get("modelReloadInterval", 30)),
+            }
+        response = self.sm_client.create_model(
+            ModelName=versioned_model_name,
+            PrimaryContainer={
+                'Image': image_uri,
+                # Job state shared by all workers and instances of the endpoint
+                'Environment': {
+                    'ASYNC_JOB_STORE': f's3://'+bucketName+"/"+_s3Prefix+asyncJobsDir,
+                    **reloadEnv,
+                    **{key: str(value) for key, value in (environment or {}).items()},
+                },
+            },
+            ExecutionRoleArn=self.project_params["EndpointConfig"]["roleArn"]
+        )
+        logging.info(f"Model Arn, {response['ModelArn']}")
+        return versioned_model_name
+
+    def create_models(self, image_uri):
+        """Creates the models of all production variants, variants sharing a model share it.
+
+        Returns:
+            A dictionary mapping the configured model names to the versioned model names.
+        """
+        model_names = {}
+        for variant in production_variants(self.project_params):
+            if variant["modelName"] not in model_names:
+                model_names[variant["modelName"]] = self.create_model(
+                    variant["modelName"], variant["imageUri"] or image_uri, variant["environment"])
+        return model_names
+
+    def create_endpoint_config(self, model_names):
+        """Creates the endpoint config of this version unless it already exists, and returns its name."""
+        endpointConfigName = versioned_name(self.project_params["EndpointConfig"]["endpointConfigName"],
+                                            self.version)
+        try:
+            self.sm_client.describe_endpoint_config(EndpointConfigName=endpointConfigName)
+            logging.info(f"Endpoint configuration exists, {endpointConfigName}")
+            return endpointConfigName
+        except ClientError as e:
+            if _error_code(e) != "ValidationException":
+                raise
+
+        capture_modes = ["Input",  "Output"]
+        bucketName = self.project_params["S3Config"]["bucketName"]
+        _s3Prefix = self.project_params["S3Config"]["s3Prefix"] + self.project_params["S3Config"]["realtimeS3Prefix"]
+        dataCapture = self.project_params["S3Config"]["dataCapture"]
+        response = self.sm_client.create_endpoint_config(
+            EndpointConfigName=endpointConfigName,
+            # Traffic is split between the variants in proportion to their weights.
+            ProductionVariants=[
+                {
+                    'InstanceType': variant["instanceType"],
+                    'InitialInstanceCount': variant["instanceCount"],
+                    'InitialVariantWeight': variant["initialWeight"],
+                    'ModelName': model_names[variant["modelName"]],
+                    'VariantName': variant["variantName"]
+                }
+                for variant in production_variants(self.project_params)
+            ],
+            DataCaptureConfig={
+                # Whether data should be captured or not.
+                'EnableCapture': self.project_params["DataCapture"]["enableCapture"],
+                'InitialSamplingPercentage': self.project_params["DataCapture"]["initialSamplingPercentage"],
+                'DestinationS3Uri': f's3://'+bucketName+"/"+_s3Prefix+dataCapture,
+                "CaptureContentTypeHeader": {
+                    "JsonContentTypes": ["application/json"]
+                },
+                'CaptureOptions': [{"CaptureMode": capture_mode} for capture_mode in capture_modes]
+            }
+        )
+        logging.info(f"Endpoint Configuration Arn, {response['EndpointConfigArn']}")
+        return endpointConfigName
+
+    def _describe_endpoint(self):
+        try:
+            return self.sm_client.describe_endpoint(EndpointName=self.endpoint_name)
+        except ClientError as e:
+            if _error_code(e) != "ValidationException":
+                raise
+            return None
+
+    def deployment_config(self):
+        """Returns the blue/green DeploymentConfig of update_endpoint from the Deployment section."""
+        deployment_params = self.project_params.get("Deployment") or {}
+        traffic_routing = {"Type": deployment_params.get("trafficRouting", "ALL_AT_ONCE"),
+                           "WaitIntervalInSeconds": int(deployment_params.get("waitIntervalInSeconds", 300))}
+        if traffic_routing["Type"] == "CANARY":
+            traffic_routing["CanarySize"] = {"Type": "CAPACITY_PERCENT",
+                                             "Value": int(deployment_params.get("canarySizePercent", 10))}
+        elif traffic_routing["Type"] == "LINEAR":
+            traffic_routing["LinearStepSize"] = {"Type": "CAPACITY_PERCENT",
+                                                 "Value": int(deployment_params.get("linearStepPercent", 25))}
+        config = {
+            "BlueGreenUpdatePolicy": {
+                "TrafficRoutingConfiguration": traffic_routing,
+                "TerminationWaitInSeconds": int(deployment_params.get("terminationWaitInSeconds", 0)),
+            }
+        }
+        alarms = deployment_params.get("rollbackAlarms") or []
+        if alarms:
+            config["AutoRollbackConfiguration"] = {"Alarms": [{"AlarmName": alarm} for alarm in alarms]}
+        return config
+
+    def _wait_in_service(self):
+        logging.info(f"Waiting for {self.endpoint_name} endpoint to be in service...")
+        self.sm_client.get_waiter('endpoint_in_service').wait(
+            EndpointName=self.endpoint_name, WaiterConfig={"Delay": 30, "MaxAttempts": 120})
+        return self.sm_client.describe_endpoint(EndpointName=self.endpoint_name)
+
+    def deploy_endpoint(self, endpoint_config_name):
+        """Points the endpoint at the endpoint config, creating or updating it, and waits until it serves.
+
+        An update deregisters the scalable targets of the variants first; when it
+        fails or SageMaker rolls it back, the scaling of the variants left serving
+        is registered again before the error is raised.
+
+        Raises:
+            RuntimeError: when SageMaker rolled the update back to the previous config.
+
+        Returns:
+            The endpoint ARN.
+        """
+        endpoint = self._describe_endpoint()
+        if endpoint is not None and endpoint["EndpointStatus"] in ("Creating", "Updating", "SystemUpdating",
+                                                                    "RollingBack"):
+            endpoint = self._wait_in_service()
+        if endpoint is not None and endpoint["EndpointStatus"] == "Failed":
+            # A failed endpoint can only be deleted.
+            logging.info(f"Deleting failed endpoint {self.endpoint_name}")
+            self.sm_client.delete_endpoint(EndpointName=self.endpoint_name)
+            self.sm_client.get_waiter('endpoint_deleted').wait(EndpointName=self.endpoint_name)
+            endpoint = None
+
+        if endpoint is None:
+            response = self.sm_client.create_endpoint(EndpointName=self.endpoint_name,
+                                                      EndpointConfigName=endpoint_config_name)
+            logging.info(f"Endpoint Arn, {response['EndpointArn']}")
+        elif endpoint["EndpointConfigName"] == endpoint_config_name:
+            logging.info(f"Endpoint {self.endpoint_name} already serves {endpoint_config_name}")
+            return endpoint["EndpointArn"]
+        else:
+            try:
+                for variant in endpoint.get("ProductionVariants", []):
+                    deregister_scalable_target(self.autoscaling_client, self.endpoint_name, variant["VariantName"])
+                self.sm_client.update_endpoint(EndpointName=self.endpoint_name,
+                                               EndpointConfigName=endpoint_config_name,
+                                               DeploymentConfig=self.deployment_config())
+                logging.info(f"Endpoint {self.endpoint_name} updating from {endpoint['EndpointConfigName']} "
+                             f"to {endpoint_config_name}")
+                return self._wait_deployed(endpoint_config_name)
+            except Exception:
+                # The previous fleet keeps serving, it must not stay pinned at its initial instance count.
+                self.restore_autoscaling()
+                raise
+
+        return self._wait_deployed(endpoint_config_name)
+
+    def _wait_deployed(self, endpoint_config_name):
+        endpoint = self._wait_in_service()
+        if endpoint["EndpointConfigName"] != endpoint_config_name:
+            raise RuntimeError(f"Endpoint {self.endpoint_name} rolled back to {endpoint['EndpointConfigName']}")
+        logging.info(f"Endpoint Arn, {endpoint['EndpointArn']}")
+        return endpoint["EndpointArn"]
+
+    def configure_autoscaling(self, variant_names=None):
+        """Applies the AutoScaling section to the variants (the configured ones by default).
+
+        Returns:
+            A dictionary mapping the variant names to the ARNs of their scaling policies.
+        """
+        if variant_names is None:
+            variant_names = [variant["variantName"] for variant in production_variants(self.project_params)]
+        return {variant_name: configure_autoscaling(self.autoscaling_client, self.project_params, variant_name)
+                for variant_name in variant_names}
+
+    def restore_autoscaling(self):
+        """Registers the scaling of the variants the endpoint serves after a failed or rolled back update.
+
+        Errors are logged, not raised, the update error is the one reported.
+        """
+        try:
+            endpoint = self._describe_endpoint()
+            if endpoint is None:
+                return {}
+            if endpoint["EndpointStatus"] in ("Updating", "RollingBack", "SystemUpdating"):
+                endpoint = self._wait_in_service()
+            variant_names = [variant["VariantName"] for variant in endpoint.get("ProductionVariants", [])]
+            logging.info(f"Restoring the autoscaling of {self.endpoint_name} variants {variant_names}")
+            return self.configure_autoscaling(variant_names)
+        except Exception:
+            logging.exception(f"Autoscaling of {self.endpoint_name} could not be restored")
+            return {}
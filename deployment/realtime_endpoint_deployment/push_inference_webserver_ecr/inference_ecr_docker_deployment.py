@@ -32,20 +32,21 @@ def read_config(file_path):
     return project_params
 
 
-def build_push_docker_image(project_params, docker_file_path):
+def build_push_docker_image(project_params, docker_file_path, version=None):
     """Used to build and push a Docker image to Amazon Elastic Container Registry (ECR). 
        This takes in a dictionary of project parameters and a file path to the Dockerfile
     
     Args:
         project_params: A dictionary containing the project parameters required for building and pushing the Docker image.
         docker_file_path: A string representing the file path to the Dockerfile
+        version: An optional string, the immutable tag the image is also pushed under.
     
     Returns: 
-        image_name: A string representing the URI of the Docker image in ECR.
+        image_name: A string representing the URI of the Docker image in ECR, with the version tag if given.
     
     """
     ecrInferenceImageName = project_params["InferenceConfig"]["ecrInferenceImageName"]
     repository_short_name = ecrInferenceImageName
     logging.info(f"Repository Name, {repository_short_name}")
-    image_name = build_and_push_docker_image(repository_short_name, docker_file_path)
+    image_name = build_and_push_docker_image(repository_short_name, docker_file_path, version=version)
     return image_name
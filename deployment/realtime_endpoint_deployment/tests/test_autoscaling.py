@@ -0,0 +1,133 @@
+import os
+import sys
+import unittest
+from datetime import datetime
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from autoscaling import (  # noqa: E402
+    SCALABLE_DIMENSION, SERVICE_NAMESPACE, configure_autoscaling, deregister_scalable_target, resource_id,
+    target_tracking_policies)
+
+ENDPOINT = 'hp-prediction-endpoint'
+TARGET = resource_id(ENDPOINT)
+ACTION = {'name': 'hp-prediction-business-hours', 'schedule': 'cron(0 8 ? * MON-FRI *)',
+          'timezone': 'Asia/Kolkata', 'minCapacity': 2, 'maxCapacity': 4}
+
+
+def project_params(**autoscaling):
+    params = {'enabled': True, 'minCapacity': 1, 'maxCapacity': 4,
+              'policies': {'invocationsPerInstance': {'targetValue': 70}},
+              'scheduledActions': [ACTION]}
+    params.update(autoscaling)
+    return {'EndpointConfig': {'endpointName': ENDPOINT}, 'AutoScaling': params}
+
+
+def client():
+    return boto3.client('application-autoscaling', region_name='us-east-1',
+                        aws_access_key_id='testing', aws_secret_access_key='testing')
+
+
+def policy_arn(policy_name):
+    return f'arn:aws:autoscaling:us-east-1:123456789012:scalingPolicy:id:resource/{TARGET}:policyName/{policy_name}'
+
+
+def described_policy(policy_name):
+    return {'PolicyARN': policy_arn(policy_name), 'PolicyName': policy_name, 'ServiceNamespace': SERVICE_NAMESPACE,
+            'ResourceId': TARGET, 'ScalableDimension': SCALABLE_DIMENSION, 'PolicyType': 'TargetTrackingScaling',
+            'CreationTime': datetime(2024, 6, 1)}
+
+
+def described_action(action_name):
+    return {'ScheduledActionName': action_name,
+            'ScheduledActionARN': f'arn:aws:autoscaling:us-east-1:123456789012:scheduledAction:id:{action_name}',
+            'ServiceNamespace': SERVICE_NAMESPACE, 'Schedule': 'cron(0 8 ? * MON-FRI *)', 'ResourceId': TARGET,
+            'ScalableDimension': SCALABLE_DIMENSION, 'CreationTime': datetime(2024, 6, 1)}
+
+
+class ConfigureAutoscalingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client()
+        self.stubber = Stubber(self.client)
+        self.policies = target_tracking_policies(project_params()['AutoScaling'], ENDPOINT)
+
+    def expect_upserts(self):
+        self.stubber.add_response('register_scalable_target', {}, {
+            'ServiceNamespace': SERVICE_NAMESPACE, 'ResourceId': TARGET, 'ScalableDimension': SCALABLE_DIMENSION,
+            'MinCapacity': 1, 'MaxCapacity': 4})
+        for policy_name, configuration in self.policies.items():
+            self.stubber.add_response('put_scaling_policy', {'PolicyARN': policy_arn(policy_name)}, {
+                'PolicyName': policy_name, 'ServiceNamespace': SERVICE_NAMESPACE, 'ResourceId': TARGET,
+                'ScalableDimension': SCALABLE_DIMENSION, 'PolicyType': 'TargetTrackingScaling',
+                'TargetTrackingScalingPolicyConfiguration': configuration})
+        self.stubber.add_response('put_scheduled_action', {}, {
+            'ServiceNamespace': SERVICE_NAMESPACE, 'ScheduledActionName': ACTION['name'], 'ResourceId': TARGET,
+            'ScalableDimension': SCALABLE_DIMENSION, 'Schedule': ACTION['schedule'], 'Timezone': ACTION['timezone'],
+            'ScalableTargetAction': {'MinCapacity': 2, 'MaxCapacity': 4}})
+
+    def expect_described_policies(self, policy_names):
+        self.stubber.add_response(
+            'describe_scaling_policies', {'ScalingPolicies': [described_policy(name) for name in policy_names]},
+            {'ServiceNamespace': SERVICE_NAMESPACE, 'ResourceId': TARGET, 'ScalableDimension': SCALABLE_DIMENSION})
+
+    def expect_described_actions(self, action_names):
+        self.stubber.add_response(
+            'describe_scheduled_actions', {'ScheduledActions': [described_action(name) for name in action_names]},
+            {'ServiceNamespace': SERVICE_NAMESPACE, 'ResourceId': TARGET, 'ScalableDimension': SCALABLE_DIMENSION})
+
+    def expect_described(self, policy_names, action_names):
+        self.expect_described_policies(policy_names)
+        self.expect_described_actions(action_names)
+
+    def test_first_run(self):
+        self.expect_upserts()
+        self.expect_described([], [])
+        with self.stubber:
+            arns = configure_autoscaling(self.client, project_params())
+        self.assertEqual(arns, [policy_arn(name) for name in self.policies])
+        self.stubber.assert_no_pending_responses()
+
+    def test_rerun_is_idempotent(self):
+        # The second run upserts the same resources and deletes nothing.
+        self.expect_upserts()
+        self.expect_described(list(self.policies), [ACTION['name']])
+        with self.stubber:
+            configure_autoscaling(self.client, project_params())
+        self.stubber.assert_no_pending_responses()
+
+    def test_deletes_stale_policy_and_scheduled_action(self):
+        stale_policy = f'{ENDPOINT}-AllTraffic-ModelLatency'
+        stale_action = 'hp-prediction-off-hours'
+        self.expect_upserts()
+        self.expect_described_policies(list(self.policies) + [stale_policy])
+        self.stubber.add_response('delete_scaling_policy', {}, {
+            'PolicyName': stale_policy, 'ServiceNamespace': SERVICE_NAMESPACE, 'ResourceId': TARGET,
+            'ScalableDimension': SCALABLE_DIMENSION})
+        self.expect_described_actions([ACTION['name'], stale_action])
+        self.stubber.add_response('delete_scheduled_action', {}, {
+            'ServiceNamespace': SERVICE_NAMESPACE, 'ScheduledActionName': stale_action, 'ResourceId': TARGET,
+            'ScalableDimension': SCALABLE_DIMENSION})
+        with self.stubber:
+            configure_autoscaling(self.client, project_params())
+        self.stubber.assert_no_pending_responses()
+
+    def test_disabled_makes_no_calls(self):
+        with self.stubber:
+            self.assertEqual(configure_autoscaling(self.client, project_params(enabled=False)), [])
+        self.stubber.assert_no_pending_responses()
+
+
+class DeregisterScalableTargetTest(unittest.TestCase):
+
+    def test_not_registered(self):
+        autoscaling_client = client()
+        with Stubber(autoscaling_client) as stubber:
+            stubber.add_client_error('deregister_scalable_target', service_error_code='ObjectNotFoundException')
+            self.assertFalse(deregister_scalable_target(autoscaling_client, ENDPOINT))
+
+
+if __name__ == '__main__':
+    unittest.main()
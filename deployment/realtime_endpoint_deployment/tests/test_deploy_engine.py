@@ -0,0 +1,153 @@
+import os
+import sys
+import threading
+import unittest
+from datetime import datetime
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from autoscaling import SCALABLE_DIMENSION, SERVICE_NAMESPACE, resource_id  # noqa: E402
+from deploy_engine import DeployEngine, EndpointDeployer, StepFailed  # noqa: E402
+
+ENDPOINT = 'hp-prediction-endpoint'
+ENDPOINT_ARN = f'arn:aws:sagemaker:us-east-1:123456789012:endpoint/{ENDPOINT}'
+OLD_CONFIG = 'hp-prediction-config-v1'
+NEW_CONFIG = 'hp-prediction-config-v2'
+PROJECT_PARAMS = {
+    'EndpointConfig': {'endpointName': ENDPOINT, 'modelName': 'hp-prediction-model',
+                       'endpointConfigName': 'hp-prediction-config'},
+    'Instance': {'instanceType': 'ml.m5.xlarge', 'instanceCount': 1},
+    'AutoScaling': {'enabled': False},
+}
+
+
+def client(service_name):
+    return boto3.client(service_name, region_name='us-east-1',
+                        aws_access_key_id='testing', aws_secret_access_key='testing')
+
+
+def described_endpoint(endpoint_config_name, status='InService'):
+    return {'EndpointName': ENDPOINT, 'EndpointArn': ENDPOINT_ARN, 'EndpointConfigName': endpoint_config_name,
+            'EndpointStatus': status, 'ProductionVariants': [{'VariantName': 'AllTraffic'}],
+            'CreationTime': datetime(2024, 6, 1), 'LastModifiedTime': datetime(2024, 6, 1)}
+
+
+class DeployEngineTest(unittest.TestCase):
+
+    def test_steps_run_after_their_requirements(self):
+        order = []
+        lock = threading.Lock()
+
+        def step(name, result):
+            def run(**kwargs):
+                with lock:
+                    order.append(name)
+                return result
+            return run
+
+        engine = DeployEngine()
+        engine.add('bucket', step('bucket', 'bucket'))
+        engine.add('image', step('image', 'image:v1'))
+        engine.add('models', lambda image: f'model of {image}', requires=('image',))
+        engine.add('endpoint', step('endpoint', 'arn'), requires=('models', 'bucket'))
+        results = engine.run()
+
+        self.assertEqual(results['models'], 'model of image:v1')
+        self.assertEqual(order[-1], 'endpoint')
+        self.assertEqual({timing['status'] for timing in engine.timings.values()}, {'done'})
+
+    def test_failure_skips_dependents(self):
+        ran = []
+
+        def fail():
+            raise ValueError('no image')
+
+        engine = DeployEngine()
+        engine.add('bucket', lambda: ran.append('bucket'))
+        engine.add('image', fail)
+        engine.add('models', lambda image: ran.append('models'), requires=('image',))
+        engine.add('endpoint', lambda models, bucket: ran.append('endpoint'), requires=('models', 'bucket'))
+        with self.assertRaises(StepFailed) as raised:
+            engine.run()
+
+        self.assertEqual(raised.exception.step, 'image')
+        self.assertIsInstance(raised.exception.error, ValueError)
+        self.assertEqual(ran, ['bucket'])
+        self.assertEqual(engine.timings['image']['status'], 'failed')
+        self.assertEqual(engine.timings['models']['status'], 'skipped')
+        self.assertEqual(engine.timings['endpoint']['status'], 'skipped')
+        self.assertEqual(engine.timings['total']['status'], 'failed')
+
+    def test_unknown_requirement(self):
+        engine = DeployEngine()
+        with self.assertRaises(ValueError):
+            engine.add('models', lambda image: None, requires=('image',))
+
+
+class DeployEndpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sm_client = client('sagemaker')
+        self.autoscaling_client = client('application-autoscaling')
+        self.sm_stubber = Stubber(self.sm_client)
+        self.autoscaling_stubber = Stubber(self.autoscaling_client)
+        self.deployer = EndpointDeployer(PROJECT_PARAMS, self.sm_client, None, self.autoscaling_client,
+                                         'us-east-1', version='v2')
+
+    def tearDown(self):
+        self.sm_stubber.assert_no_pending_responses()
+        self.autoscaling_stubber.assert_no_pending_responses()
+
+    def expect_describe(self, endpoint):
+        self.sm_stubber.add_response('describe_endpoint', endpoint, {'EndpointName': ENDPOINT})
+
+    def expect_in_service(self, endpoint_config_name):
+        # The endpoint_in_service waiter, then the describe of _wait_in_service.
+        self.expect_describe(described_endpoint(endpoint_config_name))
+        self.expect_describe(described_endpoint(endpoint_config_name))
+
+    def deploy(self, endpoint_config_name):
+        with self.sm_stubber, self.autoscaling_stubber:
+            return self.deployer.deploy_endpoint(endpoint_config_name)
+
+    def test_create(self):
+        self.sm_stubber.add_client_error('describe_endpoint', service_error_code='ValidationException',
+                                         expected_params={'EndpointName': ENDPOINT})
+        self.sm_stubber.add_response('create_endpoint', {'EndpointArn': ENDPOINT_ARN},
+                                     {'EndpointName': ENDPOINT, 'EndpointConfigName': NEW_CONFIG})
+        self.expect_in_service(NEW_CONFIG)
+        self.assertEqual(self.deploy(NEW_CONFIG), ENDPOINT_ARN)
+
+    def test_reuses_served_config(self):
+        self.expect_describe(described_endpoint(NEW_CONFIG))
+        self.assertEqual(self.deploy(NEW_CONFIG), ENDPOINT_ARN)
+
+    def test_update(self):
+        self.expect_describe(described_endpoint(OLD_CONFIG))
+        self.autoscaling_stubber.add_response('deregister_scalable_target', {}, {
+            'ServiceNamespace': SERVICE_NAMESPACE, 'ResourceId': resource_id(ENDPOINT),
+            'ScalableDimension': SCALABLE_DIMENSION})
+        self.sm_stubber.add_response('update_endpoint', {'EndpointArn': ENDPOINT_ARN}, {
+            'EndpointName': ENDPOINT, 'EndpointConfigName': NEW_CONFIG,
+            'DeploymentConfig': self.deployer.deployment_config()})
+        self.expect_in_service(NEW_CONFIG)
+        self.assertEqual(self.deploy(NEW_CONFIG), ENDPOINT_ARN)
+
+    def test_rolled_back_update_restores_autoscaling(self):
+        self.expect_describe(described_endpoint(OLD_CONFIG))
+        self.autoscaling_stubber.add_client_error('deregister_scalable_target',
+                                                  service_error_code='ObjectNotFoundException')
+        self.sm_stubber.add_response('update_endpoint', {'EndpointArn': ENDPOINT_ARN}, {
+            'EndpointName': ENDPOINT, 'EndpointConfigName': NEW_CONFIG,
+            'DeploymentConfig': self.deployer.deployment_config()})
+        self.expect_in_service(OLD_CONFIG)
+        # restore_autoscaling looks up the variants left serving; AutoScaling is disabled, so it stops there.
+        self.expect_describe(described_endpoint(OLD_CONFIG))
+        with self.assertRaises(RuntimeError):
+            self.deploy(NEW_CONFIG)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+"""Golden-corpus accuracy and performance regression harness.
+
+Runs the serving stages of the inference webserver (preprocess, inference,
+render, encode) on a fixed local image corpus, fully offline, and compares
+them with a recorded baseline:
+
+  * keypoints: per-joint distance (normalised coordinates) and score error,
+    for the joints the baseline is confident about;
+  * overlay: mean absolute pixel difference and fraction of changed pixels
+    against the recorded overlay images;
+  * performance: median latency and peak Python allocations per stage against
+    the budgets in limits.json and against the recorded baseline latencies.
+
+Usage (inside the inference image, or with its requirements installed):
+
+    python src/golden_harness/harness.py extract --video assets/demo_video.mp4
+    python src/golden_harness/harness.py record --model /opt/ml/model/model.tflite
+    python src/golden_harness/harness.py check --model /opt/ml/model/model.tflite
+
+check exits with status 1 when any limit is exceeded. The golden-harness job of
+the deploy workflow runs check with the pushed commit against the baseline
+version GOLDEN_BASELINE_VERSION, recorded by the record-golden-baseline workflow.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import cv2
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HARNESS_DIR, '..', 'inference_webserver'))
+# The serving modules create AWS clients at import time, nothing is called on them here.
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+
+import model_store  # noqa: E402
+
+STAGES = ('preprocess', 'inference', 'render', 'encode')
+
+
+def _measure(fn, *args):
+    """Runs fn and returns its result, the latency in ms and the peak Python allocations in MB."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = fn(*args)
+    latency = (time.perf_counter() - started) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, latency, peak / (1024 * 1024)
+
+
+def run_image(predictor, image_path, repeats):
+    """Runs all stages on one image and returns its keypoints, overlay and per-stage measurements."""
+    timings = {stage: [] for stage in STAGES}
+    memory = {stage: 0.0 for stage in STAGES}
+    for _ in range(repeats):
+        (input_image, image), latency, peak = _measure(predictor.load_input_image_resize_pad, image_path)
+        timings['preprocess'].append(latency)
+        memory['preprocess'] = max(memory['preprocess'], peak)
+        keypoints, latency, peak = _measure(predictor.predict_movenet_for_image, input_image)
+        timings['inference'].append(latency)
+        memory['inference'] = max(memory['inference'], peak)
+        overlay, latency, peak = _measure(predictor.render_prediction, image, keypoints)
+        timings['render'].append(latency)
+        memory['render'] = max(memory['render'], peak)
+        _, latency, peak = _measure(predictor.encode_overlay, overlay)
+        timings['encode'].append(latency)
+        memory['encode'] = max(memory['encode'], peak)
+    return {
+        'keypoints': np.asarray(keypoints).reshape(17, 3),
+        'overlay': np.asarray(overlay, dtype=np.uint8),
+        'latency_ms': {stage: float(np.median(values)) for stage, values in timings.items()},
+        'memory_mb': memory,
+    }
+
+
+def compare_keypoints(baseline, current, limits, keypoint_dict):
+    """Returns the per-joint errors and the violations of the joint and score tolerances."""
+    tolerances = limits['joint_tolerance']
+    errors = {}
+    violations = []
+    for joint, idx in keypoint_dict.items():
+        if baseline[idx, 2] < limits['keypoint_score_threshold']:
+            continue
+        distance = float(np.hypot(*(current[idx, :2] - baseline[idx, :2])))
+        score_error = float(abs(current[idx, 2] - baseline[idx, 2]))
+        errors[joint] = {'distance': distance, 'score_error': score_error}
+        tolerance = tolerances.get(joint, tolerances['default'])
+        if distance > tolerance:
+            violations.append(f"{joint} moved {distance:.4f} > {tolerance}")
+        if score_error > limits['score_tolerance']:
+            violations.append(f"{joint} score changed {score_error:.4f} > {limits['score_tolerance']}")
+    return errors, violations
+
+
+def compare_overlay(baseline, current, limits):
+    """Returns the overlay difference statistics and their violations."""
+    overlay_limits = limits['overlay']
+    if baseline.shape != current.shape:
+        return {'shape': list(current.shape)}, [f"overlay shape {current.shape} != {baseline.shape}"]
+    diff = np.abs(baseline.astype(np.int16) - current.astype(np.int16))
+    stats = {
+        'mean_abs_diff': float(diff.mean()),
+        'changed_pixel_fraction': float(np.mean(diff.max(axis=-1) > overlay_limits['changed_pixel_threshold'])),
+    }
+    violations = []
+    if stats['mean_abs_diff'] > overlay_limits['max_mean_abs_diff']:
+        violations.append(f"overlay mean abs diff {stats['mean_abs_diff']:.2f}")
+    if stats['changed_pixel_fraction'] > overlay_limits['max_changed_pixel_fraction']:
+        violations.append(f"overlay changed pixels {stats['changed_pixel_fraction']:.4f}")
+    return stats, violations
+
+
+def compare_performance(baseline, current, limits):
+    """Returns the violations of the latency and memory budgets and of the baseline latencies."""
+    violations = []
+    for stage in STAGES:
+        latency = current['latency_ms'][stage]
+        if latency > limits['latency_budget_ms'][stage]:
+            violations.append(f"{stage} latency {latency:.1f} ms > budget {limits['latency_budget_ms'][stage]} ms")
+        allowed = baseline['latency_ms'][stage] * limits['latency_regression_factor']
+        if latency > allowed:
+            violations.append(f"{stage} latency {latency:.1f} ms > {allowed:.1f} ms (baseline x factor)")
+        if current['memory_mb'][stage] > limits['memory_budget_mb'][stage]:
+            violations.append(f"{stage} peak allocations {current['memory_mb'][stage]:.1f} MB "
+                              f"> budget {limits['memory_budget_mb'][stage]} MB")
+    return violations
+
+
+def _corpus_images(corpus_dir):
+    return sorted(glob.glob(os.path.join(corpus_dir, '*.jpg')) + glob.glob(os.path.join(corpus_dir, '*.jpeg')))
+
+
+def extract(video_path, corpus_dir, frames):
+    """Writes frames evenly spaced over the video as the JPEG images of the corpus."""
+    capture = cv2.VideoCapture(video_path)
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    if count <= 0:
+        sys.exit(f"Cannot read {video_path}")
+    os.makedirs(corpus_dir, exist_ok=True)
+    for position in np.linspace(0, count - 1, frames).astype(int):
+        capture.set(cv2.CAP_PROP_POS_FRAMES, int(position))
+        ok, frame = capture.read()
+        if not ok:
+            continue
+        cv2.imwrite(os.path.join(corpus_dir, f'frame_{position:06d}.jpg'), frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        print(f"extracted frame {position}")
+    capture.release()
+
+
+def record(predictor, corpus_dir, repeats):
+    images = _corpus_images(corpus_dir)
+    if not images:
+        sys.exit(f"No images in {corpus_dir}")
+    os.makedirs(os.path.join(corpus_dir, 'overlays'), exist_ok=True)
+    baseline = {}
+    for image_path in images:
+        name = os.path.basename(image_path)
+        result = run_image(predictor, image_path, repeats)
+        cv2.imwrite(os.path.join(corpus_dir, 'overlays', f'{name}.png'),
+                    cv2.cvtColor(result['overlay'], cv2.COLOR_RGB2BGR))
+        baseline[name] = {'keypoints': result['keypoints'].tolist(),
+                          'latency_ms': result['latency_ms'], 'memory_mb': result['memory_mb']}
+        print(f"recorded {name}")
+    with open(os.path.join(corpus_dir, 'baseline.json'), 'w') as outfile:
+        json.dump(baseline, outfile, indent=2)
+
+
+def check(predictor, corpus_dir, limits, repeats, report_path=None):
+    with open(os.path.join(corpus_dir, 'baseline.json'), 'r') as infile:
+        baseline = json.load(infile)
+    report = {}
+    failed = False
+    for name, expected in sorted(baseline.items()):
+        result = run_image(predictor, os.path.join(corpus_dir, name), repeats)
+        joint_errors, violations = compare_keypoints(
+            np.asarray(expected['keypoints']), result['keypoints'], limits, predictor.KEYPOINT_DICT)
+        baseline_overlay = cv2.imread(os.path.join(corpus_dir, 'overlays', f'{name}.png'))
+        if baseline_overlay is None:
+            overlay_stats, overlay_violations = {}, [f"overlay of {name} missing from the baseline"]
+        else:
+            overlay_stats, overlay_violations = compare_overlay(
+                cv2.cvtColor(baseline_overlay, cv2.COLOR_BGR2RGB), result['overlay'], limits)
+        violations += overlay_violations
+        violations += compare_performance(expected, result, limits)
+        report[name] = {'joint_errors': joint_errors, 'overlay': overlay_stats,
+                        'latency_ms': result['latency_ms'], 'memory_mb': result['memory_mb'],
+                        'violations': violations}
+        status = 'FAIL' if violations else 'ok'
+        print(f"{status:>4} {name} " + ' '.join(f"{stage}={result['latency_ms'][stage]:.1f}ms" for stage in STAGES))
+        for violation in violations:
+            print(f"       {violation}")
+        failed = failed or bool(violations)
+    if report_path:
+        with open(report_path, 'w') as outfile:
+            json.dump(report, outfile, indent=2)
+    return not failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', choices=['extract', 'record', 'check'])
+    parser.add_argument('--model', default=model_store.model_file, help='path of the model.tflite file')
+    parser.add_argument('--corpus', default=os.path.join(HARNESS_DIR, 'corpus'))
+    parser.add_argument('--limits', default=os.path.join(HARNESS_DIR, 'limits.json'))
+    parser.add_argument('--repeats', type=int, default=5, help='runs per image, latencies are medians')
+    parser.add_argument('--report', help='write the detailed report as JSON to this file')
+    parser.add_argument('--video', default=os.path.join(HARNESS_DIR, '..', '..', 'assets', 'demo_video.mp4'),
+                        help='video the extract command takes the corpus images from')
+    parser.add_argument('--frames', type=int, default=8, help='number of images extract writes')
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        extract(args.video, args.corpus, args.frames)
+        sys.exit(0)
+
+    # Before the import: predictor binds model_file at import time, preload_model reads it at call time.
+    model_store.model_file = args.model
+    import predictor  # noqa: E402
+
+    if args.command == 'record':
+        record(predictor, args.corpus, args.repeats)
+    else:
+        with open(args.limits, 'r') as infile:
+            limits = json.load(infile)
+        sys.exit(0 if check(predictor, args.corpus, limits, args.repeats, args.report) else 1)
@@ -0,0 +1,152 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+# Relative time budget of a request in milliseconds, set by the caller.
+DEADLINE_HEADER = 'X-Request-Timeout-Ms'
+# SageMaker forwards the CustomAttributes of invoke_endpoint in this header,
+# callers can pass the budget there as "timeout_ms=<milliseconds>".
+CUSTOM_ATTRIBUTES_HEADER = 'X-Amzn-SageMaker-Custom-Attributes'
+# Arrival time of the request at nginx in epoch seconds ($msec), so that the
+# time queued in nginx and in the gunicorn backlog counts against the budget.
+REQUEST_START_HEADER = 'X-Request-Start'
+
+
+class Overloaded(Exception):
+    """Raised when the in-flight queue of the worker is full."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the deadline of a request passed before the given stage."""
+
+    def __init__(self, stage):
+        super().__init__(f"Deadline exceeded before {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Absolute deadline of a request, checked before every stage of the work."""
+
+    def __init__(self, timeout, elapsed=0.0):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() - elapsed + timeout
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, stage):
+        """Raises DeadlineExceeded if there is no time left to start the stage."""
+        if self.expired():
+            metrics.increment('invocations_deadline_exceeded_total', stage=stage)
+            raise DeadlineExceeded(stage)
+
+
+def _timeout_seconds(value):
+    """Parses a budget in milliseconds, None if it is not a positive finite number."""
+    try:
+        timeout = float(value) / 1000.0
+    except ValueError:
+        return None
+    return timeout if 0 < timeout < float('inf') else None
+
+
+def request_deadline(headers, default_timeout=None):
+    """Derives the deadline of a request.
+
+    The budget is taken from the X-Request-Timeout-Ms header, then from a
+    timeout_ms entry of the SageMaker custom attributes, then from
+    MODEL_SERVER_TIMEOUT; a malformed or non-positive budget is ignored. It
+    starts when nginx received the request (X-Request-Start), or now when the
+    header is missing.
+
+    Args:
+        headers: The headers of the request.
+        default_timeout: A number of seconds used when the request carries no budget.
+
+    Returns:
+        A Deadline object.
+    """
+    if default_timeout is None:
+        default_timeout = float(os.environ.get('MODEL_SERVER_TIMEOUT', 60))
+    timeout = None
+    if headers.get(DEADLINE_HEADER):
+        timeout = _timeout_seconds(headers[DEADLINE_HEADER])
+    if timeout is None and headers.get(CUSTOM_ATTRIBUTES_HEADER):
+        for attribute in headers[CUSTOM_ATTRIBUTES_HEADER].split(','):
+            name, _, value = attribute.strip().partition('=')
+            if name == 'timeout_ms' and value:
+                timeout = _timeout_seconds(value)
+    if timeout is None:
+        timeout = default_timeout
+    elapsed = 0.0
+    if headers.get(REQUEST_START_HEADER):
+        try:
+            elapsed = max(time.time() - float(headers[REQUEST_START_HEADER]), 0.0)
+        except ValueError:
+            pass
+        metrics.observe('invocations_backlog_seconds', elapsed)
+    # Never wait longer than the worker itself is allowed to run.
+    return Deadline(min(timeout, default_timeout), elapsed=elapsed)
+
+
+class AdmissionController:
+    """Bounded in-flight queue of a worker.
+
+    At most max_inflight requests run at the same time, up to max_queue more
+    wait for a slot. Requests beyond that are rejected immediately with
+    Overloaded, waiting requests give up with DeadlineExceeded once their
+    deadline passes.
+    """
+
+    def __init__(self, max_inflight=1, max_queue=4):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def reserve(self):
+        """Takes a queue place, or raises Overloaded when the queue is full. Freed by release."""
+        with self._lock:
+            if self._pending >= self.max_inflight + self.max_queue:
+                metrics.increment('invocations_shed_total', reason='queue_full')
+                raise Overloaded()
+            self._pending += 1
+            metrics.set_gauge('invocations_pending', self._pending)
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            metrics.set_gauge('invocations_pending', self._pending)
+
+    @contextmanager
+    def admit(self, deadline, reserved=False):
+        """Runs the block in a slot, waiting in the queue until the deadline.
+
+        Args:
+            deadline: The Deadline of the work.
+            reserved: A boolean, the caller already holds a queue place taken with reserve
+                (e.g. an asynchronous job) and releases it itself.
+        """
+        if not reserved:
+            self.reserve()
+        try:
+            queued_at = time.monotonic()
+            acquired = self._slots.acquire(timeout=max(deadline.remaining(), 0))
+            metrics.observe('invocations_queue_wait_seconds', time.monotonic() - queued_at)
+            if not acquired:
+                metrics.increment('invocations_shed_total', reason='deadline')
+                raise DeadlineExceeded('queue')
+            try:
+                yield
+            finally:
+                self._slots.release()
+        finally:
+            if not reserved:
+                self.release()
@@ -0,0 +1,354 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.client import Config
+
+try:
+    from aiobotocore.session import get_session
+except ImportError:  # aiobotocore is optional, boto3 then runs on a pool of I/O threads
+    get_session = None
+
+import predictor
+import metrics
+import keypoint_codec
+import recycling
+from admission import Overloaded, DeadlineExceeded, request_deadline
+from jobs import JobQueueFull
+from singleflight import AsyncSingleFlight
+
+# This is the ASGI counterpart of wsgi.py, selected with MODEL_SERVER_MODE=asgi in serve.
+#
+# The event loop of the worker does the request parsing and the S3 round trips
+# (HEAD, download, upload), so a worker keeps many requests in flight while
+# they wait on S3. Decoding, inference, rendering and encoding run on a pool of
+# MODEL_SERVER_EXECUTOR_THREADS threads, each with its own interpreter; at most
+# MODEL_SERVER_MAX_QUEUE more requests wait for a thread, further requests are
+# answered with 503 and Retry-After.
+
+executor_threads = int(os.environ.get('MODEL_SERVER_EXECUTOR_THREADS', 1))
+max_queue = int(os.environ.get('MODEL_SERVER_MAX_QUEUE', 4))
+executor = ThreadPoolExecutor(max_workers=executor_threads, thread_name_prefix='inference')
+# /ping never waits behind a render on the executor; it only loads the model itself if the startup did not.
+ping_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ping')
+model_ready = False
+in_flight = AsyncSingleFlight()
+
+# Presigning is computed locally, it needs no round trip.
+presign_client = boto3.client('s3', region_name=predictor.region, config=Config(signature_version='s3v4'))
+
+
+class AsyncS3:
+    """The S3 calls of a request, awaited on the event loop.
+
+    With aiobotocore the requests are made by the loop itself; without it the
+    boto3 client of predictor runs on io_threads threads, which still keeps the
+    CPU executor free while a request waits on S3.
+    """
+
+    def __init__(self, region, io_threads=32):
+        self.region = region
+        self.io_threads = io_threads
+        self._client = None
+        self._exit_stack = None
+        self._io_executor = None
+        self._client_lock = None
+
+    async def _get_client(self):
+        if self._client is not None:
+            return self._client
+        if self._client_lock is None:
+            self._client_lock = asyncio.Lock()
+        # Concurrent first requests wait for the one client instead of each creating one.
+        async with self._client_lock:
+            if self._client is not None:
+                return self._client
+            if get_session is not None:
+                self._exit_stack = contextlib.AsyncExitStack()
+                self._client = await self._exit_stack.enter_async_context(
+                    get_session().create_client('s3', region_name=self.region))
+            else:
+                self._io_executor = ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix='s3')
+                self._client = predictor.client_s3
+            return self._client
+
+    async def _call(self, method, **kwargs):
+        client = await self._get_client()
+        if self._io_executor is None:
+            return await getattr(client, method)(**kwargs)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._io_executor, lambda: getattr(client, method)(**kwargs))
+
+    async def head_object(self, **kwargs):
+        return await self._call('head_object', **kwargs)
+
+    async def get_object_bytes(self, **kwargs):
+        """Returns the body of the object, read without blocking the loop."""
+        response = await self._call('get_object', **kwargs)
+        if self._io_executor is None:
+            async with response['Body'] as stream:
+                return await stream.read()
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor, response['Body'].read)
+
+    async def put_object(self, **kwargs):
+        return await self._call('put_object', **kwargs)
+
+    async def close(self):
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
+        if self._io_executor is not None:
+            self._io_executor.shutdown(wait=False)
+        self._client = self._exit_stack = self._io_executor = None
+
+
+s3 = AsyncS3(predictor.region)
+
+
+class _Headers(dict):
+    """The request headers, looked up case-insensitively like the Flask ones."""
+
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+
+    def __getitem__(self, name):
+        return super().__getitem__(name.lower())
+
+
+class _ExecutorQueue:
+    """Counts the requests running on or waiting for the executor, see AdmissionController."""
+
+    def __init__(self, max_inflight, max_queue):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.pending = 0
+
+    def check(self):
+        """Raises Overloaded when the queue is full."""
+        if self.pending >= self.max_inflight + self.max_queue:
+            metrics.increment('invocations_shed_total', reason='queue_full')
+            raise Overloaded()
+
+    async def run(self, deadline, fn, *args):
+        """Runs fn(*args) on the executor, raising Overloaded when the queue is full."""
+        self.check()
+        self.pending += 1
+        metrics.set_gauge('invocations_pending', self.pending)
+        queued_at = time.monotonic()
+
+        def run_admitted():
+            metrics.observe('invocations_queue_wait_seconds', time.monotonic() - queued_at)
+            if deadline.expired():
+                metrics.increment('invocations_shed_total', reason='deadline')
+                raise DeadlineExceeded('queue')
+            return fn(*args)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, run_admitted)
+        finally:
+            self.pending -= 1
+            metrics.set_gauge('invocations_pending', self.pending)
+
+
+executor_queue = _ExecutorQueue(executor_threads, max_queue)
+
+
+def _compute(data, deadline, session_id, analytics, timings):
+    """The CPU-bound stages of a request, run on an executor thread."""
+    with predictor.timed_stage(timings, 'preprocess'):
+        input_image, image = predictor.decode_input_image(data)
+    body, keypoints_with_scores = predictor.predict_and_render(
+        input_image, image, deadline=deadline, session_id=session_id, timings=timings)
+    return body, predictor.prediction_result(keypoints_with_scores, image, analytics=analytics, timings=timings)
+
+
+async def predict_image_ref(input_path, deadline, session_id=None, analytics=False, etag=None):
+    """Runs the prediction for an image stored in S3, see predictor.predict_image_ref.
+
+    Returns:
+        The same dictionary as predictor.predict_image_ref.
+    """
+    bucket, key, file_name = predictor.split_image_ref(input_path)
+
+    timings = {}
+    # Shed before the download when the executor is already saturated.
+    executor_queue.check()
+    deadline.check('download')
+    with predictor.timed_stage(timings, 'download'):
+        if etag is not None:
+            data = await s3.get_object_bytes(Bucket=bucket, Key=key, IfMatch=etag)
+        else:
+            data = await s3.get_object_bytes(Bucket=bucket, Key=key)
+
+    deadline.check('inference')
+    body, result = await executor_queue.run(deadline, _compute, data, deadline, session_id, analytics, timings)
+
+    deadline.check('upload')
+    output_file, output_format = predictor.prediction_output(file_name)
+    with predictor.timed_stage(timings, 'upload'):
+        await s3.put_object(Bucket=bucket, Key=output_file, Body=body, ContentType=output_format['content_type'])
+        result["predicted_image"] = presign_client.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket, 'Key': output_file}, ExpiresIn=3600)
+    return result
+
+
+async def coalesced_predict_image_ref(input_path, deadline, session_id=None, analytics=False):
+    """Awaits predict_image_ref once for the concurrent identical requests of this worker.
+
+    See predictor.coalesced_predict_image_ref, the requests are coalesced on the event loop.
+    """
+    if not predictor.coalesce_requests:
+        return await predict_image_ref(input_path, deadline, session_id=session_id, analytics=analytics)
+    bucket, key, _ = predictor.split_image_ref(input_path)
+    deadline.check('head')
+    with predictor.timed_stage(None, 'head'):
+        etag = (await s3.head_object(Bucket=bucket, Key=key))['ETag']
+    return await in_flight.do(
+        (input_path, etag, session_id, analytics),
+        lambda: predict_image_ref(input_path, deadline, session_id=session_id, analytics=analytics, etag=etag),
+        deadline=deadline)
+
+
+async def ping(headers):
+    """Answers on the event loop once the model is loaded, the container is healthy then."""
+    global model_ready
+    if not model_ready:
+        await asyncio.get_running_loop().run_in_executor(ping_executor, predictor.load_model)
+        model_ready = True
+    if predictor.model_watcher is not None:
+        predictor.model_watcher.ensure_started()
+    generation, _, version = predictor.active_model()
+    status = 200
+    if predictor.inference_ring is not None and not predictor.inference_ring.alive():
+        status = 500
+    return status, "application/json", json.dumps({"model_version": version, "model_generation": generation}), \
+        {'X-Model-Version': version}
+
+
+async def worker_metrics(headers):
+    for reason, count in recycling.recycle_counts().items():
+        metrics.set_gauge('worker_recycles_total', count, reason=reason)
+    return 200, "text/plain", metrics.render(), {}
+
+
+async def inference(headers, data):
+    """Serves /invocations like predictor.inference, with the S3 round trips on the event loop."""
+    content_type = headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type == "application/x-npy":
+        return 400, "application/json", json.dumps(predictor.INVALID_JSON_OUTCOME), {}
+    if content_type != "application/json":
+        return 415, "application/json", "This predictor only images of size 256", {}
+
+    json_data = json.loads(data)
+    if "job_id" in json_data:
+        job = predictor.job_manager.status(json_data["job_id"])
+        if job is None:
+            return 404, "application/json", json.dumps({"job_id": json_data["job_id"], "status": "unknown"}), {}
+        return 200, "application/json", json.dumps(job), {}
+
+    input_path = json_data["image_ref"]
+    session_id = json_data.get("session_id") or headers.get("X-Session-Id")
+    analytics = bool(json_data.get("analytics"))
+
+    if json_data.get("async"):
+        # The jobs keep running on the threads of the job manager, in slots of predictor.admission.
+        try:
+            job_id = predictor.job_manager.submit(predictor.predict_job, input_path,
+                                                  session_id=session_id, analytics=analytics)
+        except (JobQueueFull, Overloaded):
+            return 503, "application/json", json.dumps("Server overloaded, retry later"), \
+                {'Retry-After': predictor.retry_after}
+        return 200, "application/json", json.dumps({"job_id": job_id, "status": "pending"}), {}
+
+    deadline = request_deadline(headers)
+    started = time.monotonic()
+    try:
+        result = await coalesced_predict_image_ref(input_path, deadline, session_id=session_id, analytics=analytics)
+    except Overloaded:
+        return 503, "application/json", json.dumps("Server overloaded, retry later"), \
+            {'Retry-After': predictor.retry_after}
+    except DeadlineExceeded as e:
+        logging.info(f"Dropped request, {e}")
+        return 504, "application/json", json.dumps(str(e)), {}
+    metrics.observe('invocations_latency_seconds', time.monotonic() - started)
+
+    binary_content_type = keypoint_codec.negotiate(headers.get("Accept"))
+    if binary_content_type is not None:
+        body = keypoint_codec.encode_response(
+            binary_content_type, result["keypoints"], result["image_height"], result["image_width"],
+            result["model_version"])
+        return 200, binary_content_type, body, {'X-Predicted-Image': result["predicted_image"],
+                                                'X-Model-Version': result["model_version"]}
+
+    model_version_header = {'X-Model-Version': result["model_version"]}
+    if analytics:
+        return 200, "application/json", json.dumps({"predicted_image": result["predicted_image"],
+                                                    "analytics": result["analytics"],
+                                                    "model_version": result["model_version"]}), model_version_header
+    return 200, "application/json", json.dumps(result["predicted_image"]), model_version_header
+
+
+ROUTES = {
+    ("GET", "/ping"): ping,
+    ("GET", "/metrics"): worker_metrics,
+    ("POST", "/invocations"): inference,
+}
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _load_model():
+    """Creates the interpreter of the executor thread before the worker serves requests."""
+    global model_ready
+    try:
+        await asyncio.get_running_loop().run_in_executor(executor, predictor.load_model)
+        model_ready = True
+    except Exception:
+        logging.exception("Model could not be loaded at startup, /ping retries")
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await _load_model()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await s3.close()
+            executor.shutdown(wait=False)
+            ping_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application, served by uvicorn workers of gunicorn behind nginx."""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    handler = ROUTES.get((scope['method'], scope['path']))
+    headers = _Headers((name.decode('latin-1').lower(), value.decode('latin-1')) for name, value in scope['headers'])
+    if handler is None:
+        status, content_type, body, extra_headers = 404, "application/json", json.dumps("Not found"), {}
+    elif scope['method'] == "POST":
+        status, content_type, body, extra_headers = await handler(headers, await _read_body(receive))
+    else:
+        status, content_type, body, extra_headers = await handler(headers)
+    if isinstance(body, str):
+        body = body.encode()
+    response_headers = [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]
+    response_headers += [(name.lower().encode(), str(value).encode()) for name, value in extra_headers.items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': response_headers})
+    await send({'type': 'http.response.body', 'body': body})
+    # uvicorn workers do not run the post_request hook of gunicorn_config.
+    recycling.after_request()
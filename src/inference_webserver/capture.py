@@ -0,0 +1,177 @@
+import io
+import os
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+import numpy as np
+import boto3
+
+import metrics
+
+# Stages timed per request, missing stages are stored as NaN.
+STAGES = ('download', 'preprocess', 'inference', 'render', 'encode', 'upload')
+
+# Marks the end of the capture queue.
+_STOP = object()
+
+
+class CaptureWriter:
+    """Samples the prediction outputs and writes them as batched columnar files.
+
+    Every batch is one compressed .npz file with one array per column:
+    timestamp (float64, epoch seconds), keypoints (float16, [N, 17, 3]),
+    image_height and image_width (int32), model_version (str) and one float32
+    column per stage in STAGES with its duration in seconds. The files are
+    written to a local directory or an s3:// prefix, under yyyy/mm/dd/hh/ like the
+    SageMaker data capture, and can be loaded with numpy.load.
+
+    record() only samples and enqueues, it never blocks a request: when the
+    queue is full the record is dropped and counted. A background thread of
+    each worker process builds the batches and writes a file once batch_records
+    records are buffered or flush_seconds after the first buffered record.
+    """
+
+    def __init__(self, destination, sample_rate=1.0, batch_records=1000, flush_seconds=60.0, max_queue=10000,
+                 client=None):
+        self.destination = destination
+        self.sample_rate = sample_rate
+        self.batch_records = batch_records
+        self.flush_seconds = flush_seconds
+        self.max_queue = max_queue
+        self._client = client
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._sequence = 0
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        # The writer thread does not survive the fork of a preloaded app, start it in every worker.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._thread = threading.Thread(target=self._run, name='capture-writer', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def record(self, keypoints_with_scores, image_height, image_width, model_version, timings=None):
+        """Captures one prediction, subject to sampling; never blocks.
+
+        Args:
+            keypoints_with_scores: The [1, 1, 17, 3] keypoints with scores.
+            image_height: An integer, the height of the input image.
+            image_width: An integer, the width of the input image.
+            model_version: A string identifying the model.
+            timings: An optional dictionary with the duration in seconds of the stages in STAGES.
+
+        Returns:
+            True if the record was queued.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        self._ensure_started()
+        item = (time.time(), np.asarray(keypoints_with_scores, dtype=np.float16).reshape(17, 3),
+                image_height, image_width, model_version, dict(timings or {}))
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            metrics.increment('capture_dropped_total')
+            return False
+        metrics.increment('capture_records_total')
+        return True
+
+    def _run(self):
+        batch = []
+        first_record = None
+        while True:
+            timeout = None if first_record is None else max(0.0, first_record + self.flush_seconds - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is not None and item is not _STOP:
+                if not batch:
+                    first_record = time.monotonic()
+                batch.append(item)
+            due = batch and (len(batch) >= self.batch_records or item is None or item is _STOP
+                             or time.monotonic() - first_record >= self.flush_seconds)
+            if due:
+                self._flush(batch)
+                batch = []
+                first_record = None
+            if item is _STOP:
+                return
+
+    def _flush(self, batch):
+        started = time.monotonic()
+        columns = {
+            'timestamp': np.array([item[0] for item in batch], dtype=np.float64),
+            'keypoints': np.stack([item[1] for item in batch]),
+            'image_height': np.array([item[2] for item in batch], dtype=np.int32),
+            'image_width': np.array([item[3] for item in batch], dtype=np.int32),
+            'model_version': np.array([item[4] for item in batch], dtype=str),
+        }
+        for stage in STAGES:
+            columns[f'{stage}_seconds'] = np.array([item[5].get(stage, np.nan) for item in batch], dtype=np.float32)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **columns)
+        try:
+            self._write(self._file_name(columns['timestamp'][0]), buffer.getvalue())
+        except Exception:
+            logging.exception("Capture batch could not be written")
+            metrics.increment('capture_write_errors_total')
+            return
+        metrics.increment('capture_files_total')
+        metrics.observe('capture_flush_seconds', time.monotonic() - started)
+
+    def _file_name(self, timestamp):
+        self._sequence += 1
+        moment = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+        return f"{moment:%Y/%m/%d/%H}/capture-{moment:%Y%m%dT%H%M%S}-{os.getpid()}-{self._sequence:06d}.npz"
+
+    def _write(self, file_name, data):
+        if self.destination.startswith('s3://'):
+            parsed = urlparse(self.destination)
+            prefix = parsed.path.strip('/')
+            key = f"{prefix}/{file_name}" if prefix else file_name
+            if self._client is None:
+                self._client = boto3.client('s3')
+            self._client.put_object(Bucket=parsed.netloc, Key=key, Body=data)
+        else:
+            path = os.path.join(self.destination, file_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as outfile:
+                outfile.write(data)
+
+    def close(self, timeout=10.0):
+        """Writes the buffered records of this process."""
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+def create_capture_writer():
+    """Returns the CaptureWriter configured by CAPTURE_DESTINATION, or None when capture is disabled."""
+    destination = os.environ.get('CAPTURE_DESTINATION')
+    if not destination:
+        return None
+    return CaptureWriter(
+        destination,
+        sample_rate=float(os.environ.get('CAPTURE_SAMPLE_RATE', 1.0)),
+        batch_records=int(os.environ.get('CAPTURE_BATCH_RECORDS', 1000)),
+        flush_seconds=float(os.environ.get('CAPTURE_FLUSH_SECONDS', 60)),
+        max_queue=int(os.environ.get('CAPTURE_MAX_QUEUE', 10000)))
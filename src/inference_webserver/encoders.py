@@ -0,0 +1,163 @@
+import io
+import logging
+import subprocess
+import threading
+import numpy as np
+import boto3
+
+# ffmpeg output arguments per format, all of them can be written to a pipe.
+FORMATS = {
+    'gif': {'args': ['-f', 'gif'], 'content_type': 'image/gif'},
+    'mp4': {'args': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-preset', 'veryfast',
+                     '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4'],
+            'content_type': 'video/mp4'},
+    'webp': {'args': ['-c:v', 'libwebp', '-loop', '0', '-f', 'webp'], 'content_type': 'image/webp'},
+}
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class BytesSink:
+    """Collects the encoded stream in memory."""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+
+    def write(self, data):
+        self._buffer.write(data)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+
+class S3MultipartSink:
+    """Uploads the encoded stream to S3 as a multipart upload.
+
+    At most one part (part_size bytes, S3 requires at least 5 MB) is held in
+    memory, whatever the length of the stream.
+    """
+
+    def __init__(self, bucket, key, content_type='application/octet-stream', part_size=8 * 1024 * 1024,
+                 client=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.client = client or boto3.client('s3')
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = self.client.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+
+    def _upload_part(self):
+        part_number = len(self._parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                           PartNumber=part_number, Body=bytes(self._buffer))
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def close(self):
+        # The last part may be smaller than the minimum part size.
+        if self._buffer or not self._parts:
+            self._upload_part()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                              MultipartUpload={'Parts': self._parts})
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+
+class StreamingEncoder:
+    """Encodes RGB frames to GIF, MP4 or WebP as they are rendered.
+
+    Frames are piped into an ffmpeg process and its output is copied into the
+    sink by a reader thread, so neither the frames nor the encoded clip are
+    kept in memory by the encoder. The frame size is taken from the first
+    frame unless width and height are given.
+
+    Usage:
+        with StreamingEncoder(sink, fps=30, format='mp4') as encoder:
+            for frame in frames:
+                encoder.write_frame(frame)
+    """
+
+    def __init__(self, sink, fps, format='gif', width=None, height=None):
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported format {format}, expected one of {sorted(FORMATS)}")
+        self.sink = sink
+        self.fps = fps
+        self.format = format
+        self.content_type = FORMATS[format]['content_type']
+        self.width = width
+        self.height = height
+        self.frame_count = 0
+        self._process = None
+        self._reader = None
+        self._reader_error = None
+
+    def _start(self):
+        command = ['ffmpeg', '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{self.width}x{self.height}',
+                   '-r', str(self.fps), '-i', 'pipe:0'] + FORMATS[self.format]['args'] + ['pipe:1']
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._copy_output, daemon=True)
+        self._reader.start()
+
+    def _copy_output(self):
+        try:
+            for chunk in iter(lambda: self._process.stdout.read(READ_CHUNK_SIZE), b''):
+                self.sink.write(chunk)
+        except Exception as e:
+            self._reader_error = e
+
+    def write_frame(self, frame):
+        """Encodes the next [height, width, 3] uint8 RGB frame."""
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if self._process is None:
+            if self.width is None or self.height is None:
+                self.height, self.width = frame.shape[:2]
+            self._start()
+        if frame.shape != (self.height, self.width, 3):
+            raise ValueError(f"Frame of shape {frame.shape}, expected {(self.height, self.width, 3)}")
+        self._process.stdin.write(frame.data)
+        self.frame_count += 1
+
+    def close(self):
+        """Finishes the stream and closes the sink."""
+        if self._process is None:
+            self.sink.close()
+            return
+        self._process.stdin.close()
+        self._reader.join()
+        stderr = self._process.stderr.read().decode('utf-8', errors='replace')
+        if self._process.wait() != 0 or self._reader_error is not None:
+            self.sink.abort()
+            raise RuntimeError(f"Encoding failed: {self._reader_error or stderr}")
+        self.sink.close()
+        logging.info(f"Encoded {self.frame_count} frames to {self.format}")
+
+    def abort(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+        self.sink.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,73 @@
+# Server hooks of gunicorn, loaded by serve with -c.
+#
+# Every worker warms up (creates its interpreter and runs one inference) before
+# it accepts requests, and is recycled by recycling.WorkerRecycler once its RSS
+# or request count passes MODEL_SERVER_MAX_RSS_MB or MODEL_SERVER_MAX_REQUESTS.
+# The replacement is started first and stops the old worker once it is warm.
+# With MODEL_SERVER_CPU_PINNING every worker is pinned to its own set of
+# MODEL_INTERPRETER_THREADS CPUs; a replacement takes the set of the worker it replaces.
+
+import os
+import sys
+import logging
+
+import recycling
+from tune import cpu_sets
+
+model_server_warmup = os.environ.get('MODEL_SERVER_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+cpu_pinning = os.environ.get('MODEL_SERVER_CPU_PINNING', 'false').lower() in ('1', 'true', 'yes')
+interpreter_threads = int(os.environ.get('MODEL_INTERPRETER_THREADS') or 1)
+
+
+def on_starting(server):
+    recycling.reset()
+
+
+def pre_fork(server, worker):
+    if not cpu_pinning:
+        return
+    # Runs in the master: the least used CPU set, i.e. a free one, or the one of the worker being recycled.
+    # The recycled worker is still in WORKERS while its replacement forks, it does not count as using its set.
+    sets = cpu_sets(server.cfg.workers, interpreter_threads)
+    used = [0] * len(sets)
+    recycled = recycling.recycled_pids()
+    for pid, other in server.WORKERS.items():
+        if pid not in recycled and getattr(other, 'cpu_slot', None) is not None:
+            used[other.cpu_slot] += 1
+    worker.cpu_slot = used.index(min(used))
+    worker.cpus = sets[worker.cpu_slot]
+
+
+def post_fork(server, worker):
+    if getattr(worker, 'cpus', None):
+        os.sched_setaffinity(0, worker.cpus)
+        server.log.info(f"Worker {os.getpid()} pinned to CPUs {sorted(worker.cpus)}")
+
+
+def post_worker_init(worker):
+    if model_server_warmup:
+        import predictor
+        try:
+            predictor.warm_up()
+        except Exception:
+            logging.exception("Warm-up of worker %s failed", os.getpid())
+    worker.recycler = recycling.create_worker_recycler()
+    worker.recycler.start()
+    recycling.set_worker(worker)
+    stopped = recycling.replace_recycled_workers()
+    if stopped:
+        worker.log.info(f"Worker {os.getpid()} is warm, stopping recycled workers {stopped}")
+
+
+def post_request(worker, req, environ, resp):
+    recycler = getattr(worker, 'recycler', None)
+    if recycler is not None:
+        recycler.after_request(worker)
+
+
+def child_exit(server, worker):
+    recycling.worker_exited(server, worker)
+    # The ring lives in the preloaded app of the master; free the slots the worker held when it died.
+    predictor = sys.modules.get('predictor')
+    if predictor is not None and predictor.inference_ring is not None:
+        predictor.inference_ring.reclaim(worker.pid)
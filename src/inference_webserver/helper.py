@@ -1,88 +1,31 @@
 import tensorflow as tf
 import numpy as np
-import imageio
 
-# Import matplotlib libraries
-from matplotlib import pyplot as plt
+# Import matplotlib libraries. Figures are drawn with the object-oriented API
+# only, pyplot keeps global state and is not safe to use from several threads.
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.collections import LineCollection
 import matplotlib.patches as patches
 
 import cv2
 
-from tensorflow_docs.vis import embed
+from encoders import BytesSink, StreamingEncoder
+from skeleton import KEYPOINT_DICT, KEYPOINT_EDGE_INDS_TO_COLOR
+from preprocess_plan import square_crop_region, get_plan
 # Confidence score to determine whether a keypoint prediction is reliable.
 MIN_CROP_KEYPOINT_SCORE = 0.2
 
-# Dictionary that maps from joint names to keypoint indices.
-KEYPOINT_DICT = {
-    'nose': 0,
-    'left_eye': 1,
-    'right_eye': 2,
-    'left_ear': 3,
-    'right_ear': 4,
-    'left_shoulder': 5,
-    'right_shoulder': 6,
-    'left_elbow': 7,
-    'right_elbow': 8,
-    'left_wrist': 9,
-    'right_wrist': 10,
-    'left_hip': 11,
-    'right_hip': 12,
-    'left_knee': 13,
-    'right_knee': 14,
-    'left_ankle': 15,
-    'right_ankle': 16
-}
-
-# Maps bones to a matplotlib color name.
-KEYPOINT_EDGE_INDS_TO_COLOR = {
-    (0, 1): 'm',
-    (0, 2): 'c',
-    (1, 3): 'm',
-    (2, 4): 'c',
-    (0, 5): 'm',
-    (0, 6): 'c',
-    (5, 7): 'm',
-    (7, 9): 'm',
-    (6, 8): 'c',
-    (8, 10): 'c',
-    (5, 6): 'y',
-    (5, 11): 'm',
-    (6, 12): 'c',
-    (11, 12): 'y',
-    (11, 13): 'm',
-    (13, 15): 'm',
-    (12, 14): 'c',
-    (14, 16): 'c'
-}
-
 
 def init_crop_region(image_height, image_width):
     """Defines the default crop region.
 
     The function provides the initial crop region (pads the full image from both
     sides to make it a square image) when the algorithm cannot reliably determine
-    the crop region from the previous frame.
+    the crop region from the previous frame. The returned dictionary is new,
+    preprocess_plan.get_plan(...).crop_region is the cached, shared one.
     """
-    if image_width > image_height:
-        box_height = image_width / image_height
-        box_width = 1.0
-        y_min = (image_height / 2 - image_width / 2) / image_height
-        x_min = 0.0
-    else:
-        box_height = 1.0
-        box_width = image_height / image_width
-        y_min = 0.0
-        x_min = (image_width / 2 - image_height / 2) / image_width
-
-    return {
-        'y_min': y_min,
-        'x_min': x_min,
-        'y_max': y_min + box_height,
-        'x_max': x_min + box_width,
-        'height': box_height,
-        'width': box_width
-    }
+    return square_crop_region(image_height, image_width)
 
 
 def torso_visible(keypoints):
@@ -138,7 +81,7 @@ def determine_torso_and_body_range(
 
 def determine_crop_region(
         keypoints, image_height,
-        image_width):
+        image_width, default_region=None):
     """Determines the region to crop the image for the model to run inference on.
 
     The algorithm uses the detected joints from the previous frame to estimate
@@ -146,7 +89,8 @@ def determine_crop_region(
     centers at the midpoint of two hip joints. The crop size is determined by
     the distances between each joints and the center point.
     When the model is not confident with the four torso joint predictions, the
-    function returns a default crop which is the full image padded to square.
+    function returns a default crop which is the full image padded to square
+    (default_region when given, e.g. the crop_region of the preprocessing plan).
     """
     target_keypoints = {}
     for joint in KEYPOINT_DICT.keys():
@@ -178,7 +122,7 @@ def determine_crop_region(
                        center_x - crop_length_half]
 
         if crop_length_half > max(image_width, image_height) / 2:
-            return init_crop_region(image_height, image_width)
+            return default_region or init_crop_region(image_height, image_width)
         else:
             crop_length = crop_length_half * 2
             return {
@@ -192,7 +136,7 @@ def determine_crop_region(
                 crop_corner[1] / image_width
             }
     else:
-        return init_crop_region(image_height, image_width)
+        return default_region or init_crop_region(image_height, image_width)
 
 
 def crop_and_resize(image, crop_region, crop_size):
@@ -228,6 +172,39 @@ def run_inference(movenet, image, crop_region, crop_size):
     return keypoints_with_scores
 
 
+def keypoints_to_crop_coordinates(keypoints_with_scores, crop_region):
+    """Maps keypoints from image coordinates into the coordinates of a crop region.
+
+    This is the inverse of the remapping done in run_inference. With the region
+    of init_crop_region it gives the coordinates in the image padded to square,
+    which is what resize_with_pad based predictions and displays use.
+    """
+    keypoints = np.array(keypoints_with_scores, copy=True)
+    keypoints[..., 0] = (keypoints[..., 0] - crop_region['y_min']) / crop_region['height']
+    keypoints[..., 1] = (keypoints[..., 1] - crop_region['x_min']) / crop_region['width']
+    return keypoints
+
+
+def letterbox(image, size, reuse_buffer=False):
+    """Resizes a uint8 image to fit a size x size square and pads it with black.
+
+    Same geometry as tf.image.resize_with_pad (aspect ratio kept, image centered),
+    but the image stays uint8 end-to-end. The geometry comes from the cached
+    preprocessing plan of the resolution.
+
+    Args:
+      image: A numpy array with shape [height, width, 3] and dtype uint8.
+      size: An integer, the side of the output square in pixels.
+      reuse_buffer: A boolean, returns the output buffer of the calling thread,
+        valid until its next letterbox call with reuse_buffer.
+
+    Returns:
+      A uint8 numpy array with shape [size, size, 3].
+    """
+    height, width, _ = image.shape
+    return get_plan(height, width, size).letterbox(image, reuse_buffer=reuse_buffer)
+
+
 def _keypoints_and_edges_for_display(keypoints_with_scores,
                                      height,
                                      width,
@@ -307,13 +284,17 @@ def draw_prediction_on_image(
     """
     height, width, channel = image.shape
     aspect_ratio = float(width) / height
-    fig, ax = plt.subplots(figsize=(12 * aspect_ratio, 12))
-    # To remove the huge white borders
-    fig.tight_layout(pad=0)
+    # The figure is 12 inches high, the dpi gives it the requested pixel height
+    # so that it needs no resampling (marker and line sizes are in points and
+    # keep their size relative to the image).
+    dpi = 100 if output_image_height is None else output_image_height / 12
+    # Every call owns its figure and canvas, concurrent renders do not share state.
+    fig = Figure(figsize=(12 * aspect_ratio, 12), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    # The axes cover the whole figure, without white borders.
+    ax = fig.add_axes([0, 0, 1, 1])
     ax.margins(0)
-    ax.set_yticklabels([])
-    ax.set_xticklabels([])
-    plt.axis('off')
+    ax.axis('off')
 
     im = ax.imshow(image)
     line_segments = LineCollection([], linewidths=(4), linestyle='solid')
@@ -343,20 +324,29 @@ def draw_prediction_on_image(
             linewidth=1, edgecolor='b', facecolor='none')
         ax.add_patch(rect)
 
-    fig.canvas.draw()
-    image_from_plot = np.frombuffer(fig.canvas.tostring_rgb(), dtype=np.uint8)
-    image_from_plot = image_from_plot.reshape(
-        fig.canvas.get_width_height()[::-1] + (3,))
-    plt.close(fig)
+    canvas.draw()
+    # RGBA view of the canvas, copied to a contiguous RGB array.
+    image_from_plot = np.ascontiguousarray(np.asarray(canvas.buffer_rgba())[..., :3])
     if output_image_height is not None:
         output_image_width = int(output_image_height / height * width)
-        image_from_plot = cv2.resize(
-            image_from_plot, dsize=(output_image_width, output_image_height),
-            interpolation=cv2.INTER_CUBIC)
+        # Only a rounding difference of the canvas size is left to correct.
+        if image_from_plot.shape[:2] != (output_image_height, output_image_width):
+            image_from_plot = cv2.resize(
+                image_from_plot, dsize=(output_image_width, output_image_height),
+                interpolation=cv2.INTER_CUBIC)
     return image_from_plot
 
 
-def to_gif(images, fps):
-    """Converts image sequence (4D numpy array) to gif."""
-    imageio.mimsave('./animation.gif', images, fps=fps)
-    return embed.embed_file('./animation.gif')
+def to_gif(images, fps, sink=None):
+    """Converts image sequence (iterable of [height, width, 3] frames) to gif.
+
+    The frames are streamed into the encoder one by one. Without a sink the gif
+    is returned as bytes, otherwise it is written to the sink (e.g. an
+    encoders.S3MultipartSink) and None is returned.
+    """
+    output = sink or BytesSink()
+    with StreamingEncoder(output, fps=fps, format='gif') as encoder:
+        for image in images:
+            encoder.write_frame(image)
+    if sink is None:
+        return output.getvalue()
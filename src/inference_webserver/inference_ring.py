@@ -0,0 +1,271 @@
+import os
+import time
+import atexit
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+KEYPOINTS_SHAPE = (1, 17, 3)
+
+# States of a slot, with the pid of the worker owning it kept next to it in shared memory.
+FREE, WRITING, SUBMITTED, DONE, ABANDONED, FAILED = range(6)
+# Seconds between two checks of the inference process while a worker waits for its output.
+_POLL_INTERVAL = 1.0
+
+
+class InferenceUnavailable(RuntimeError):
+    """Raised when the inference process of the ring is not running."""
+
+
+class InferenceFailed(RuntimeError):
+    """Raised when the batch holding the slot of the request failed in the inference process."""
+
+
+class InferenceRing:
+    """Shared-memory request ring between the gunicorn workers and one inference process.
+
+    The ring is a single shared memory block: the uint8 input tensors of the
+    num_slots slots back to back, then their float32 keypoints outputs. Workers
+    take a free slot, write the preprocessed image straight into it and submit
+    the slot index; the inference process drains the submitted slots and runs
+    every range of at most max_batch neighbouring slots as one batch, passing
+    a view of the shared inputs as the batch tensor, then signals each slot's
+    semaphore once its output is written. Only slot indices travel through the
+    queues, the image data is neither pickled nor copied into a batch array.
+
+    The ring has to be created in the gunicorn master before the workers fork
+    (serve enables --preload for it), so that every worker inherits the same
+    shared memory, queues and semaphores.
+
+    Every slot has a state and an owner pid in shared memory, so that no slot
+    is lost when a worker gives up or dies: a worker waits for a free slot and
+    for its output at most timeout seconds (or its deadline), a slot whose
+    worker gave up is freed by the inference process once its batch is done,
+    and the master frees the slots of a worker that exited (see reclaim). A
+    dead inference process makes infer fail with InferenceUnavailable instead
+    of blocking, a batch that raised fails its requests with InferenceFailed.
+    """
+
+    def __init__(self, num_slots=16, input_shape=(256, 256, 3), max_batch=4, timeout=60.0):
+        context = multiprocessing.get_context('fork')
+        self.num_slots = num_slots
+        self.input_shape = tuple(input_shape)
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._input_size = int(np.prod(self.input_shape))
+        self._output_size = int(np.prod(KEYPOINTS_SHAPE)) * 4
+        self._shm = shared_memory.SharedMemory(create=True, size=(self._input_size + self._output_size) * num_slots)
+        self._owner = os.getpid()
+        # SimpleQueue writes straight to a pipe, no feeder thread that would not survive the fork.
+        self._submitted = context.SimpleQueue()
+        self._done = [context.Semaphore(0) for _ in range(num_slots)]
+        self._free = context.Semaphore(num_slots)
+        # The state and owner pid of every slot, changed under _lock only.
+        self._lock = context.Lock()
+        self._state = context.Array('i', num_slots, lock=False)
+        self._owners = context.Array('q', num_slots, lock=False)
+        self._process = None
+        self._process_pid = None
+        atexit.register(self.close)
+
+    def input_view(self, slot):
+        return self.inputs_view(slot, 1)[0]
+
+    def inputs_view(self, first_slot, count):
+        """Returns the [count, height, width, 3] inputs of the slots first_slot to first_slot + count - 1."""
+        return np.ndarray((count,) + self.input_shape, dtype=np.uint8, buffer=self._shm.buf,
+                          offset=first_slot * self._input_size)
+
+    def output_view(self, slot):
+        offset = self.num_slots * self._input_size + slot * self._output_size
+        return np.ndarray(KEYPOINTS_SHAPE, dtype=np.float32, buffer=self._shm.buf, offset=offset)
+
+    def infer(self, image, timeout=None):
+        """Runs the model on one preprocessed [height, width, 3] uint8 image.
+
+        Args:
+            image: The preprocessed image.
+            timeout: An optional number of seconds to wait for a slot and the output, self.timeout by default.
+
+        Returns:
+            A [1, 1, 17, 3] float32 numpy array with the keypoints and scores.
+
+        Raises:
+            TimeoutError: When no slot was free or the output was not ready within the timeout.
+            InferenceUnavailable: When the inference process is not running.
+            InferenceFailed: When the batch of the image failed.
+        """
+        expires_at = time.monotonic() + (self.timeout if timeout is None else timeout)
+        slot = self._take_slot(expires_at)
+        try:
+            np.copyto(self.input_view(slot), image, casting='unsafe')
+            with self._lock:
+                self._state[slot] = SUBMITTED
+            self._submitted.put(slot)
+            self._wait_done(slot, expires_at)
+            if self._state[slot] == FAILED:
+                raise InferenceFailed("Inference of the batch failed")
+            return self.output_view(slot)[np.newaxis].copy()
+        finally:
+            with self._lock:
+                if self._state[slot] == SUBMITTED:
+                    # Still in a batch, the inference process frees it once the output is written.
+                    self._state[slot] = ABANDONED
+                else:
+                    self._release(slot)
+
+    def _take_slot(self, expires_at):
+        self._check_alive()
+        if not self._free.acquire(timeout=max(expires_at - time.monotonic(), 0)):
+            raise TimeoutError("No free slot in the inference ring")
+        with self._lock:
+            slot = list(self._state).index(FREE)
+            self._state[slot] = WRITING
+            self._owners[slot] = os.getpid()
+        return slot
+
+    def _wait_done(self, slot, expires_at):
+        while True:
+            remaining = expires_at - time.monotonic()
+            if self._done[slot].acquire(timeout=max(min(remaining, _POLL_INTERVAL), 0)):
+                return
+            self._check_alive()
+            if remaining <= _POLL_INTERVAL:
+                raise TimeoutError("Inference ring output not ready in time")
+
+    def _release(self, slot):
+        # Called under _lock; a DONE or FAILED slot whose token was not consumed gives it back first.
+        if self._state[slot] in (DONE, FAILED):
+            self._done[slot].acquire(False)
+        self._state[slot] = FREE
+        self._owners[slot] = 0
+        self._free.release()
+
+    def alive(self):
+        """Returns whether the inference process is running, from any process of the server."""
+        if self._process_pid is None:
+            return False
+        try:
+            with open(f'/proc/{self._process_pid}/stat', 'r') as stat:
+                # The state follows the parenthesized command name; Z is a zombie.
+                return stat.read().rpartition(')')[2].split()[0] != 'Z'
+        except FileNotFoundError:
+            return False
+
+    def _check_alive(self):
+        if not self.alive():
+            raise InferenceUnavailable(f"Inference process {self._process_pid} is not running")
+
+    def reclaim(self, pid):
+        """Frees the slots of a worker that exited; called by the master from gunicorn's child_exit.
+
+        Returns:
+            The number of slots that were owned by the worker.
+        """
+        reclaimed = 0
+        with self._lock:
+            for slot in range(self.num_slots):
+                if self._owners[slot] != pid or self._state[slot] in (FREE, ABANDONED):
+                    continue
+                reclaimed += 1
+                if self._state[slot] == SUBMITTED:
+                    self._state[slot] = ABANDONED
+                else:
+                    self._release(slot)
+        if reclaimed:
+            logging.warning(f"Reclaimed {reclaimed} inference ring slots of worker {pid}")
+        return reclaimed
+
+    def start(self, model_file, num_threads=None):
+        """Starts the inference process, forked from the current (master) process."""
+        context = multiprocessing.get_context('fork')
+        self._process = context.Process(target=self._serve, args=(model_file, num_threads),
+                                        name='inference-ring', daemon=True)
+        self._process.start()
+        self._process_pid = self._process.pid
+        logging.info(f"Inference process started, pid {self._process.pid}")
+
+    def _interpreter(self, interpreters, model_file, num_threads, batch_size):
+        import tensorflow as tf
+        interpreter = interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = tf.lite.Interpreter(model_path=model_file, num_threads=num_threads)
+            if batch_size > 1:
+                input_index = interpreter.get_input_details()[0]['index']
+                interpreter.resize_tensor_input(input_index, (batch_size,) + self.input_shape, strict=False)
+            interpreter.allocate_tensors()
+            if batch_size > 1:
+                # Some models allocate at any batch size but keep a batch of 1 in their output.
+                interpreter.set_tensor(interpreter.get_input_details()[0]['index'],
+                                       np.zeros((batch_size,) + self.input_shape, dtype=np.uint8))
+                interpreter.invoke()
+                output = interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+                if output.shape[0] != batch_size:
+                    raise ValueError(f"Output batch {output.shape[0]} for an input batch of {batch_size}")
+            interpreters[batch_size] = interpreter
+        return interpreter
+
+    def _batch_ranges(self, slots, max_batch):
+        """Groups the submitted slots into (first slot, count) ranges of at most max_batch neighbouring slots.
+
+        A range can include slots that are not part of the batch, their rows are
+        computed and ignored; the inputs are never copied to be made contiguous.
+        """
+        ranges = []
+        for slot in sorted(slots):
+            if ranges and slot < ranges[-1][0] + max_batch:
+                ranges[-1][1] = slot - ranges[-1][0] + 1
+            else:
+                ranges.append([slot, 1])
+        return ranges
+
+    def _serve(self, model_file, num_threads):
+        interpreters = {}
+        max_batch = 1
+        self._interpreter(interpreters, model_file, num_threads, 1)
+        try:
+            for batch_size in range(2, self.max_batch + 1):
+                self._interpreter(interpreters, model_file, num_threads, batch_size)
+                max_batch = batch_size
+        except Exception:
+            logging.warning(f"Model does not support batches of {max_batch + 1}, batching at most {max_batch} slots",
+                            exc_info=True)
+        while True:
+            slots = [self._submitted.get()]
+            while len(slots) < max_batch and not self._submitted.empty():
+                slots.append(self._submitted.get())
+            submitted = set(slots)
+            for first_slot, count in self._batch_ranges(slots, max_batch):
+                batch_slots = [slot for slot in range(first_slot, first_slot + count) if slot in submitted]
+                try:
+                    interpreter = self._interpreter(interpreters, model_file, num_threads, count)
+                    interpreter.set_tensor(interpreter.get_input_details()[0]['index'],
+                                           self.inputs_view(first_slot, count))
+                    interpreter.invoke()
+                    keypoints = interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+                    for slot in batch_slots:
+                        self.output_view(slot)[...] = keypoints[slot - first_slot]
+                    state = DONE
+                except Exception:
+                    logging.exception(f"Inference failed for slots {batch_slots}")
+                    state = FAILED
+                with self._lock:
+                    for slot in batch_slots:
+                        if self._state[slot] == ABANDONED:
+                            # The worker gave up or exited, nobody waits for this output.
+                            self._release(slot)
+                        else:
+                            self._state[slot] = state
+                            self._done[slot].release()
+
+    def close(self):
+        if os.getpid() != self._owner:
+            return
+        if self._process is not None and self._process.is_alive():
+            self._process.terminate()
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
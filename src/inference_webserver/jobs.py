@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+import metrics
+from cache import LRUCache
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class JobStore:
+    """Storage of the asynchronous job records.
+
+    Records are JSON serialisable dictionaries; they expire ttl seconds after
+    they were last written.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def put(self, job_id, record):
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """Returns the record of the job, or None if it is unknown or expired."""
+        raise NotImplementedError
+
+
+class InMemoryJobStore(JobStore):
+    """Job store local to the worker process, meant for local testing.
+
+    With several workers or instances a status call can reach a process that
+    did not run the job, use S3JobStore there.
+    """
+
+    def __init__(self, ttl=3600, max_jobs=10000):
+        super().__init__(ttl)
+        self._jobs = LRUCache(max_entries=max_jobs, ttl=ttl)
+
+    def put(self, job_id, record):
+        self._jobs.put(job_id, record)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+
+class S3JobStore(JobStore):
+    """Job store keeping one JSON object per job under an S3 prefix.
+
+    Expired records are ignored when read; a lifecycle rule on the prefix can
+    delete the objects themselves.
+    """
+
+    def __init__(self, s3_uri, ttl=3600, client=None):
+        super().__init__(ttl)
+        parsed = urlparse(s3_uri)
+        self.bucket = parsed.netloc
+        self.prefix = parsed.path.strip("/")
+        self.client = client or boto3.client('s3')
+
+    def _key(self, job_id):
+        return f"{self.prefix}/{job_id}.json" if self.prefix else f"{job_id}.json"
+
+    def put(self, job_id, record):
+        record = dict(record, expires_at=time.time() + self.ttl)
+        self.client.put_object(Bucket=self.bucket, Key=self._key(job_id),
+                               Body=json.dumps(record), ContentType='application/json')
+
+    def get(self, job_id):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(job_id))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        record = json.loads(response['Body'].read())
+        if record.pop('expires_at', 0) < time.time():
+            return None
+        return record
+
+
+def create_job_store(location=None, ttl=None):
+    """Creates the job store configured by ASYNC_JOB_STORE ('memory' or an s3:// prefix)."""
+    location = location or os.environ.get('ASYNC_JOB_STORE', 'memory')
+    ttl = ttl or float(os.environ.get('ASYNC_JOB_TTL', 3600))
+    if location.startswith('s3://'):
+        return S3JobStore(location, ttl=ttl)
+    return InMemoryJobStore(ttl=ttl)
+
+
+class JobQueueFull(Exception):
+    """Raised when the worker already holds the maximum number of unfinished jobs."""
+
+
+def _owner_alive(owner):
+    """Returns False when the owner of a record is a process of this host that no longer runs."""
+    if not owner or owner.get('host') != socket.gethostname():
+        return True
+    try:
+        os.kill(owner['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobManager:
+    """Runs submitted jobs on a bounded pool of threads and records their state.
+
+    Every record names its owner (pid and host) and carries a heartbeat the
+    owner refreshes every heartbeat_interval seconds while the job is not
+    finished. A pending or running record whose heartbeat is older than
+    stale_after, or whose owner process on this host is gone, is reported as
+    failed: the worker running it was recycled or crashed.
+    """
+
+    def __init__(self, store, max_workers=2, max_pending=16, admission=None, heartbeat_interval=30,
+                 stale_after=None):
+        self.store = store
+        self.max_pending = max_pending
+        self.admission = admission
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after or 3 * heartbeat_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='async-job')
+        self._lock = threading.Lock()
+        # Serialises the writes of the records, a heartbeat never overwrites a newer state.
+        self._write_lock = threading.Lock()
+        self._pending = 0
+        # Unfinished jobs of this process: job id -> the last record written.
+        self._records = {}
+        self._heartbeat = None
+        self._heartbeat_pid = None
+
+    def _owner(self):
+        return {"pid": os.getpid(), "host": socket.gethostname()}
+
+    def _put(self, job_id, record, finished=False):
+        with self._write_lock:
+            record["heartbeat_at"] = time.time()
+            if finished:
+                self._records.pop(job_id, None)
+            else:
+                self._records[job_id] = record
+            self.store.put(job_id, record)
+
+    def _ensure_heartbeat(self):
+        # Started lazily: the manager is created at import time, in the gunicorn master with preload.
+        with self._lock:
+            if self._heartbeat is None or not self._heartbeat.is_alive() or self._heartbeat_pid != os.getpid():
+                self._heartbeat_pid = os.getpid()
+                self._heartbeat = threading.Thread(target=self._beat, name='async-job-heartbeat', daemon=True)
+                self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._write_lock:
+                records = list(self._records.items())
+            for job_id, record in records:
+                try:
+                    with self._write_lock:
+                        if self._records.get(job_id) is record:
+                            record["heartbeat_at"] = time.time()
+                            self.store.put(job_id, record)
+                except Exception:
+                    logging.exception(f"Job heartbeat failed, {job_id}")
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) and returns the id of the job.
+
+        The return value of fn becomes the result of the job, an exception
+        marks the job as failed. An unfinished job holds a queue place of the
+        admission controller, when one is given, so submitting raises
+        Overloaded once the worker is saturated by requests and jobs together.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.increment('async_jobs_rejected_total')
+                raise JobQueueFull()
+            self._pending += 1
+        if self.admission is not None:
+            try:
+                self.admission.reserve()
+            except Exception:
+                with self._lock:
+                    self._pending -= 1
+                metrics.increment('async_jobs_rejected_total')
+                raise
+        job_id = uuid.uuid4().hex
+        submitted_at = time.time()
+        try:
+            self._ensure_heartbeat()
+            self._put(job_id, {"job_id": job_id, "status": PENDING, "submitted_at": submitted_at,
+                               "owner": self._owner()})
+            self._executor.submit(self._run, job_id, submitted_at, fn, args, kwargs)
+        except Exception:
+            # The job never runs, free its places or a few store errors would shed every request.
+            with self._write_lock:
+                self._records.pop(job_id, None)
+            with self._lock:
+                self._pending -= 1
+            if self.admission is not None:
+                self.admission.release()
+            raise
+        metrics.increment('async_jobs_submitted_total')
+        return job_id
+
+    def _run(self, job_id, submitted_at, fn, args, kwargs):
+        running = {"job_id": job_id, "status": RUNNING, "submitted_at": submitted_at, "started_at": time.time(),
+                   "owner": self._owner()}
+        # The running record is only rewritten by the heartbeat, the outcome goes into a new one.
+        record = dict(running)
+        try:
+            self._put(job_id, running)
+            record["result"] = fn(*args, **kwargs)
+            record["status"] = COMPLETED
+        except Exception as e:
+            logging.exception(f"Job failed, {job_id}")
+            record["status"] = FAILED
+            record["error"] = str(e)
+        finally:
+            with self._lock:
+                self._pending -= 1
+            if self.admission is not None:
+                self.admission.release()
+        record["finished_at"] = time.time()
+        metrics.increment('async_jobs_finished_total', status=record["status"])
+        metrics.observe('async_job_duration_seconds', record["finished_at"] - record["started_at"])
+        self._put(job_id, record, finished=True)
+
+    def status(self, job_id):
+        """Returns the record of the job, or None if it is unknown or expired.
+
+        An unfinished job whose owner stopped heartbeating is returned as failed.
+        """
+        record = self.store.get(job_id)
+        if record is None or record.get("status") not in (PENDING, RUNNING):
+            return record
+        heartbeat_at = record.get("heartbeat_at", record.get("submitted_at", 0))
+        if time.time() - heartbeat_at > self.stale_after:
+            error = f"Worker lost, no heartbeat for {time.time() - heartbeat_at:.0f} s"
+        elif not _owner_alive(record.get("owner")):
+            error = f"Worker lost, process {record['owner']['pid']} exited"
+        else:
+            return record
+        metrics.increment('async_jobs_lost_total')
+        return dict(record, status=FAILED, error=error)
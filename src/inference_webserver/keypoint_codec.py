@@ -0,0 +1,120 @@
+import struct
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # in the server requirements; the fixed binary layout has no dependency
+    msgpack = None
+
+# Binary keypoint layout, all fields little-endian:
+#   magic 'KPTS' | format version u8 | dtype u8 | num_poses u16 | image_height u32 |
+#   image_width u32 | model_version_length u8 | model_version (utf-8) |
+#   num_poses * 17 * 3 values (y, x, score) of the given dtype
+# Coordinates are normalised like the JSON keypoints of the same request.
+# Version 1 had u16 image sizes, the decoder still reads it.
+MAGIC = b'KPTS'
+FORMAT_VERSION = 2
+HEADERS = {1: struct.Struct('<4sBBHHHB'), 2: struct.Struct('<4sBBHIIB')}
+HEADER = HEADERS[FORMAT_VERSION]
+MAX_POSES = 0xFFFF
+MAX_IMAGE_SIDE = 0xFFFFFFFF
+DTYPES = {1: np.dtype('<f2'), 2: np.dtype('<f4')}
+DTYPE_CODES = {'float16': 1, 'float32': 2}
+
+CONTENT_TYPE_FLOAT16 = 'application/x-keypoints-f16'
+CONTENT_TYPE_FLOAT32 = 'application/x-keypoints-f32'
+CONTENT_TYPE_MSGPACK = 'application/x-msgpack'
+BINARY_CONTENT_TYPES = {CONTENT_TYPE_FLOAT16: 'float16', CONTENT_TYPE_FLOAT32: 'float32'}
+
+
+def encode_keypoints(keypoints_with_scores, image_height, image_width, model_version='', dtype='float16'):
+    """Encodes keypoints into the fixed little-endian binary layout.
+
+    Args:
+        keypoints_with_scores: An array of shape [N, 17, 3] (or [1, N, 17, 3], [1, 1, 17, 3]).
+        image_height: height of the input image in pixels.
+        image_width: width of the input image in pixels.
+        model_version: A string identifying the model that produced the keypoints.
+        dtype: 'float16' or 'float32'.
+
+    Returns:
+        The encoded bytes.
+
+    Raises:
+        ValueError: if the number of poses or an image side does not fit the header.
+    """
+    keypoints = np.asarray(keypoints_with_scores).reshape(-1, 17, 3)
+    if keypoints.shape[0] > MAX_POSES:
+        raise ValueError(f"{keypoints.shape[0]} poses, the layout holds at most {MAX_POSES}")
+    if not (0 <= image_height <= MAX_IMAGE_SIDE and 0 <= image_width <= MAX_IMAGE_SIDE):
+        raise ValueError(f"Image size {image_height}x{image_width} out of range")
+    version = model_version.encode('utf-8')[:255]
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, DTYPE_CODES[dtype], keypoints.shape[0],
+                         image_height, image_width, len(version))
+    return header + version + keypoints.astype(DTYPES[DTYPE_CODES[dtype]], copy=False).tobytes()
+
+
+def decode_keypoints(data):
+    """Reference decoder of encode_keypoints.
+
+    Returns:
+        A dictionary with 'keypoints' ([N, 17, 3] float32), 'image_height',
+        'image_width' and 'model_version'.
+    """
+    if len(data) < 5 or data[:4] != MAGIC or data[4] not in HEADERS:
+        raise ValueError("Not a keypoint payload of a supported version")
+    header = HEADERS[data[4]]
+    _, _, dtype_code, num_poses, image_height, image_width, version_length = header.unpack_from(data)
+    offset = header.size + version_length
+    keypoints = np.frombuffer(data, dtype=DTYPES[dtype_code], count=num_poses * 17 * 3, offset=offset)
+    return {
+        'keypoints': keypoints.reshape(num_poses, 17, 3).astype(np.float32),
+        'image_height': image_height,
+        'image_width': image_width,
+        'model_version': data[header.size:offset].decode('utf-8'),
+    }
+
+
+def encode_msgpack(keypoints_with_scores, image_height, image_width, model_version=''):
+    """Encodes keypoints as a msgpack map with the float16 values as a bin field."""
+    keypoints = np.asarray(keypoints_with_scores).reshape(-1, 17, 3)
+    return msgpack.packb({
+        'model_version': model_version,
+        'image_height': image_height,
+        'image_width': image_width,
+        'num_poses': keypoints.shape[0],
+        'keypoints': keypoints.astype('<f2').tobytes(),
+    })
+
+
+def decode_msgpack(data):
+    """Reference decoder of encode_msgpack, returns the same dictionary as decode_keypoints."""
+    payload = msgpack.unpackb(data)
+    keypoints = np.frombuffer(payload['keypoints'], dtype='<f2').reshape(payload['num_poses'], 17, 3)
+    return {
+        'keypoints': keypoints.astype(np.float32),
+        'image_height': payload['image_height'],
+        'image_width': payload['image_width'],
+        'model_version': payload['model_version'],
+    }
+
+
+def negotiate(accept):
+    """Returns the binary content type to answer with for an Accept header, or None for JSON."""
+    if not accept:
+        return None
+    for media_range in accept.split(','):
+        media_type = media_range.split(';')[0].strip().lower()
+        if media_type in BINARY_CONTENT_TYPES:
+            return media_type
+        if media_type == CONTENT_TYPE_MSGPACK and msgpack is not None:
+            return media_type
+    return None
+
+
+def encode_response(content_type, keypoints_with_scores, image_height, image_width, model_version=''):
+    """Encodes the keypoints in the negotiated binary content type."""
+    if content_type == CONTENT_TYPE_MSGPACK:
+        return encode_msgpack(keypoints_with_scores, image_height, image_width, model_version)
+    return encode_keypoints(keypoints_with_scores, image_height, image_width, model_version,
+                            dtype=BINARY_CONTENT_TYPES[content_type])
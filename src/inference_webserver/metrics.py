@@ -0,0 +1,74 @@
+import os
+import threading
+from collections import defaultdict
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds (bytes) of the allocation histogram buckets.
+ALLOCATION_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """Adds value to the counter name with the given labels."""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    """Sets the gauge name with the given labels to value."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """Records value in the histogram name with the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for idx, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][idx] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in items) + '}'
+
+
+def render():
+    """Returns the metrics of this worker process in the Prometheus text format.
+
+    Every gunicorn worker keeps its own metrics, the samples carry a pid label
+    so that scrapes of different workers can be told apart.
+    """
+    pid = (('pid', os.getpid()),)
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append('{}{} {}'.format(name, _format_labels(labels, pid), value))
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append('{}{} {}'.format(name, _format_labels(labels, pid), value))
+        for (name, labels), histogram in sorted(_histograms.items()):
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels, pid + (('le', bound),)), count))
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels, pid + (('le', '+Inf'),)), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels, pid), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels, pid), histogram['count']))
+    return '\n'.join(lines) + '\n'
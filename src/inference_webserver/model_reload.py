@@ -0,0 +1,163 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+from urllib.parse import urlparse
+
+import numpy as np
+import boto3
+
+import metrics
+import model_store
+
+# Local copies of the downloaded model versions, shared by the workers.
+VERSIONS_DIR = os.path.join(model_store.model_path, 'versions')
+MODEL_FILE_NAME = 'model.tflite'
+
+
+class ModelWatcher:
+    """Watches a versioned model location and switches the worker to its latest version.
+
+    The source is a local directory or an s3:// prefix holding one
+    <version>/model.tflite per version; the latest version is the greatest
+    version name, e.g. a timestamp or a zero-padded number. Every
+    poll_interval seconds a background thread of each worker process lists the
+    versions, downloads a new one once for all the workers of the instance,
+    validates it with a warm-up inference and activates it in model_store. A
+    model failing the validation is not retried and the worker keeps serving
+    the previous one.
+    """
+
+    def __init__(self, source, poll_interval=30.0, input_size=None, versions_dir=VERSIONS_DIR, client=None):
+        self.source = source.rstrip('/')
+        self.poll_interval = poll_interval
+        self.input_size = input_size
+        self.versions_dir = versions_dir
+        self._client = client
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._rejected = set()
+
+    def ensure_started(self):
+        """Starts the watcher thread of the calling process, once per worker."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='model-watcher', daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                logging.exception(f"Model watch of {self.source} failed")
+                metrics.increment('model_reload_errors_total')
+            time.sleep(self.poll_interval)
+
+    def check(self):
+        """Activates the latest version of the source if it is new and valid.
+
+        Returns:
+            The activated version, or None when nothing changed.
+        """
+        versions = self.list_versions()
+        if not versions:
+            return None
+        latest = max(versions)
+        if latest == model_store.active_model()[2] or latest in self._rejected:
+            return None
+        path = self.fetch(latest)
+        started = time.monotonic()
+        try:
+            validate_model(path, self.input_size)
+        except Exception:
+            logging.exception(f"Model {latest} failed the validation, keeping {model_store.active_model()[2]}")
+            metrics.increment('model_reload_rejected_total')
+            self._rejected.add(latest)
+            return None
+        metrics.observe('model_validation_seconds', time.monotonic() - started)
+        generation = model_store.activate(path, latest)
+        metrics.increment('model_reloads_total')
+        metrics.set_gauge('model_generation', generation)
+        return latest
+
+    def list_versions(self):
+        """Returns the versions of the source that hold a model file."""
+        if self.source.startswith('s3://'):
+            parsed = urlparse(self.source)
+            prefix = parsed.path.strip('/')
+            prefix = prefix + '/' if prefix else ''
+            paginator = self._s3().get_paginator('list_objects_v2')
+            versions = []
+            for page in paginator.paginate(Bucket=parsed.netloc, Prefix=prefix):
+                for item in page.get('Contents', []):
+                    version, _, name = item['Key'][len(prefix):].partition('/')
+                    if name == MODEL_FILE_NAME:
+                        versions.append(version)
+            return versions
+        if not os.path.isdir(self.source):
+            return []
+        return [version for version in os.listdir(self.source)
+                if os.path.isfile(os.path.join(self.source, version, MODEL_FILE_NAME))]
+
+    def fetch(self, version):
+        """Returns the local path of the model version, downloading it unless another worker did."""
+        if not self.source.startswith('s3://'):
+            return os.path.join(self.source, version, MODEL_FILE_NAME)
+        path = os.path.join(self.versions_dir, version, MODEL_FILE_NAME)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(os.path.join(self.versions_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(path):
+                    parsed = urlparse(self.source)
+                    key = '/'.join(part for part in (parsed.path.strip('/'), version, MODEL_FILE_NAME) if part)
+                    self._s3().download_file(parsed.netloc, key, path + '.tmp')
+                    os.replace(path + '.tmp', path)
+                    logging.info(f"Model {version} downloaded to {path}")
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return path
+
+    def _s3(self):
+        if self._client is None:
+            self._client = boto3.client('s3')
+        return self._client
+
+
+def validate_model(path, input_size=None):
+    """Runs a warm-up inference of the model at path on a blank input.
+
+    Args:
+        path: A string representing the path of the model.tflite file.
+        input_size: An optional integer, the side of the input image the server resizes to.
+
+    Raises:
+        ValueError: When the model does not take a square uint8 image (of input_size) or does
+            not return finite [1, 1, 17, 3] keypoints.
+    """
+    interpreter = model_store.create_interpreter(path)
+    input_details = interpreter.get_input_details()[0]
+    shape = tuple(input_details['shape'])
+    if len(shape) != 4 or shape[1] != shape[2] or shape[3] != 3 or input_details['dtype'] != np.uint8:
+        raise ValueError(f"Unexpected input {shape} {input_details['dtype']}, expected [1, N, N, 3] uint8")
+    if input_size is not None and shape[1] != input_size:
+        raise ValueError(f"Input size {shape[1]} differs from the {input_size} the images are resized to")
+    interpreter.set_tensor(input_details['index'], np.zeros(shape, dtype=np.uint8))
+    interpreter.invoke()
+    output = interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+    if output.shape != (1, 1, 17, 3) or not np.all(np.isfinite(output)):
+        raise ValueError(f"Unexpected output {output.shape}, expected finite [1, 1, 17, 3] keypoints")
+
+
+def create_model_watcher(input_size=None):
+    """Returns the ModelWatcher of MODEL_RELOAD_SOURCE, or None when hot reload is disabled."""
+    source = os.environ.get('MODEL_RELOAD_SOURCE')
+    if not source:
+        return None
+    return ModelWatcher(source, poll_interval=float(os.environ.get('MODEL_RELOAD_INTERVAL', 30)),
+                        input_size=input_size)
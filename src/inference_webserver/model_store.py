@@ -0,0 +1,125 @@
+import os
+import hashlib
+import logging
+import threading
+import tensorflow as tf
+
+prefix = "/opt/ml/"
+model_path = os.path.join(prefix, "model")
+model_file = os.path.join(model_path, 'model.tflite')
+
+_model_version = None
+_local = threading.local()
+# Model served by new interpreters as (generation, path, version), replaced by activate().
+# None until the first reload, the model is then model_file.
+_active = None
+_active_lock = threading.Lock()
+# TFLite threads of every worker interpreter, the TFLite default when not set (see tune.py).
+interpreter_threads = int(os.environ['MODEL_INTERPRETER_THREADS']) if os.environ.get('MODEL_INTERPRETER_THREADS') else None
+
+
+def preload_model(path=None):
+    """Reads the TensorFlow Lite model file into the page cache and computes its version.
+
+    Called at import time of the serving modules. With MODEL_SERVER_PRELOAD the
+    import happens in the gunicorn master, so the TensorFlow runtime and the
+    version are shared copy-on-write by every worker after the fork. The
+    workers' interpreters are built from the file path, TFLite maps the file
+    read-only, so the model pages live once in the page cache whatever the
+    number of workers.
+
+    Args:
+        path: A string representing the path of the model.tflite file, model_file when None.
+
+    Returns:
+        The version of the model, see model_version.
+    """
+    path = model_file if path is None else path
+    if os.path.exists(path):
+        with open(path, 'rb') as model:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(model.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+    else:
+        logging.warning(f"Model file not found, {path}")
+    return model_version(path)
+
+
+def model_version(path=None):
+    """Returns the version of the served model.
+
+    MODEL_VERSION if set, otherwise the first 12 hex digits of the SHA-256 of
+    the model file (model_file when path is None), streamed from the file.
+    """
+    global _model_version
+    if _model_version is None:
+        _model_version = os.environ.get('MODEL_VERSION')
+        if not _model_version:
+            path = model_file if path is None else path
+            if os.path.exists(path):
+                digest = hashlib.sha256()
+                with open(path, 'rb') as model:
+                    for chunk in iter(lambda: model.read(1 << 20), b''):
+                        digest.update(chunk)
+                _model_version = digest.hexdigest()[:12]
+            else:
+                _model_version = 'unknown'
+    return _model_version
+
+
+def active_model():
+    """Returns the (generation, path, version) of the model new interpreters are created from."""
+    active = _active
+    if active is None:
+        return 0, model_file, model_version()
+    return active
+
+
+def activate(path, version):
+    """Makes the model at path the served model of this process.
+
+    The switch is atomic: every thread creates an interpreter of the new model on
+    its next get_interpreter call, a request running on the previous interpreter
+    finishes on it.
+
+    Returns:
+        The generation of the activated model.
+    """
+    global _active
+    with _active_lock:
+        generation = active_model()[0] + 1
+        _active = (generation, path, version)
+    logging.info(f"Model {version} activated, generation {generation}, {path}")
+    return generation
+
+
+def create_interpreter(path, num_threads=interpreter_threads):
+    """Returns a TensorFlow Lite interpreter of the model at path with its tensors allocated."""
+    interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+def get_interpreter():
+    """Returns the interpreter of the calling worker thread.
+
+    The interpreter, and therefore its tensor arena, is created lazily after the
+    fork, once per process and thread. It is never created in the gunicorn master.
+    It is created again when another model was activated.
+    """
+    generation, path, version = active_model()
+    interpreter = getattr(_local, 'interpreter', None)
+    if interpreter is None or _local.pid != os.getpid() or _local.generation != generation:
+        logging.info(f"Model Path, {path}")
+        interpreter = create_interpreter(path)
+        _local.interpreter = interpreter
+        _local.pid = os.getpid()
+        _local.generation = generation
+        _local.version = version
+    return interpreter
+
+
+def interpreter_version():
+    """Returns the version of the model the calling thread last ran, the active version before its first run."""
+    if getattr(_local, 'interpreter', None) is None or _local.pid != os.getpid():
+        return active_model()[2]
+    return _local.version
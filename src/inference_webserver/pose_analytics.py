@@ -0,0 +1,175 @@
+import numpy as np
+
+from skeleton import KEYPOINT_DICT, KEYPOINT_EDGE_INDS_TO_COLOR
+
+# Keypoints below this score are treated as not visible, features using them are NaN.
+DEFAULT_SCORE_THRESHOLD = 0.3
+
+# Joint angles as (first, vertex, second) joints, the angle is measured at the vertex.
+JOINT_ANGLES = {
+    'left_elbow': ('left_shoulder', 'left_elbow', 'left_wrist'),
+    'right_elbow': ('right_shoulder', 'right_elbow', 'right_wrist'),
+    'left_shoulder': ('left_elbow', 'left_shoulder', 'left_hip'),
+    'right_shoulder': ('right_elbow', 'right_shoulder', 'right_hip'),
+    'left_hip': ('left_shoulder', 'left_hip', 'left_knee'),
+    'right_hip': ('right_shoulder', 'right_hip', 'right_knee'),
+    'left_knee': ('left_hip', 'left_knee', 'left_ankle'),
+    'right_knee': ('right_hip', 'right_knee', 'right_ankle'),
+}
+
+JOINT_NAMES = sorted(KEYPOINT_DICT, key=KEYPOINT_DICT.get)
+ANGLE_NAMES = list(JOINT_ANGLES)
+LIMB_NAMES = [f"{JOINT_NAMES[a]}-{JOINT_NAMES[b]}" for a, b in KEYPOINT_EDGE_INDS_TO_COLOR]
+
+_ANGLE_INDICES = np.array([[KEYPOINT_DICT[joint] for joint in joints] for joints in JOINT_ANGLES.values()])
+_LIMB_INDICES = np.array(list(KEYPOINT_EDGE_INDS_TO_COLOR))
+_SHOULDERS = np.array([KEYPOINT_DICT['left_shoulder'], KEYPOINT_DICT['right_shoulder']])
+_HIPS = np.array([KEYPOINT_DICT['left_hip'], KEYPOINT_DICT['right_hip']])
+
+
+def as_batch(keypoints_with_scores):
+    """Reshapes [1, 1, 17, 3], [N, 1, 1, 17, 3] or [N, 17, 3] keypoints to a [N, 17, 3] float32 array."""
+    return np.asarray(keypoints_with_scores, dtype=np.float32).reshape(-1, 17, 3)
+
+
+def _points(keypoints, aspect_ratio):
+    # (x, y) with x scaled by width / height, so that distances and angles are isotropic.
+    points = np.empty(keypoints.shape[:-1] + (2,), dtype=np.float32)
+    points[..., 0] = keypoints[..., 1] * aspect_ratio
+    points[..., 1] = keypoints[..., 0]
+    return points
+
+
+def joint_angles(visible, points):
+    """Returns the [N, len(JOINT_ANGLES)] angles in degrees (0-180), NaN if a joint is not visible."""
+    vertex = points[:, _ANGLE_INDICES[:, 1]]
+    # Fancy indexing copies, the arms are computed in place in their own float32 arrays.
+    first = points[:, _ANGLE_INDICES[:, 0]]
+    first -= vertex
+    second = points[:, _ANGLE_INDICES[:, 2]]
+    second -= vertex
+    cross = first[..., 0] * second[..., 1]
+    cross -= first[..., 1] * second[..., 0]
+    np.abs(cross, out=cross)
+    dot = first[..., 0] * second[..., 0]
+    dot += first[..., 1] * second[..., 1]
+    angles = np.arctan2(cross, dot, out=cross)
+    np.degrees(angles, out=angles)
+    angles[~visible[:, _ANGLE_INDICES].all(axis=-1)] = np.nan
+    return angles
+
+
+def _torso_visible(visible):
+    return visible[:, _SHOULDERS].all(axis=-1) & visible[:, _HIPS].all(axis=-1)
+
+
+def _torso_vector(points):
+    # Hip midpoint to shoulder midpoint, [N, 2].
+    up = points[:, _SHOULDERS].sum(axis=1)
+    up -= points[:, _HIPS].sum(axis=1)
+    up *= 0.5
+    return up
+
+
+def torso_length(visible, points):
+    """Returns the [N] distance between the shoulder and hip midpoints, NaN without all four torso joints."""
+    up = _torso_vector(points)
+    length = np.hypot(up[:, 0], up[:, 1])
+    length[~_torso_visible(visible)] = np.nan
+    length[length == 0] = np.nan
+    return length
+
+
+def limb_lengths(visible, points, torso):
+    """Returns the [N, len(LIMB_NAMES)] limb lengths divided by the torso length."""
+    vectors = points[:, _LIMB_INDICES[:, 0]]
+    vectors -= points[:, _LIMB_INDICES[:, 1]]
+    lengths = np.hypot(vectors[..., 0], vectors[..., 1])
+    lengths /= torso[:, np.newaxis]
+    lengths[~visible[:, _LIMB_INDICES].all(axis=-1)] = np.nan
+    return lengths
+
+
+def torso_orientation(visible, points):
+    """Returns the [N] torso lean and shoulder tilt in degrees.
+
+    The lean is the angle of the hip-to-shoulder midpoint line from the image
+    vertical, positive when the shoulders are right of the hips in the image.
+    The tilt is the angle of the shoulder line from the image horizontal.
+    """
+    up = _torso_vector(points)
+    np.negative(up[:, 1], out=up[:, 1])
+    lean = np.arctan2(up[:, 0], up[:, 1])
+    np.degrees(lean, out=lean)
+    lean[~_torso_visible(visible)] = np.nan
+    across = points[:, _SHOULDERS[1]] - points[:, _SHOULDERS[0]]
+    np.abs(across[:, 0], out=across[:, 0])
+    tilt = np.arctan2(across[:, 1], across[:, 0])
+    np.degrees(tilt, out=tilt)
+    tilt[~visible[:, _SHOULDERS].all(axis=-1)] = np.nan
+    return lean, tilt
+
+
+def analyze(keypoints_with_scores, score_threshold=DEFAULT_SCORE_THRESHOLD, aspect_ratio=1.0):
+    """Computes pose features for a batch of poses with numpy only.
+
+    Args:
+        keypoints_with_scores: [N, 17, 3] (or [1, 1, 17, 3]) keypoints as (y, x, score)
+            in normalized coordinates, e.g. the MoveNet output.
+        score_threshold: A float, keypoints below this score are not visible.
+        aspect_ratio: A float, width / height of the image the coordinates are normalized
+            to. 1.0 for the predictions of the server, which are in the image padded to square.
+
+    Returns:
+        A dictionary of arrays:
+            'joint_angles': [N, len(ANGLE_NAMES)] degrees, see JOINT_ANGLES;
+            'limb_lengths': [N, len(LIMB_NAMES)] limb lengths relative to the torso length;
+            'torso_lean', 'shoulder_tilt': [N] degrees, see torso_orientation;
+            'visibility': [N, 17] bool, score above the threshold;
+            'visible_fraction': [N] fraction of the visible keypoints.
+        Features depending on a keypoint that is not visible are NaN.
+    """
+    keypoints = as_batch(keypoints_with_scores)
+    visible = keypoints[..., 2] > score_threshold
+    points = _points(keypoints, aspect_ratio)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        torso = torso_length(visible, points)
+        lean, tilt = torso_orientation(visible, points)
+        return {
+            'joint_angles': joint_angles(visible, points),
+            'limb_lengths': limb_lengths(visible, points, torso),
+            'torso_lean': lean,
+            'shoulder_tilt': tilt,
+            'visibility': visible,
+            'visible_fraction': visible.mean(axis=-1, dtype=np.float32),
+        }
+
+
+def _column(values):
+    # Rounded float64 lists (float32 values would print their binary expansion), NaN as None.
+    rounded = np.round(values.astype(np.float64), 4)
+    missing = np.isnan(rounded)
+    if not missing.any():
+        return rounded.tolist()
+    column = rounded.astype(object)
+    column[missing] = None
+    return column.tolist()
+
+
+def to_json(analytics):
+    """Converts the result of analyze into a JSON serialisable dictionary of columns.
+
+    Every feature is a list with one value per pose, the per-joint and per-limb
+    features are dictionaries of such lists keyed by name:
+    {'joint_angles': {name: [...]}, 'limb_lengths': {name: [...]},
+     'torso_lean': [...], 'shoulder_tilt': [...], 'visibility': {joint: [...]},
+     'visible_fraction': [...]}. Features that are NaN become null.
+    """
+    return {
+        'joint_angles': dict(zip(ANGLE_NAMES, _column(analytics['joint_angles'].T))),
+        'limb_lengths': dict(zip(LIMB_NAMES, _column(analytics['limb_lengths'].T))),
+        'torso_lean': _column(analytics['torso_lean']),
+        'shoulder_tilt': _column(analytics['shoulder_tilt']),
+        'visibility': dict(zip(JOINT_NAMES, analytics['visibility'].T.tolist())),
+        'visible_fraction': _column(analytics['visible_fraction']),
+    }
@@ -8,8 +8,10 @@ import boto3
 import cv2
 import imageio
 import argparse
+import time
+import tracemalloc
+import contextlib
 from io import BytesIO
-from PIL import Image
 from flask import request
 from flask import send_file
 from urllib.parse import urlparse
@@ -18,11 +20,23 @@ from botocore.client import Config
 import tensorflow as tf
 import tensorflow_hub as hub
 import numpy as np
-from matplotlib import pyplot as plt
-import matplotlib.image
 from matplotlib.collections import LineCollection
 import matplotlib.patches as patches
 from helper import *
+from model_store import (model_path, model_file, preload_model, get_interpreter, active_model,
+                         interpreter_version)
+from model_reload import create_model_watcher
+from inference_ring import InferenceRing
+import keypoint_codec
+from admission import AdmissionController, Deadline, Overloaded, DeadlineExceeded, request_deadline
+import metrics
+from jobs import JobManager, JobQueueFull, create_job_store
+from cache import LRUCache
+from capture import create_capture_writer
+import pose_analytics
+import recycling
+from preprocess_plan import get_plan
+from singleflight import SingleFlight
 cwd = os.getcwd()
 
 # Some modules to display an animation using imageio.
@@ -35,14 +49,77 @@ logging.basicConfig(
 # The flask app for serving predictions
 app = flask.Flask(__name__)
 
-prefix = "/opt/ml/"
-model_path = os.path.join(prefix, "model")
-
 region = os.environ['AWS_REGION']
 
 
 client_s3 = boto3.client('s3', region_name=region)
 
+# Bounded in-flight queue of this worker, requests beyond it are shed with a 503.
+admission = AdmissionController(
+    max_inflight=int(os.environ.get('MODEL_SERVER_MAX_INFLIGHT', 1)),
+    max_queue=int(os.environ.get('MODEL_SERVER_MAX_QUEUE', 4)))
+retry_after = os.environ.get('MODEL_SERVER_RETRY_AFTER', '1')
+
+# Last keypoints per client session, used to crop the next image of the same subject.
+session_keypoints = LRUCache(
+    max_entries=int(os.environ.get('SESSION_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('SESSION_TTL', 300)))
+
+# Asynchronous jobs, submitted with {"image_ref": ..., "async": true} and polled with {"job_id": ...}.
+# An unfinished job holds a queue place of the admission controller, a running one its slot.
+job_manager = JobManager(
+    create_job_store(),
+    max_workers=int(os.environ.get('ASYNC_JOB_WORKERS', 2)),
+    max_pending=int(os.environ.get('ASYNC_JOB_MAX_PENDING', 16)),
+    admission=admission,
+    heartbeat_interval=float(os.environ.get('ASYNC_JOB_HEARTBEAT', 30)))
+job_timeout = float(os.environ.get('ASYNC_JOB_TIMEOUT', 600))
+
+# Concurrent identical requests (same image_ref and ETag) of this worker share one prediction.
+# A sync worker never has two requests at once, there coalescing would only add a HEAD request.
+coalesce_requests = os.environ.get('MODEL_SERVER_COALESCE', 'auto').lower()
+if coalesce_requests == 'auto':
+    coalesce_requests = (int(os.environ.get('MODEL_SERVER_THREADS', 1)) > 1
+                         or os.environ.get('MODEL_SERVER_MODE', 'wsgi').lower() == 'asgi')
+else:
+    coalesce_requests = coalesce_requests in ('1', 'true', 'yes')
+in_flight = SingleFlight()
+
+# Sampled keypoints, image sizes and stage timings, written in batches when CAPTURE_DESTINATION is set.
+capture_writer = create_capture_writer()
+
+# Output image of the predictions, encoded once from the uint8 overlay.
+output_image_format = os.environ.get('OUTPUT_IMAGE_FORMAT', 'jpeg').lower()
+output_image_quality = int(os.environ.get('OUTPUT_IMAGE_QUALITY', 90))
+output_image_size = int(os.environ.get('OUTPUT_IMAGE_SIZE', 1280))
+OUTPUT_FORMATS = {
+    'jpeg': {'extension': '.jpeg', 'content_type': 'image/jpeg', 'quality_flag': cv2.IMWRITE_JPEG_QUALITY},
+    'webp': {'extension': '.webp', 'content_type': 'image/webp', 'quality_flag': cv2.IMWRITE_WEBP_QUALITY},
+}
+if output_image_format not in OUTPUT_FORMATS:
+    raise ValueError(f"OUTPUT_IMAGE_FORMAT {output_image_format}, expected one of {sorted(OUTPUT_FORMATS)}")
+
+# Body of the 400 answer to an application/x-npy invocation, the endpoint only takes JSON image references.
+INVALID_JSON_OUTCOME = {
+    "resourceType": "OperationOutcome",
+    "issue": [
+        {
+            "severity": "error",
+            "code": "invalid",
+            "diagnostics": "Invalid JSON format",
+            "details": {
+                "text": "The JSON format is invalid. Please ensure that the request body contains valid JSON."
+            }
+        }
+    ]
+}
+
+# With MODEL_SERVER_TRACE_ALLOCATIONS the peak Python/numpy allocations of every request are exported.
+trace_allocations = os.environ.get('MODEL_SERVER_TRACE_ALLOCATIONS', 'false').lower() == 'true'
+if trace_allocations:
+    tracemalloc.start()
+
+
 def create_presigned_url(bucket_name, object_name, expiration=3600):
     """Generate a presigned URL for accessing an S3 object
     
@@ -69,32 +146,72 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
     return response
 
 
+# Map the model once; with MODEL_SERVER_PRELOAD this runs in the gunicorn master.
+preload_model()
+
+# With MODEL_SERVER_INFERENCE=ring the workers hand the preprocessed images to a
+# single inference process through shared memory; serve preloads the app for it.
+inference_ring = None
+if os.environ.get('MODEL_SERVER_INFERENCE', 'worker') == 'ring':
+    inference_ring = InferenceRing(
+        num_slots=int(os.environ.get('INFERENCE_RING_SLOTS', 16)),
+        input_shape=(input_size, input_size, 3),
+        max_batch=int(os.environ.get('INFERENCE_RING_MAX_BATCH', 4)),
+        timeout=float(os.environ.get('MODEL_SERVER_TIMEOUT', 60)))
+    inference_ring.start(model_file, num_threads=int(os.environ.get('INFERENCE_RING_THREADS', os.cpu_count())))
+
+# New model versions under MODEL_RELOAD_SOURCE are validated and activated in every worker.
+model_watcher = create_model_watcher(input_size)
+if model_watcher is not None and inference_ring is not None:
+    logging.warning("MODEL_RELOAD_SOURCE is ignored with MODEL_SERVER_INFERENCE=ring")
+    model_watcher = None
+
+
 def load_model():
-    """load a TensorFlow Lite model file located at the specified path"""
-    path = os.path.join(model_path, 'model.tflite')
-    logging.info(f"Model Path, {path}")
-    interpreter = tf.lite.Interpreter(model_path=path)
-    interpreter.allocate_tensors()
-    return interpreter
+    """Returns the TensorFlow Lite interpreter of the current worker, created on first use"""
+    if model_watcher is not None:
+        model_watcher.ensure_started()
+    return get_interpreter()
+
+
+def warm_up():
+    """Creates the interpreter of the calling thread and runs one inference on a blank image.
+
+    Called by gunicorn_config.post_worker_init before the worker accepts requests.
+    """
+    started = time.monotonic()
+    predict_movenet_for_image(tf.zeros((1, input_size, input_size, 3), dtype=tf.uint8))
+    metrics.observe('worker_warmup_seconds', time.monotonic() - started)
 
 
-def predict_movenet_for_image(input_image):
+def predict_movenet_for_image(input_image, deadline=None):
     """Runs detection on an input image.
 
     Args:
         input_image: A [1, height, width, 3] tensor represents the input image
         pixels. Note that the height/width should already be resized and match the
         expected input resolution of the model before passing into this function.
+        deadline: An optional Deadline, bounds the wait for the inference ring.
 
     Returns:
         A [1, 1, 17, 3] float numpy array representing the predicted keypoint
         coordinates and scores.
     """
+    # TF Lite format expects tensor type of uint8.
+    input_image = tf.cast(input_image, dtype=tf.uint8)
+    if inference_ring is not None:
+        timeout = None if deadline is None else max(deadline.remaining(), 0)
+        try:
+            return inference_ring.infer(input_image.numpy()[0], timeout=timeout)
+        except TimeoutError:
+            if deadline is None:
+                raise
+            metrics.increment('invocations_deadline_exceeded_total', stage='inference')
+            raise DeadlineExceeded('inference')
+
     # load the model
     interpreter = load_model()
     
-    # TF Lite format expects tensor type of uint8.
-    input_image = tf.cast(input_image, dtype=tf.uint8)
     input_details = interpreter.get_input_details()
     output_details = interpreter.get_output_details()
     interpreter.set_tensor(input_details[0]['index'], input_image.numpy())
@@ -108,19 +225,176 @@ def predict_movenet_for_image(input_image):
     return keypoints_with_scores
 
 
-def load_input_image_resize_pad(image_path):
-    """Loads image, resizes and pads it to keep the aspect ratio."""
-    image = tf.io.read_file(image_path)
-    image = tf.image.decode_jpeg(image)
-    
-    # Resize and pad the image to keep the aspect ratio and fit the expected size.
+def predict_movenet_for_session(image, session_id, deadline=None):
+    """Runs detection on a crop around the subject of the previous image of the session.
+
+    The crop region is determined from the keypoints the session stored last;
+    unknown or expired sessions start from init_crop_region, the full image
+    padded to square.
+
+    Args:
+        image: A [height, width, 3] tensor representing the original image.
+        session_id: A string identifying the client session.
+        deadline: An optional Deadline, see predict_movenet_for_image.
+
+    Returns:
+        A [1, 1, 17, 3] float numpy array with the keypoints in the coordinates of the original image.
+    """
+    image_height, image_width, _ = image.shape
+    plan = get_plan(image_height, image_width, input_size)
+    previous_keypoints = session_keypoints.get(session_id)
+    if previous_keypoints is None:
+        crop_region = plan.crop_region
+    else:
+        crop_region = determine_crop_region(previous_keypoints, image_height, image_width,
+                                            default_region=plan.crop_region)
+    keypoints_with_scores = run_inference(
+        lambda input_image: predict_movenet_for_image(input_image, deadline=deadline), image, crop_region,
+        crop_size=[input_size, input_size])
+    session_keypoints.put(session_id, keypoints_with_scores)
+    return keypoints_with_scores
+
+
+def resize_pad_input_image(image):
+    """Resizes and pads a decoded [height, width, 3] image to the model input, keeping the aspect ratio.
+
+    The model input keeps tf.image.resize_with_pad, the resize the keypoint
+    baselines were recorded with; only the display letterbox uses the plans.
+    """
     input_image = tf.expand_dims(image, axis=0)
     input_image = tf.image.resize_with_pad(input_image, input_size, input_size)
+    return input_image
+
+
+def decode_input_image(data):
+    """Decodes JPEG bytes and resizes and pads the image to keep the aspect ratio."""
+    image = tf.image.decode_jpeg(data)
+    return resize_pad_input_image(image), image
+
+
+def load_input_image_resize_pad(image_path):
+    """Loads image, resizes and pads it to keep the aspect ratio."""
+    return decode_input_image(tf.io.read_file(image_path))
+
+
+def render_prediction(image, keypoints_with_scores, size=None):
+    """Draws the keypoints on the original image letterboxed to a size x size square.
+
+    The image stays uint8 from decoding to the overlay, and is letterboxed into
+    the display buffer of the calling thread.
+
+    Args:
+        image: A [height, width, 3] uint8 tensor or numpy array representing the original image.
+        keypoints_with_scores: The [1, 1, 17, 3] keypoints in the coordinates of the image padded to square.
+        size: The side of the output image in pixels, OUTPUT_IMAGE_SIZE by default.
+
+    Returns:
+        A uint8 numpy array with shape [size, size, 3] representing the overlay image.
+    """
+    size = size or output_image_size
+    display_image = letterbox(np.asarray(image, dtype=np.uint8), size, reuse_buffer=True)
+    return draw_prediction_on_image(display_image, keypoints_with_scores, output_image_height=size)
 
-    return input_image, image
 
+def encode_overlay(output_overlay, image_format=None, quality=None):
+    """Encodes the RGB overlay image once with OpenCV (libjpeg-turbo for JPEG, libwebp for WebP).
 
-def prediction(input_image, image, filename, bucket):
+    Args:
+        output_overlay: A [height, width, 3] uint8 RGB numpy array.
+        image_format: 'jpeg' or 'webp', OUTPUT_IMAGE_FORMAT by default.
+        quality: The encoder quality 1-100, OUTPUT_IMAGE_QUALITY by default.
+
+    Returns:
+        The encoded image as bytes.
+    """
+    output_format = OUTPUT_FORMATS[image_format or output_image_format]
+    bgr_overlay = cv2.cvtColor(output_overlay, cv2.COLOR_RGB2BGR)
+    ok, encoded = cv2.imencode(output_format['extension'], bgr_overlay,
+                               [output_format['quality_flag'], quality or output_image_quality])
+    if not ok:
+        raise RuntimeError(f"Could not encode the overlay as {output_format['extension']}")
+    return encoded.tobytes()
+
+
+@contextlib.contextmanager
+def timed_stage(timings, stage):
+    """Measures the duration of a request stage into timings and the stage latency histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.observe('stage_latency_seconds', seconds, stage=stage)
+        if timings is not None:
+            timings[stage] = seconds
+
+
+def predict_and_render(input_image, image, deadline=None, session_id=None, timings=None):
+    """Runs the CPU-bound stages of a prediction: inference, rendering and encoding of the overlay.
+
+    Args:
+        input_image: The [1, input_size, input_size, 3] input image, resized and padded.
+        image: The [height, width, 3] original image.
+        deadline: An optional Deadline, checked before the rendering.
+        session_id: An optional string, consecutive images of a session run on a crop around the subject.
+        timings: An optional dictionary receiving the duration in seconds of every stage.
+
+    Returns:
+        The encoded overlay image as bytes and the [1, 1, 17, 3] keypoints with scores
+        in the coordinates of the image padded to square.
+    """
+    with timed_stage(timings, 'inference'):
+        if session_id is None:
+            keypoints_with_scores = predict_movenet_for_image(input_image, deadline=deadline)
+        else:
+            image_height, image_width, _ = image.shape
+            keypoints_with_scores = get_plan(image_height, image_width, input_size).to_square_coordinates(
+                predict_movenet_for_session(image, session_id, deadline=deadline))
+
+    if deadline is not None:
+        deadline.check('render')
+    # Visualize the predictions with image.
+    with timed_stage(timings, 'render'):
+        output_overlay = render_prediction(image, keypoints_with_scores)
+
+    with timed_stage(timings, 'encode'):
+        body = encode_overlay(output_overlay)
+    return body, keypoints_with_scores
+
+
+def split_image_ref(input_path):
+    """Returns the bucket, the key and the file name of an s3://bucket/key image reference."""
+    objectPath = urlparse(input_path)
+    return objectPath.netloc, objectPath.path[1:], os.path.basename(objectPath.path)
+
+
+def prediction_output(filename):
+    """Returns the S3 key and the OUTPUT_FORMATS entry of the predicted image of an input file."""
+    output_format = OUTPUT_FORMATS[output_image_format]
+    return f"prediction/{filename}-predicted{output_format['extension']}", output_format
+
+
+def prediction_result(keypoints_with_scores, image, analytics=False, timings=None):
+    """Builds the result of predict_image_ref, without the URL of the predicted image.
+
+    Also records the prediction with the capture writer and computes the pose
+    features when analytics is set. Shared by the Flask and the ASGI server.
+    """
+    image_height, image_width, _ = image.shape
+    # The version of the model this thread ran, a reload may have activated another one since.
+    result = {"keypoints": keypoints_with_scores.tolist(), "image_height": int(image_height),
+              "image_width": int(image_width), "model_version": interpreter_version()}
+    if capture_writer is not None:
+        capture_writer.record(keypoints_with_scores, int(image_height), int(image_width), result["model_version"],
+                              timings)
+    if analytics:
+        # The keypoints are normalized to the input padded to a square, the aspect ratio is 1.
+        with timed_stage(timings, 'analytics'):
+            result["analytics"] = pose_analytics.to_json(pose_analytics.analyze(keypoints_with_scores))
+    return result
+
+
+def prediction(input_image, image, filename, bucket, deadline=None, session_id=None, timings=None):
     
     """Takes an input image and uses a machine learning model (MoveNet) to predict keypoints with scores for that image. 
     It then visualizes the predictions on the original image and saves the resulting image to an S3 bucket. 
@@ -131,31 +405,112 @@ def prediction(input_image, image, filename, bucket):
         image: A NumPy array representing the original image.
         filename: A string representing the name of the file to be saved.
         bucket: A string representing the name of the S3 bucket where the predicted image is to be stored.
+        deadline: An optional Deadline, the remaining stages are skipped once it has passed.
+        session_id: An optional string, consecutive images of a session run on a crop around the subject.
+        timings: An optional dictionary receiving the duration in seconds of every stage.
     
     Returns:
-        A pre-signed URL (string) for the predicted image.
+        A pre-signed URL (string) for the predicted image and the [1, 1, 17, 3] keypoints with scores
+        in the coordinates of the image padded to square.
     
     """
 
-    keypoints_with_scores = predict_movenet_for_image(input_image)
+    body, keypoints_with_scores = predict_and_render(
+        input_image, image, deadline=deadline, session_id=session_id, timings=timings)
+    if deadline is not None:
+        deadline.check('upload')
+    output_file, output_format = prediction_output(filename)
+    with timed_stage(timings, 'upload'):
+        client_s3.put_object(Bucket=bucket, Key=output_file, Body=body, ContentType=output_format['content_type'])
+        pre_singed_url = create_presigned_url(bucket, output_file, expiration=3600)
+    return pre_singed_url, keypoints_with_scores
 
-    # Visualize the predictions with image.
-    display_image = tf.expand_dims(image, axis=0)
-    display_image = tf.cast(tf.image.resize_with_pad(
-        display_image, 1280, 1280), dtype=tf.int32)
-    output_overlay = draw_prediction_on_image(
-        np.squeeze(display_image.numpy(), axis=0), keypoints_with_scores)
-    
-    output_file_name = f'{filename}-predicted.jpeg'
-    matplotlib.image.imsave(output_file_name, output_overlay)
-    image_in = Image.fromarray(output_overlay).convert("RGB")
-    buffer = io.BytesIO()
-    image_in.save(buffer, format = 'jpeg')
-    buffer.seek(0)    
-    output_file = f"prediction/{output_file_name}"
-    client_s3.put_object(Bucket=bucket, Key=output_file, Body=buffer, ContentType='image/jpeg')
-    pre_singed_url = create_presigned_url(bucket, output_file, expiration=3600)
-    return pre_singed_url
+
+def predict_image_ref(input_path, deadline=None, session_id=None, analytics=False, etag=None):
+    """Runs the prediction for an image stored in S3.
+
+    Args:
+        input_path: A string representing the s3://bucket/key URI of the input image.
+        deadline: An optional Deadline, the remaining stages are skipped once it has passed.
+        session_id: An optional string identifying the client session, see predict_movenet_for_session.
+        analytics: A boolean, adds the pose features of pose_analytics.analyze ('analytics').
+        etag: An optional string, the ETag the input object must have, see coalesced_predict_image_ref.
+
+    Returns:
+        A dictionary with the pre-signed URL of the predicted image ('predicted_image'),
+        the keypoints with scores as a nested [1, 1, 17, 3] list ('keypoints'), the
+        size of the input image ('image_height', 'image_width') and the version of the
+        model that ran ('model_version').
+    """
+    bucket, key, file_name = split_image_ref(input_path)
+
+    logging.info(f"bucket, {bucket}")
+    logging.info(f"Object key, {key}")
+    logging.info(f"File Name, {file_name}")
+
+    timings = {}
+    if deadline is not None:
+        deadline.check('download')
+    # The input is decoded from memory, nothing is written to the local disk.
+    with timed_stage(timings, 'download'):
+        if etag is not None:
+            data = client_s3.get_object(Bucket=bucket, Key=key, IfMatch=etag)['Body'].read()
+        else:
+            data = client_s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+    if deadline is not None:
+        deadline.check('inference')
+    with timed_stage(timings, 'preprocess'):
+        input_image, image = decode_input_image(data)
+    pre_singed_url, keypoints_with_scores = prediction(
+        input_image, image, file_name, bucket, deadline=deadline, session_id=session_id, timings=timings)
+    return {"predicted_image": pre_singed_url,
+            **prediction_result(keypoints_with_scores, image, analytics=analytics, timings=timings)}
+
+
+def coalesced_predict_image_ref(input_path, deadline=None, session_id=None, analytics=False, admit=None):
+    """Runs predict_image_ref once for the concurrent identical requests of this worker.
+
+    Requests are identical when they have the same image_ref, ETag of the input
+    object, session and analytics flag; the ETag comes from a HEAD request and
+    the download is conditional on it, so a replaced object is never shared.
+    The first request does the work, the others wait for its result or error.
+
+    Args:
+        input_path: A string representing the s3://bucket/key URI of the input image.
+        deadline: An optional Deadline of the request, see predict_image_ref.
+        session_id: An optional string identifying the client session.
+        analytics: A boolean, adds the pose features to the result.
+        admit: An optional context manager factory taking the deadline, entered around the work,
+            e.g. admission.admit; the waiting requests do not take a slot.
+
+    Returns:
+        The result of predict_image_ref, shared by the coalesced requests.
+    """
+    def run(etag=None):
+        with admit(deadline) if admit is not None else contextlib.nullcontext():
+            return predict_image_ref(input_path, deadline=deadline, session_id=session_id, analytics=analytics,
+                                     etag=etag)
+
+    if not coalesce_requests:
+        return run()
+    bucket, key, _ = split_image_ref(input_path)
+    if deadline is not None:
+        deadline.check('head')
+    with timed_stage(None, 'head'):
+        etag = client_s3.head_object(Bucket=bucket, Key=key)['ETag']
+    return in_flight.do((input_path, etag, session_id, analytics), lambda: run(etag), deadline=deadline)
+
+
+def predict_job(input_path, session_id=None, analytics=False):
+    """Runs an asynchronous job like a synchronous request, in a slot of the worker's admission controller.
+
+    The job already holds its queue place (JobManager.submit reserved it), it
+    waits up to ASYNC_JOB_TIMEOUT seconds for a slot.
+    """
+    return coalesced_predict_image_ref(input_path, deadline=Deadline(job_timeout), session_id=session_id,
+                                       analytics=analytics,
+                                       admit=lambda deadline: admission.admit(deadline, reserved=True))
 
 
 @app.route("/ping", methods=["GET"])
@@ -166,7 +521,21 @@ def ping():
     load_model()
     logging.info("Model loaded")
     status = 200
-    return flask.Response(response="\n", status=status, mimetype="application/json")
+    # Without its inference process a ring server cannot answer, let SageMaker replace the instance.
+    if inference_ring is not None and not inference_ring.alive():
+        status = 500
+    generation, _, version = active_model()
+    return flask.Response(response=json.dumps({"model_version": version, "model_generation": generation}),
+                          status=status, mimetype="application/json", headers={'X-Model-Version': version})
+
+
+@app.route("/metrics", methods=["GET"])
+def worker_metrics():
+    """Exports the metrics of the worker serving the request in the Prometheus text format."""
+    # Recycled workers are counted by the master, for the whole server.
+    for reason, count in recycling.recycle_counts().items():
+        metrics.set_gauge('worker_recycles_total', count, reason=reason)
+    return flask.Response(response=metrics.render(), status=200, mimetype="text/plain")
 
 
 @app.route("/invocations", methods=["POST"])
@@ -183,46 +552,71 @@ def inference():
     if flask.request.content_type == "application/x-npy":
         input_data = flask.request.data
         logging.info(f"input_data, {input_data}")
-        result = {
-            "resourceType": "OperationOutcome",
-            "issue": [
-                {
-                            "severity": "error",
-                            "code": "invalid",
-                            "diagnostics": "Invalid JSON format",
-                            "details": {
-                                "text": "The JSON format is invalid. Please ensure that the request body contains valid JSON."
-                            }
-                }
-            ]
-        }
-
-        return flask.Response(response=result, status=400, mimetype="application/json")
+        return flask.Response(response=json.dumps(INVALID_JSON_OUTCOME), status=400, mimetype="application/json")
 
     elif flask.request.content_type == "application/json":
         logging.info(f"Flask request data, {flask.request.data}")
         json_data = json.loads(flask.request.data)
         logging.info(f"json data, {json_data}")
+        if "job_id" in json_data:
+            job = job_manager.status(json_data["job_id"])
+            if job is None:
+                return flask.Response(response=json.dumps({"job_id": json_data["job_id"], "status": "unknown"}),
+                                      status=404, mimetype="application/json")
+            return flask.Response(response=json.dumps(job), status=200, mimetype="application/json")
+
         input_path = json_data["image_ref"]
         logging.info(f"input_path, {input_path}")
-        objectPath = urlparse(input_path)
-        bucket = objectPath.netloc
-        key = objectPath.path[1:]
-        file_name = os.path.basename(objectPath.path)
-
-        logging.info(f"bucket, {bucket}")
-        logging.info(f"Object key, {key}")
-        logging.info(f"File Name, {file_name}")
-
-        preSignedUrl = create_presigned_url(bucket, key)
-        urllib.request.urlretrieve(preSignedUrl, file_name)
-
-        input_image, image = load_input_image_resize_pad(file_name)
-        result = prediction(input_image, image, file_name, bucket)
-
-        result = json.dumps(result)
-
-        return flask.Response(response=result, status=200, mimetype="application/json")
+        session_id = json_data.get("session_id") or flask.request.headers.get("X-Session-Id")
+        analytics = bool(json_data.get("analytics"))
+
+        if json_data.get("async"):
+            try:
+                job_id = job_manager.submit(predict_job, input_path, session_id=session_id, analytics=analytics)
+            except (JobQueueFull, Overloaded):
+                return flask.Response(response=json.dumps("Server overloaded, retry later"), status=503,
+                                      mimetype="application/json", headers={'Retry-After': retry_after})
+            # SageMaker only relays 200 responses of the container, the status field tells the job is pending.
+            return flask.Response(response=json.dumps({"job_id": job_id, "status": "pending"}),
+                                  status=200, mimetype="application/json")
+
+        deadline = request_deadline(flask.request.headers)
+        started = time.monotonic()
+        if trace_allocations:
+            tracemalloc.reset_peak()
+        try:
+            result = coalesced_predict_image_ref(input_path, deadline=deadline, session_id=session_id,
+                                                 analytics=analytics, admit=admission.admit)
+        except Overloaded:
+            return flask.Response(response=json.dumps("Server overloaded, retry later"), status=503,
+                                  mimetype="application/json", headers={'Retry-After': retry_after})
+        except DeadlineExceeded as e:
+            logging.info(f"Dropped request, {e}")
+            return flask.Response(response=json.dumps(str(e)), status=504, mimetype="application/json")
+        metrics.observe('invocations_latency_seconds', time.monotonic() - started)
+        if trace_allocations:
+            # Peak of the worker since the reset, it covers concurrent requests with MODEL_SERVER_THREADS > 1.
+            metrics.observe('invocations_peak_allocated_bytes', tracemalloc.get_traced_memory()[1],
+                            buckets=metrics.ALLOCATION_BUCKETS)
+
+        # Keypoint clients can ask for a compact binary body through Accept.
+        binary_content_type = keypoint_codec.negotiate(flask.request.headers.get("Accept"))
+        if binary_content_type is not None:
+            body = keypoint_codec.encode_response(
+                binary_content_type, result["keypoints"], result["image_height"], result["image_width"],
+                result["model_version"])
+            return flask.Response(response=body, status=200, mimetype=binary_content_type,
+                                  headers={'X-Predicted-Image': result["predicted_image"],
+                                           'X-Model-Version': result["model_version"]})
+
+        model_version_header = {'X-Model-Version': result["model_version"]}
+        if analytics:
+            result = json.dumps({"predicted_image": result["predicted_image"], "analytics": result["analytics"],
+                                 "model_version": result["model_version"]})
+        else:
+            result = json.dumps(result["predicted_image"])
+
+        return flask.Response(response=result, status=200, mimetype="application/json", headers=model_version_header)
 
     else:
         return flask.Response(response="This predictor only images of size 256", status=415, mimetype="application/json")
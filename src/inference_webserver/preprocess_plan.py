@@ -0,0 +1,126 @@
+import os
+import threading
+
+import numpy as np
+import cv2
+
+import metrics
+from cache import LRUCache
+
+
+def square_crop_region(image_height, image_width):
+    """Returns the region of the full image padded from both sides to a square, in normalized coordinates."""
+    if image_width > image_height:
+        box_height = image_width / image_height
+        box_width = 1.0
+        y_min = (image_height / 2 - image_width / 2) / image_height
+        x_min = 0.0
+    else:
+        box_height = 1.0
+        box_width = image_height / image_width
+        y_min = 0.0
+        x_min = (image_width / 2 - image_height / 2) / image_width
+
+    return {
+        'y_min': y_min,
+        'x_min': x_min,
+        'y_max': y_min + box_height,
+        'x_max': x_min + box_width,
+        'height': box_height,
+        'width': box_width
+    }
+
+
+class PreprocessPlan:
+    """Geometry of fitting one image resolution into a size x size square, computed once.
+
+    It holds the resize scale, interpolation and pad offsets of the letterbox
+    (the geometry of tf.image.resize_with_pad), the crop region of the image
+    padded to square and its inverse-remap coefficients. The plan is shared by
+    all the images of that resolution and must not be modified.
+    """
+
+    def __init__(self, image_height, image_width, size):
+        self.image_height = image_height
+        self.image_width = image_width
+        self.size = size
+        self.scale = min(size / image_height, size / image_width)
+        self.resized_height = max(1, int(round(image_height * self.scale)))
+        self.resized_width = max(1, int(round(image_width * self.scale)))
+        self.interpolation = cv2.INTER_AREA if self.scale < 1 else cv2.INTER_LINEAR
+        self.top = (size - self.resized_height) // 2
+        self.left = (size - self.resized_width) // 2
+        self.crop_region = square_crop_region(image_height, image_width)
+        # Image coordinates to the coordinates of the image padded to square: (y - offset) * scale.
+        self.square_offset = np.array([self.crop_region['y_min'], self.crop_region['x_min']], dtype=np.float32)
+        self.square_scale = np.array([1.0 / self.crop_region['height'], 1.0 / self.crop_region['width']],
+                                     dtype=np.float32)
+
+    def letterbox(self, image, reuse_buffer=False):
+        """Resizes a uint8 [height, width, 3] image of the plan's resolution into the padded square.
+
+        Args:
+            image: A uint8 numpy array with the shape of the plan.
+            reuse_buffer: A boolean, writes into the buffer of the calling thread for the output size
+                instead of a new array; the result is only valid until the thread's next call with
+                reuse_buffer and the same size.
+
+        Returns:
+            A uint8 numpy array with shape [size, size, 3].
+        """
+        if reuse_buffer:
+            output = _thread_buffer(self)
+        else:
+            output = np.zeros((self.size, self.size, 3), dtype=np.uint8)
+        inner = output[self.top:self.top + self.resized_height, self.left:self.left + self.resized_width]
+        resized = cv2.resize(np.asarray(image, dtype=np.uint8), (self.resized_width, self.resized_height),
+                             dst=inner, interpolation=self.interpolation)
+        if not np.shares_memory(resized, output):
+            inner[...] = resized
+        return output
+
+    def to_square_coordinates(self, keypoints_with_scores):
+        """Maps keypoints from image coordinates into the coordinates of the image padded to square.
+
+        Same as helper.keypoints_to_crop_coordinates with the region of init_crop_region.
+        """
+        keypoints = np.array(keypoints_with_scores, dtype=np.float32, copy=True)
+        keypoints[..., :2] = (keypoints[..., :2] - self.square_offset) * self.square_scale
+        return keypoints
+
+
+# Letterbox buffers of every thread, one per output size whatever the resolution,
+# with the plan that last wrote each: {size: (plan, buffer)}.
+_buffers = threading.local()
+
+
+def _thread_buffer(plan):
+    """Returns the calling thread's buffer of the plan's size, with black borders for the plan's geometry."""
+    by_size = getattr(_buffers, 'by_size', None)
+    if by_size is None:
+        by_size = _buffers.by_size = {}
+    owner, output = by_size.get(plan.size, (None, None))
+    if output is None:
+        output = np.zeros((plan.size, plan.size, 3), dtype=np.uint8)
+    elif owner is not plan:
+        # Another resolution left pixels where this plan's borders are.
+        output.fill(0)
+    by_size[plan.size] = (plan, output)
+    return output
+
+
+# Plans of the recent resolutions, every resolution has one per output size (model input, display).
+plans = LRUCache(max_entries=int(os.environ.get('PREPROCESS_PLAN_CACHE_SIZE', 64)))
+
+
+def get_plan(image_height, image_width, size):
+    """Returns the cached plan of the resolution and square size, creating it on the first use."""
+    key = (int(image_height), int(image_width), int(size))
+    plan = plans.get(key)
+    if plan is None:
+        metrics.increment('preprocess_plan_lookups_total', result='miss')
+        plan = PreprocessPlan(*key)
+        plans.put(key, plan)
+    else:
+        metrics.increment('preprocess_plan_lookups_total', result='hit')
+    return plan
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import random
+import signal
+import logging
+import threading
+
+import metrics
+
+# Shared by the gunicorn master and its workers, cleared when the server starts.
+RECYCLE_DIR = os.environ.get('MODEL_SERVER_RECYCLE_DIR', '/tmp/worker-recycle')
+# Only one worker is replaced at a time, so that the server never runs more than one extra worker.
+_LOCK_FILE = 'recycling.lock'
+_COUNTS_FILE = 'recycles.json'
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_bytes(pid='self'):
+    """Returns the resident set size of a process in bytes."""
+    with open(f'/proc/{pid}/statm', 'r') as statm:
+        return int(statm.read().split()[1]) * _PAGE_SIZE
+
+
+def _marker(directory, pid, state='pending'):
+    return os.path.join(directory, f'{pid}.{state}')
+
+
+class WorkerRecycler:
+    """Replaces a gunicorn worker once its RSS or request count passes a limit.
+
+    After every request the worker compares its RSS with max_rss_bytes and its
+    request count with max_requests (plus a random jitter, so that the workers
+    do not all recycle together). The first time a limit is passed it writes a
+    marker and asks the master for one more worker (SIGTTIN), then keeps
+    serving. The new worker warms up and only then stops the old one gracefully
+    (see replace_recycled_workers), and the master drops the extra worker again
+    when the old one exits (see worker_exited). A worker still running
+    recycle_timeout seconds after its request stops by itself.
+    """
+
+    def __init__(self, max_rss_bytes=0, max_requests=0, max_requests_jitter=0, recycle_timeout=120.0,
+                 directory=RECYCLE_DIR):
+        self.max_rss_bytes = max_rss_bytes
+        self.max_requests = max_requests + random.randint(0, max_requests_jitter) if max_requests else 0
+        self.recycle_timeout = recycle_timeout
+        self.directory = directory
+        self.requests = 0
+        self.baseline_rss = None
+        self.peak_rss = 0
+        self.started_at = time.monotonic()
+        self.requested_at = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Records the RSS of the warm worker, the growth is measured from it."""
+        self.baseline_rss = rss_bytes()
+        self.started_at = time.monotonic()
+        metrics.set_gauge('worker_baseline_rss_bytes', self.baseline_rss)
+
+    def after_request(self, worker):
+        """Updates the memory metrics and starts the recycling once a limit is passed.
+
+        Args:
+            worker: The gunicorn worker, its ppid is the master and alive=False stops it gracefully.
+        """
+        rss = rss_bytes()
+        with self._lock:
+            self.requests += 1
+            self.peak_rss = max(self.peak_rss, rss)
+            requests, requested_at = self.requests, self.requested_at
+        metrics.set_gauge('worker_rss_bytes', rss)
+        metrics.set_gauge('worker_peak_rss_bytes', self.peak_rss)
+        metrics.set_gauge('worker_requests_served', requests)
+        if self.baseline_rss is not None:
+            metrics.observe('worker_rss_growth_bytes', max(rss - self.baseline_rss, 0),
+                            buckets=metrics.ALLOCATION_BUCKETS)
+
+        if requested_at is not None:
+            if time.monotonic() - requested_at > self.recycle_timeout:
+                logging.warning(f"No replacement within {self.recycle_timeout}s, worker {os.getpid()} stops itself")
+                worker.alive = False
+            return
+        if self.max_rss_bytes and rss > self.max_rss_bytes:
+            self.request_recycle(worker, 'rss', rss)
+        elif self.max_requests and requests >= self.max_requests:
+            self.request_recycle(worker, 'requests', rss)
+
+    def request_recycle(self, worker, reason, rss):
+        """Asks the master for a replacement of this worker; returns False if another recycle is running."""
+        try:
+            lock = os.open(os.path.join(self.directory, _LOCK_FILE), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(lock, 'w') as lockfile:
+            lockfile.write(str(os.getpid()))
+        with open(_marker(self.directory, os.getpid()), 'w') as marker:
+            marker.write(json.dumps({'reason': reason, 'rss_bytes': rss, 'requests': self.requests,
+                                     'age_seconds': time.monotonic() - self.started_at}))
+        with self._lock:
+            self.requested_at = time.monotonic()
+        metrics.increment('worker_recycle_requests_total', reason=reason)
+        logging.info(f"Worker {os.getpid()} requests a replacement, {reason}: rss {rss} bytes, "
+                     f"{self.requests} requests")
+        os.kill(worker.ppid, signal.SIGTTIN)
+        return True
+
+
+# The gunicorn worker of this process, set by gunicorn_config.post_worker_init.
+_worker = None
+
+
+def set_worker(worker):
+    global _worker
+    _worker = worker
+
+
+def after_request():
+    """Runs the recycler of the worker process, for worker classes without the post_request hook (uvicorn)."""
+    recycler = getattr(_worker, 'recycler', None)
+    if recycler is not None:
+        recycler.after_request(_worker)
+
+
+def create_worker_recycler():
+    """Returns the WorkerRecycler configured by MODEL_SERVER_MAX_RSS_MB and MODEL_SERVER_MAX_REQUESTS."""
+    return WorkerRecycler(
+        max_rss_bytes=int(float(os.environ.get('MODEL_SERVER_MAX_RSS_MB', 0)) * 1024 * 1024),
+        max_requests=int(os.environ.get('MODEL_SERVER_MAX_REQUESTS', 0)),
+        max_requests_jitter=int(os.environ.get('MODEL_SERVER_MAX_REQUESTS_JITTER', 0)),
+        recycle_timeout=float(os.environ.get('MODEL_SERVER_RECYCLE_TIMEOUT', 120)))
+
+
+def replace_recycled_workers(directory=RECYCLE_DIR):
+    """Stops the workers waiting for a replacement; called by a new worker once it is warm.
+
+    Returns:
+        The pids of the workers that were sent SIGTERM, they finish their requests and exit.
+    """
+    stopped = []
+    for name in os.listdir(directory):
+        if not name.endswith('.pending'):
+            continue
+        pid = int(name.split('.')[0])
+        try:
+            # Several workers can start at once, the rename lets exactly one of them stop the old worker.
+            os.rename(os.path.join(directory, name), _marker(directory, pid, 'draining'))
+        except FileNotFoundError:
+            continue
+        try:
+            os.kill(pid, signal.SIGTERM)
+            stopped.append(pid)
+        except ProcessLookupError:
+            pass
+    return stopped
+
+
+def recycled_pids(directory=RECYCLE_DIR):
+    """Returns the pids of the workers waiting for a replacement or draining."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return set()
+    return {int(name.split('.')[0]) for name in names if name.endswith(('.pending', '.draining'))}
+
+
+def reset(directory=RECYCLE_DIR):
+    """Clears the markers of a previous server and the recycle counts; called by the master on start."""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+
+
+def worker_exited(server, worker, directory=RECYCLE_DIR):
+    """Completes the recycling of a worker; called by the master when a worker exited.
+
+    Args:
+        server: The gunicorn arbiter.
+        worker: The worker that exited.
+
+    Returns:
+        The marker of the recycled worker, or None if it was not being recycled.
+    """
+    marker = None
+    for state in ('pending', 'draining'):
+        path = _marker(directory, worker.pid, state)
+        if os.path.exists(path):
+            with open(path, 'r') as infile:
+                marker = json.loads(infile.read())
+            os.remove(path)
+    if marker is None:
+        return None
+    lock = os.path.join(directory, _LOCK_FILE)
+    if os.path.exists(lock):
+        os.remove(lock)
+    # The replacement was added with SIGTTIN, go back to the configured number of workers.
+    if server.num_workers > server.cfg.workers:
+        server.num_workers -= 1
+    counts = recycle_counts(directory)
+    counts[marker['reason']] = counts.get(marker['reason'], 0) + 1
+    path = os.path.join(directory, _COUNTS_FILE)
+    with open(path + '.tmp', 'w') as outfile:
+        outfile.write(json.dumps(counts))
+    os.replace(path + '.tmp', path)
+    server.log.info(f"Recycled worker {worker.pid} ({marker['reason']}): rss {marker['rss_bytes']} bytes, "
+                    f"{marker['requests']} requests, {marker['age_seconds']:.0f}s old")
+    return marker
+
+
+def recycle_counts(directory=RECYCLE_DIR):
+    """Returns the number of recycled workers of the server per reason."""
+    try:
+        with open(os.path.join(directory, _COUNTS_FILE), 'r') as infile:
+            return json.loads(infile.read())
+    except (FileNotFoundError, ValueError):
+        return {}
@@ -0,0 +1,163 @@
+import copy
+import time
+import asyncio
+import threading
+
+import metrics
+from admission import DeadlineExceeded, Overloaded
+
+# Errors about the leader's own budget or slot, not about the work: the followers retry instead.
+CALLER_ERRORS = (DeadlineExceeded, Overloaded)
+_RETRY = object()
+
+
+def _follower_error(error):
+    """Returns a copy of the leader's error for a follower, one exception object is not raised in several threads."""
+    try:
+        follower_error = copy.copy(error)
+    except Exception:
+        follower_error = RuntimeError(f"Coalesced call failed: {error!r}")
+    follower_error.__cause__ = error
+    return follower_error
+
+
+class _Call:
+    """A call in flight, shared by the leader and the followers with the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key of a worker process.
+
+    The first caller of a key (the leader) runs the function, the callers
+    arriving while it runs (the followers) wait for it and get the same result,
+    or a copy of its exception. When the leader ran out of time or was shed
+    (CALLER_ERRORS), the followers are not failed with its budget: one of them
+    runs the function as the new leader. The key is forgotten as soon as the
+    leader returns, so nothing is cached: a call starting afterwards runs the
+    function again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, deadline=None):
+        """Runs fn() once for all the concurrent callers of key.
+
+        Args:
+            key: A hashable identifying the work, calls with equal keys must return the same result.
+            fn: The function without arguments doing the work.
+            deadline: An optional Deadline, a follower gives up waiting with DeadlineExceeded once it passed.
+
+        Returns:
+            The result of fn(), shared by the leader and the followers; it must not be modified.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                else:
+                    call.followers += 1
+            if leader:
+                return self._lead(key, call, fn)
+            result = self._follow(call, deadline)
+            if result is not _RETRY:
+                return result
+
+    def _lead(self, key, call, fn):
+        try:
+            metrics.increment('coalesced_requests_total', role='leader')
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if call.error is not None and not isinstance(call.error, CALLER_ERRORS) and call.followers:
+                metrics.increment('coalesced_errors_total', call.followers)
+
+    def _follow(self, call, deadline):
+        metrics.increment('coalesced_requests_total', role='follower')
+        started = time.monotonic()
+        timeout = None if deadline is None else max(deadline.remaining(), 0)
+        finished = call.done.wait(timeout)
+        metrics.observe('coalesced_wait_seconds', time.monotonic() - started)
+        if not finished:
+            metrics.increment('invocations_deadline_exceeded_total', stage='coalesced')
+            raise DeadlineExceeded('coalesced')
+        if isinstance(call.error, CALLER_ERRORS):
+            metrics.increment('coalesced_retries_total')
+            return _RETRY
+        if call.error is not None:
+            raise _follower_error(call.error)
+        return call.result
+
+    def in_flight(self):
+        """Returns the number of keys currently running."""
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """SingleFlight for the coroutines of an event loop, see asgi.py.
+
+    The leader runs the coroutine as a task, so that a caller giving up or
+    disconnecting does not cancel the work the other callers wait for.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, deadline=None):
+        """Awaits fn() once for all the concurrent callers of key.
+
+        Args:
+            key: A hashable identifying the work, calls with equal keys must return the same result.
+            fn: The coroutine function without arguments doing the work.
+            deadline: An optional Deadline, a follower gives up waiting with DeadlineExceeded once it passed.
+
+        Returns:
+            The result of fn(), shared by the leader and the followers; it must not be modified.
+        """
+        while True:
+            call = self._calls.get(key)
+            if call is None:
+                metrics.increment('coalesced_requests_total', role='leader')
+                call = self._calls[key] = _Call()
+                call.task = asyncio.ensure_future(fn())
+                call.task.add_done_callback(lambda _, call=call: self._done(key, call))
+                return await asyncio.shield(call.task)
+            call.followers += 1
+            metrics.increment('coalesced_requests_total', role='follower')
+            started = time.monotonic()
+            timeout = None if deadline is None else max(deadline.remaining(), 0)
+            try:
+                return await asyncio.wait_for(asyncio.shield(call.task), timeout)
+            except asyncio.TimeoutError:
+                metrics.increment('invocations_deadline_exceeded_total', stage='coalesced')
+                raise DeadlineExceeded('coalesced')
+            except CALLER_ERRORS:
+                metrics.increment('coalesced_retries_total')
+            except Exception as e:
+                raise _follower_error(e)
+            finally:
+                metrics.observe('coalesced_wait_seconds', time.monotonic() - started)
+
+    def _done(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if call.task.cancelled() or call.task.exception() is None:
+            return
+        if not isinstance(call.task.exception(), CALLER_ERRORS) and call.followers:
+            metrics.increment('coalesced_errors_total', call.followers)
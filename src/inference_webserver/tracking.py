@@ -0,0 +1,159 @@
+import math
+import numpy as np
+import cv2
+
+from helper import init_crop_region, determine_crop_region, run_inference
+
+
+class OneEuroFilter:
+    """One-Euro low-pass filter for noisy keypoint coordinates.
+
+    The cutoff frequency adapts to the speed of the signal: slow movements are
+    smoothed strongly (less jitter), fast movements lightly (less lag).
+    See Casiez et al., "1 Euro Filter", CHI 2012.
+    """
+
+    def __init__(self, freq, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        self.freq = freq
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self._x = None
+        self._dx = None
+
+    def _alpha(self, cutoff):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        te = 1.0 / self.freq
+        return 1.0 / (1.0 + tau / te)
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self._x is None:
+            self._x = x
+            self._dx = np.zeros_like(x)
+            return x
+        dx = (x - self._x) * self.freq
+        a_d = self._alpha(self.d_cutoff)
+        self._dx = a_d * dx + (1 - a_d) * self._dx
+        cutoff = self.min_cutoff + self.beta * np.abs(self._dx)
+        a = 1.0 / (1.0 + self.freq / (2 * math.pi * cutoff))
+        self._x = a * x + (1 - a) * self._x
+        return self._x
+
+
+def frame_motion(previous, frame, size=32):
+    """Returns the mean absolute difference (0..1) of two frames on small grayscale thumbnails."""
+    if previous is None:
+        return 1.0
+    return float(np.mean(np.abs(previous.astype(np.float32) - _thumbnail(frame, size)))) / 255.0
+
+
+def _thumbnail(frame, size=32):
+    gray = cv2.cvtColor(np.asarray(frame, dtype=np.uint8), cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+class FrameSkippingTracker:
+    """Pose tracker for video that runs the model only on key frames.
+
+    A frame becomes a key frame every every_k frames, when the mean keypoint
+    score of the last key frame drops below min_score, or when the frame moved
+    more than motion_threshold away from the last key frame. Key frames are
+    cropped with determine_crop_region from the previous key frame's keypoints.
+    The keypoints of the frames in between are interpolated linearly between the
+    surrounding key frames, and every coordinate is smoothed by a One-Euro filter.
+
+    Frames are pushed one at a time; push() returns the (index, keypoints) of the
+    frames whose track is final, in order, so the output lags the input by at
+    most every_k frames.
+    """
+
+    def __init__(self, movenet, crop_size=(256, 256), every_k=3, min_score=0.3,
+                 motion_threshold=0.05, fps=30.0, min_cutoff=1.0, beta=0.0):
+        self.movenet = movenet
+        self.crop_size = list(crop_size)
+        self.every_k = every_k
+        self.min_score = min_score
+        self.motion_threshold = motion_threshold
+        self.inference_count = 0
+        self.frame_count = 0
+        self._filter = OneEuroFilter(fps, min_cutoff=min_cutoff, beta=beta)
+        self._last_key_index = None
+        self._last_keypoints = None
+        self._last_thumbnail = None
+        self._pending = []
+
+    def _is_key_frame(self, index, frame):
+        if self._last_keypoints is None:
+            return True
+        if index - self._last_key_index >= self.every_k:
+            return True
+        if float(np.mean(self._last_keypoints[0, 0, :, 2])) < self.min_score:
+            return True
+        return frame_motion(self._last_thumbnail, frame) > self.motion_threshold
+
+    def _smooth(self, keypoints):
+        smoothed = np.array(keypoints, dtype=np.float32, copy=True)
+        smoothed[0, 0, :, :2] = self._filter(keypoints[0, 0, :, :2])
+        return smoothed
+
+    def push(self, frame):
+        """Adds the next frame ([height, width, 3] RGB) and returns the finished (index, keypoints)."""
+        index = self.frame_count
+        self.frame_count += 1
+        if not self._is_key_frame(index, frame):
+            self._pending.append(index)
+            return []
+
+        image_height, image_width, _ = frame.shape
+        if self._last_keypoints is None:
+            crop_region = init_crop_region(image_height, image_width)
+        else:
+            crop_region = determine_crop_region(self._last_keypoints, image_height, image_width)
+        keypoints = run_inference(self.movenet, frame, crop_region, crop_size=self.crop_size)
+        self.inference_count += 1
+
+        ready = []
+        if self._last_keypoints is not None:
+            span = index - self._last_key_index
+            for pending_index in self._pending:
+                weight = (pending_index - self._last_key_index) / span
+                interpolated = (1 - weight) * self._last_keypoints + weight * keypoints
+                ready.append((pending_index, self._smooth(interpolated)))
+        self._pending = []
+        ready.append((index, self._smooth(keypoints)))
+
+        self._last_key_index = index
+        self._last_keypoints = keypoints
+        self._last_thumbnail = _thumbnail(frame)
+        return ready
+
+    def flush(self):
+        """Finishes the frames after the last key frame by holding its keypoints."""
+        ready = [(pending_index, self._smooth(self._last_keypoints)) for pending_index in self._pending]
+        self._pending = []
+        return ready
+
+
+def track_video(movenet, frames, crop_size=(256, 256), **tracker_args):
+    """Computes a keypoint track for every frame of a video.
+
+    Args:
+        movenet: A callable taking a [1, height, width, 3] image and returning [1, 1, 17, 3] keypoints.
+        frames: An iterable of [height, width, 3] RGB frames.
+        crop_size: The model input size as [height, width].
+        tracker_args: Further arguments of FrameSkippingTracker (every_k, min_score, ...).
+
+    Returns:
+        A [num_frames, 1, 1, 17, 3] float32 numpy array with the keypoints of every
+        frame, and the number of frames the model actually ran on.
+    """
+    tracker = FrameSkippingTracker(movenet, crop_size=crop_size, **tracker_args)
+    track = []
+    for frame in frames:
+        track.extend(tracker.push(frame))
+    track.extend(tracker.flush())
+    track.sort(key=lambda item: item[0])
+    if not track:
+        return np.zeros((0, 1, 1, 17, 3), dtype=np.float32), 0
+    return np.stack([keypoints for _, keypoints in track]), tracker.inference_count
@@ -0,0 +1,197 @@
+"""Finds the number of workers and TFLite threads per worker with the best throughput on this host.
+
+    python tune.py [--slo-ms 250] [--duration 3] [--output /opt/ml/tuning.json]
+
+Every candidate (workers x threads, at most one thread per CPU) is run with one
+process per worker, pinned to its own CPUs, serving a synthetic JPEG of
+--image-size for --duration seconds through the CPU-bound path of a request
+(predictor.decode_input_image and predict_and_render: decoding, resize and
+pad, inference, rendering and encoding of the overlay). The candidate with the
+highest throughput whose p95 latency meets --slo-ms is written to --output;
+serve reads it with MODEL_SERVER_TUNE (see load_tuning).
+"""
+import os
+import json
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+
+prefix = "/opt/ml/"
+model_file = os.path.join(prefix, "model", "model.tflite")
+TUNING_FILE = os.path.join(prefix, "tuning.json")
+# Height and width of the synthetic request image.
+DEFAULT_IMAGE_SHAPE = (720, 1280)
+
+
+def cpu_sets(num_workers, threads, cpus=None):
+    """Splits the CPUs available to the process into one disjoint set of threads CPUs per worker.
+
+    Args:
+        num_workers: An integer, the number of workers.
+        threads: An integer, the CPUs of every worker.
+        cpus: An optional list of CPU ids, the affinity of the calling process by default.
+
+    Returns:
+        A list with the CPU set of every worker; the sets wrap around and overlap
+        only when num_workers * threads exceeds the CPUs.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if cpus is None else sorted(cpus)
+    return [{cpus[(idx * threads + offset) % len(cpus)] for offset in range(threads)} for idx in range(num_workers)]
+
+
+def candidates(num_cpus):
+    """Returns the (workers, threads) pairs using at most num_cpus CPUs, largest first."""
+    pairs = set()
+    threads = 1
+    while threads <= num_cpus:
+        max_workers = num_cpus // threads
+        workers = 1
+        while workers < max_workers:
+            pairs.add((workers, threads))
+            workers *= 2
+        pairs.add((max_workers, threads))
+        threads *= 2
+    return sorted(pairs, key=lambda pair: (-pair[0] * pair[1], -pair[0]))
+
+
+def synthetic_jpeg(height, width):
+    """Returns a deterministic height x width JPEG of gradients and noise, a stand-in for a photo."""
+    import cv2
+    rng = np.random.default_rng(0)
+    ys, xs = np.mgrid[0:height, 0:width]
+    image = np.stack([xs * 255 // max(width - 1, 1), ys * 255 // max(height - 1, 1),
+                      (xs + ys) * 255 // max(height + width - 2, 1)], axis=-1)
+    image = np.clip(image + rng.integers(-24, 25, size=image.shape), 0, 255).astype(np.uint8)
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def _run_worker(path, threads, cpus, image_shape, ready, start, duration, results):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    # The serving modules read their configuration at import time; one interpreter
+    # per worker, without the capture and the model reload of the server.
+    os.environ['MODEL_INTERPRETER_THREADS'] = str(threads)
+    os.environ['MODEL_SERVER_INFERENCE'] = 'worker'
+    os.environ.pop('CAPTURE_DESTINATION', None)
+    os.environ.pop('MODEL_RELOAD_SOURCE', None)
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    import model_store
+    model_store.model_file = path
+    import predictor
+
+    data = synthetic_jpeg(*image_shape)
+
+    def request():
+        input_image, image = predictor.decode_input_image(data)
+        predictor.predict_and_render(input_image, image)
+
+    request()
+    ready.put(os.getpid())
+    start.wait()
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        request()
+        latencies.append(time.perf_counter() - started)
+    results.put(latencies)
+
+
+def benchmark(num_workers, threads, duration=3.0, path=model_file, pin=True, image_shape=DEFAULT_IMAGE_SHAPE):
+    """Runs num_workers processes with a threads-thread interpreter each for duration seconds.
+
+    Returns:
+        A dictionary with the 'workers', 'threads', the total 'throughput' in
+        requests per second and the 'p50_ms', 'p95_ms' and 'p99_ms' latencies.
+    """
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    start = context.Event()
+    results = context.Queue()
+    sets = cpu_sets(num_workers, threads) if pin else [None] * num_workers
+    processes = [context.Process(target=_run_worker,
+                                 args=(path, threads, cpus, image_shape, ready, start, duration, results))
+                 for cpus in sets]
+    for process in processes:
+        process.start()
+    # Every worker imports the serving modules and serves a first request before the clock starts.
+    for _ in processes:
+        ready.get()
+    start.set()
+    latencies = np.concatenate([np.asarray(results.get(), dtype=np.float64) for _ in processes])
+    for process in processes:
+        process.join()
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if len(latencies) else (np.nan,) * 3
+    return {"workers": num_workers, "threads": threads, "throughput": len(latencies) / duration,
+            "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def tune(slo_ms=250.0, duration=3.0, path=model_file, pin=True, image_shape=DEFAULT_IMAGE_SHAPE):
+    """Benchmarks every candidate and selects the best one.
+
+    Returns:
+        A dictionary with the selected 'workers' and 'threads', whether it 'meets_slo'
+        (when no candidate does, the one with the lowest p95 is selected), the host
+        'cpus', the 'slo_ms', the 'model' (size and modification time) and all the 'results'.
+    """
+    num_cpus = len(os.sched_getaffinity(0))
+    results = []
+    for num_workers, threads in candidates(num_cpus):
+        result = benchmark(num_workers, threads, duration=duration, path=path, pin=pin, image_shape=image_shape)
+        print(f"{num_workers:>8} {threads:>8} {result['throughput']:>12.1f} "
+              f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f}", flush=True)
+        results.append(result)
+    within_slo = [result for result in results if result['p95_ms'] <= slo_ms]
+    if within_slo:
+        best = max(within_slo, key=lambda result: result['throughput'])
+    else:
+        best = min(results, key=lambda result: result['p95_ms'])
+    return {"workers": best["workers"], "threads": best["threads"], "meets_slo": bool(within_slo),
+            "cpus": num_cpus, "slo_ms": slo_ms, "model": _model_key(path), "results": results}
+
+
+def _model_key(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}-{int(stat.st_mtime)}"
+
+
+def load_tuning(path=TUNING_FILE, model_path=model_file):
+    """Returns the persisted tuning, or None when it is missing or was made on another host or model."""
+    try:
+        with open(path, "r") as infile:
+            tuning = json.loads(infile.read())
+    except (FileNotFoundError, ValueError):
+        return None
+    if tuning.get("cpus") != len(os.sched_getaffinity(0)) or tuning.get("model") != _model_key(model_path):
+        return None
+    return tuning
+
+
+def save_tuning(tuning, path=TUNING_FILE):
+    with open(path + ".tmp", "w") as outfile:
+        outfile.write(json.dumps(tuning, indent=4))
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slo-ms", type=float, default=float(os.environ.get("MODEL_SERVER_LATENCY_SLO_MS", 250)),
+                        help="p95 request latency the selected candidate must meet")
+    parser.add_argument("--duration", type=float, default=float(os.environ.get("MODEL_SERVER_TUNE_SECONDS", 3)),
+                        help="seconds every candidate runs")
+    parser.add_argument("--model", default=model_file)
+    parser.add_argument("--output", default=os.environ.get("MODEL_SERVER_TUNING_FILE", TUNING_FILE))
+    parser.add_argument("--no-pin", action="store_true", help="do not pin the workers to CPUs")
+    parser.add_argument("--image-size", default=os.environ.get("MODEL_SERVER_TUNE_IMAGE_SIZE", "720x1280"),
+                        help="HEIGHTxWIDTH of the synthetic request image")
+    args = parser.parse_args()
+    image_shape = tuple(int(side) for side in args.image_size.lower().split("x"))
+
+    print(f"{'workers':>8} {'threads':>8} {'requests/s':>12} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    tuning = tune(slo_ms=args.slo_ms, duration=args.duration, path=args.model, pin=not args.no_pin,
+                  image_shape=image_shape)
+    save_tuning(tuning, args.output)
+    print(f"Selected {tuning['workers']} workers x {tuning['threads']} threads"
+          f"{'' if tuning['meets_slo'] else ' (no candidate meets the SLO, lowest p95)'}, written to {args.output}")
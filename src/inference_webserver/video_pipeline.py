@@ -0,0 +1,228 @@
+import time
+import queue
+import logging
+import threading
+import numpy as np
+import cv2
+
+from helper import draw_prediction_on_image
+from tracking import FrameSkippingTracker
+from encoders import StreamingEncoder
+
+# Marks the end of the stream in the stage queues.
+_END = object()
+_POLL_INTERVAL = 0.1
+
+
+class StageStats:
+    """Throughput and busy time of a pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+
+    def report(self, wall_time):
+        return {
+            'frames': self.items,
+            'fps': self.items / wall_time if wall_time else 0.0,
+            'busy_fraction': self.busy / wall_time if wall_time else 0.0,
+        }
+
+
+class MonitoredQueue(queue.Queue):
+    """Bounded queue sampling its occupancy on every put."""
+
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self._samples = 0
+        self._occupancy = 0
+        self._max_occupancy = 0
+
+    def put_sample(self):
+        occupancy = self.qsize()
+        self._samples += 1
+        self._occupancy += occupancy
+        self._max_occupancy = max(self._max_occupancy, occupancy)
+
+    def report(self):
+        return {
+            'capacity': self.maxsize,
+            'mean_occupancy': self._occupancy / self._samples if self._samples else 0.0,
+            'max_occupancy': self._max_occupancy,
+        }
+
+
+class VideoPipeline:
+    """Decode -> infer -> render/encode pipeline for video files.
+
+    Every stage runs in its own thread and the stages are connected by bounded
+    queues, so decoding, inference and rendering/encoding overlap. Decoded
+    frames live in a fixed pool of reusable buffers that is sized to cover the
+    queues and the frames the tracker holds back, frames stay in order
+    end-to-end. The inference stage runs a FrameSkippingTracker (every_k=1
+    runs the model on every frame).
+
+    TFLite, OpenCV and ffmpeg release the GIL while they work; matplotlib
+    rendering does not, so the report shows when rendering limits the FPS.
+    """
+
+    def __init__(self, movenet, sink, output_format='mp4', crop_size=(256, 256), every_k=1,
+                 queue_size=8, output_image_height=None, **tracker_args):
+        self.movenet = movenet
+        self.sink = sink
+        self.output_format = output_format
+        self.crop_size = crop_size
+        self.every_k = every_k
+        self.output_image_height = output_image_height
+        self.tracker_args = tracker_args
+        self.decoded = MonitoredQueue('decoded', queue_size)
+        self.inferred = MonitoredQueue('inferred', queue_size)
+        self.pool_size = 2 * queue_size + every_k + 3
+        self._free_buffers = queue.Queue()
+        self._stop = threading.Event()
+        self._errors = []
+        self.stats = {name: StageStats(name) for name in ('decode', 'infer', 'render')}
+        self.track = []
+
+    def _put(self, target, item):
+        while not self._stop.is_set():
+            try:
+                target.put(item, timeout=_POLL_INTERVAL)
+                target.put_sample()
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source):
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _run_stage(self, stage, *args):
+        try:
+            stage(*args)
+        except Exception as e:
+            logging.exception("Video pipeline stage failed")
+            self._errors.append(e)
+            self._stop.set()
+
+    def _decode(self, video_path):
+        stats = self.stats['decode']
+        capture = cv2.VideoCapture(video_path)
+        try:
+            index = 0
+            while not self._stop.is_set():
+                started = time.monotonic()
+                if index < self.pool_size:
+                    buffer = None
+                else:
+                    buffer = self._get(self._free_buffers)
+                    if buffer is _END:
+                        break
+                ok, frame = capture.read(buffer)
+                if not ok:
+                    break
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+                stats.busy += time.monotonic() - started
+                stats.items += 1
+                if not self._put(self.decoded, (index, frame)):
+                    break
+                index += 1
+        finally:
+            capture.release()
+            self._put(self.decoded, _END)
+
+    def _infer(self):
+        stats = self.stats['infer']
+        tracker = FrameSkippingTracker(self.movenet, crop_size=self.crop_size, every_k=self.every_k,
+                                       **self.tracker_args)
+        held_frames = {}
+        while True:
+            item = self._get(self.decoded)
+            if item is _END:
+                break
+            index, frame = item
+            started = time.monotonic()
+            held_frames[index] = frame
+            ready = tracker.push(frame)
+            stats.busy += time.monotonic() - started
+            for ready_index, keypoints in ready:
+                stats.items += 1
+                if not self._put(self.inferred, (ready_index, held_frames.pop(ready_index), keypoints)):
+                    return
+        for ready_index, keypoints in tracker.flush():
+            stats.items += 1
+            self._put(self.inferred, (ready_index, held_frames.pop(ready_index), keypoints))
+        self.inference_count = tracker.inference_count
+        self._put(self.inferred, _END)
+
+    def _render(self, fps):
+        stats = self.stats['render']
+        with StreamingEncoder(self.sink, fps=fps, format=self.output_format) as encoder:
+            while True:
+                item = self._get(self.inferred)
+                if item is _END:
+                    break
+                index, frame, keypoints = item
+                started = time.monotonic()
+                overlay = draw_prediction_on_image(
+                    frame, keypoints, output_image_height=self.output_image_height)
+                self._free_buffers.put(frame)
+                encoder.write_frame(overlay)
+                stats.busy += time.monotonic() - started
+                stats.items += 1
+                self.track.append(keypoints)
+            if self._stop.is_set():
+                raise RuntimeError("Video pipeline stopped")
+
+    def run(self, video_path):
+        """Processes the video file and writes the overlay video to the sink.
+
+        Returns:
+            A [num_frames, 1, 1, 17, 3] numpy array with the keypoints of every
+            frame, and a report with per-stage throughput, busy fraction and
+            queue occupancy.
+        """
+        capture = cv2.VideoCapture(video_path)
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        capture.release()
+        self.inference_count = 0
+
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=self._run_stage, args=(self._decode, video_path), name='decode'),
+            threading.Thread(target=self._run_stage, args=(self._infer,), name='infer'),
+            threading.Thread(target=self._run_stage, args=(self._render, fps), name='render'),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_time = time.monotonic() - started
+        if self._errors:
+            raise self._errors[0]
+
+        stages = {name: stats.report(wall_time) for name, stats in self.stats.items()}
+        report = {
+            'wall_seconds': wall_time,
+            'end_to_end_fps': len(self.track) / wall_time if wall_time else 0.0,
+            'inference_frames': self.inference_count,
+            'stages': stages,
+            'queues': {q.name: q.report() for q in (self.decoded, self.inferred)},
+            'bottleneck': max(stages, key=lambda name: stages[name]['busy_fraction']),
+        }
+        logging.info(f"Video pipeline report, {report}")
+        if not self.track:
+            return np.zeros((0, 1, 1, 17, 3), dtype=np.float32), report
+        return np.stack(self.track), report
+
+
+def process_video(movenet, video_path, sink, output_format='mp4', **pipeline_args):
+    """Runs the decode -> infer -> render pipeline on a video file, see VideoPipeline."""
+    return VideoPipeline(movenet, sink, output_format=output_format, **pipeline_args).run(video_path)
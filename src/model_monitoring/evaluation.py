@@ -1,18 +1,23 @@
 """Custom Model Monitoring script for infrastructure monitoring"""
 # Python Built-Ins:
-from collections import defaultdict
-import datetime
 import json
 import os
 import traceback
 from types import SimpleNamespace
 
 # External Dependencies:
-import numpy as np
 import boto3
 from dateutil.tz import tzutc
 from datetime import timedelta, datetime
+from metrics_store import (MetricsStore, HISTORY_FILE, download_state, upload_state, load_checkpoint,
+                           save_checkpoint, new_capture_objects, count_capture_records)
+from variant_comparison import format_table
+from metrics_source import create_metrics_source
+from fleet import endpoint_names, fetch_fleet, evaluate_endpoint, endpoint_summary, fleet_summary, format_fleet_table
 cw_client = boto3.client('cloudwatch', region_name='ap-south-1')
+sm_client = boto3.client('sagemaker', region_name='ap-south-1')
+
+FLEET_REPORT_FILE = "fleet_report.json"
 
 
 def get_environment():
@@ -55,130 +60,106 @@ def get_environment():
 
         max_ratio_threshold=float(os.environ.get(
             "THRESHOLD", defaults.get("THRESHOLD", "nan"))),
+        state_s3_uri=os.environ.get(
+            "STATE_S3_URI", defaults.get("STATE_S3_URI")),
+        lookback_hours=float(os.environ.get(
+            "LOOKBACK_HOURS", defaults.get("LOOKBACK_HOURS", "10"))),
+        baseline_variant=os.environ.get(
+            "BASELINE_VARIANT", defaults.get("BASELINE_VARIANT")),
+        max_latency_regression=float(os.environ.get(
+            "MAX_LATENCY_REGRESSION", defaults.get("MAX_LATENCY_REGRESSION", "0.1"))),
+        min_sample_count=int(os.environ.get(
+            "MIN_SAMPLE_COUNT", defaults.get("MIN_SAMPLE_COUNT", "1000"))),
+        max_memory_utilization=float(os.environ.get(
+            "MAX_MEMORY_UTILIZATION", defaults.get("MAX_MEMORY_UTILIZATION", "90"))),
+        endpoint_names=os.environ.get(
+            "ENDPOINT_NAMES", defaults.get("ENDPOINT_NAMES")),
+        max_concurrent_endpoints=int(os.environ.get(
+            "MAX_CONCURRENT_ENDPOINTS", defaults.get("MAX_CONCURRENT_ENDPOINTS", "8"))),
+        metrics_source=os.environ.get(
+            "METRICS_SOURCE", defaults.get("METRICS_SOURCE", "cloudwatch")),
+        metrics_record_path=os.environ.get(
+            "METRICS_RECORD_PATH", defaults.get("METRICS_RECORD_PATH")),
+        job_output_dir=os.environ.get(
+            "JOB_OUTPUT_DIR", defaults.get("JOB_OUTPUT_DIR", "/opt/ml/output")),
     )
 
 
-def get_infra_stats(endpoint_name, start_time, end_time):
-    
-    """Retrieves infrastructure statistics for a given SageMaker endpoint between a specified start and end time. 
-    The function takes in the endpoint name, start time and end time as parameters and returns a list of dictionaries 
-    containing the requested statistics
-    
-    Args:
-        endpoint_name: A string representing the name of the SageMaker endpoint for which to retrieve infrastructure statistics.
-        start_time: A datetime object representing the start time of the period for which to retrieve statistics.
-        end_time: A datetime object representing the end time of the period for which to retrieve statistics.
-    
-    Returns:
-        metrics_report: A list of dictionaries containing the infrastructure statistics for the specified endpoint within the specified time period. 
-        Each dictionary contains the metric name and the corresponding datapoints for that metric.
-    """
-    
-    metrics = [
-        {'namespace': 'AWS/SageMaker', 'unit': 'Microseconds', 'name': 'ModelLatency', 'dimensions': [
-            {'Name': 'EndpointName', 'Value': endpoint_name}, {'Name': 'VariantName', 'Value': 'AllTraffic'}]},
-
-        {'namespace': '/aws/sagemaker/Endpoints', 'unit': 'Percent', 'name': 'CPUUtilization', 'dimensions': [
-            {'Name': 'EndpointName', 'Value': endpoint_name}, {'Name': 'VariantName', 'Value': 'AllTraffic'}]},
-
-        {'namespace': '/aws/sagemaker/Endpoints', 'unit': 'Percent', 'name': 'MemoryUtilization',
-            'dimensions': [{'Name': 'EndpointName', 'Value': endpoint_name}, {'Name': 'VariantName', 'Value': 'AllTraffic'}]}
-    ]
-
-    metrics_report = []
-    for metric in metrics:
-        response = cw_client.get_metric_statistics(
-            Namespace=metric['namespace'],
-            MetricName=metric['name'],
-            Dimensions=metric['dimensions'],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=60,
-            Unit=metric['unit'],
-            Statistics=['SampleCount', 'Average']
-        )
-
-        metrics_report.append({metric['name']: response['Datapoints']})
-
-    return metrics_report
-
-
-def average_and_time(matrix, len_matrix):
-    """Takes in a matrix and its length as input and returns the maximum average value and the corresponding timestamp from the matrix. 
-        The matrix is assumed to be a list of dictionaries where each dictionary contains two keys 'Average' and 'Timestamp'.
-        
-    Args:
-        matrix: A list of dictionaries where each dictionary contains two keys 'Average' and 'Timestamp'.
-        len_matrix: An integer representing the length of the matrix.
-        
-    Returns:
-        max_avg: A float representing the maximum average value in the matrix.
-        max_time: A string representing the timestamp corresponding to the maximum average value.
-
-    """
-    
-    for i in range(len_matrix):
-        if i == 0:
-            max_avg = matrix[i]['Average']
-            max_time = matrix[i]['Timestamp']
-
-        else:
-            if matrix[i]['Average'] > max_avg:
-                max_avg = matrix[i]['Average']
-                max_time = matrix[i]['Timestamp']
-        return max_avg, max_time
-
-
-def _iterator(list_metrics, key_name):
-    for key, value in list_metrics.items():
-        if key == key_name:
-            refined_list = list_metrics[key_name]
-        else:
-            return ""
-    return refined_list
-
-
-def _check_field(list_metrics):
-    if len(list_metrics) == 3:
-        model_lat = _iterator(list_metrics[0], "ModelLatency")
-        cpu_util = _iterator(list_metrics[1], "CPUUtilization")
-        mem_util = _iterator(list_metrics[2], "MemoryUtilization")
-    else:
-        return None
-
-    return model_lat, cpu_util, mem_util
-
-
 if __name__ == "__main__":
     env = get_environment()
     print(f"Starting evaluation with config:\n{env}")
 
-    print("Analyzing collected data...")
-    end_point_name = "human-pose-prediction-endpoint"
-    start_time = datetime.now() - timedelta(hours=10)
-    end_time = datetime.now()
+    print("Restoring checkpoint and metrics history...")
+    download_state(env.state_s3_uri, env.output_path)
+    checkpoint = load_checkpoint(env.output_path)
+    store = MetricsStore(os.path.join(env.output_path, HISTORY_FILE))
 
-    result = get_infra_stats(end_point_name, start_time, end_time)
-
-    model_lat, cpu_util, mem_util = _check_field(result)
-
-    avg_model_latency, time = average_and_time(model_lat, len(model_lat))
-    avg_cpu_util, time = average_and_time(cpu_util, len(cpu_util))
-    avg_mem_util, time = average_and_time(mem_util, len(mem_util))
-
-    avg_model_latency = (avg_model_latency/1000000)
+    print("Analyzing collected data...")
+    source = create_metrics_source(env, cw_client=cw_client, sm_client=sm_client)
+    endpoints = endpoint_names(env, source)
+    print(f"Endpoints: {endpoints}")
+    end_time = datetime.now(tzutc())
+    window_start = end_time - timedelta(hours=env.lookback_hours)
+    start_times = {}
+    for end_point_name in endpoints:
+        # Histories written before the fleet checkpoint only have the job-wide timestamp.
+        last_timestamp = checkpoint["endpoint_timestamps"].get(end_point_name, checkpoint["last_timestamp"])
+        if last_timestamp is not None:
+            # CloudWatch datapoints can land a few minutes late, re-read a small overlap.
+            start_times[end_point_name] = max(last_timestamp - timedelta(minutes=5), window_start)
+        else:
+            start_times[end_point_name] = window_start
+    print(f"Fetching metrics of {len(endpoints)} endpoints until {end_time}")
+
+    # The fetches run concurrently, the history is written from this thread only.
+    fetched = fetch_fleet(source, endpoints, start_times, end_time, max_workers=env.max_concurrent_endpoints)
+    endpoint_timestamps = dict(checkpoint["endpoint_timestamps"])
+    for end_point_name, result in fetched.items():
+        if "error" in result:
+            continue
+        for variant_name, metrics in result["datapoints"].items():
+            for metric_name, datapoints in metrics.items():
+                newest = store.append(end_point_name, metric_name, datapoints, variant_name=variant_name)
+                previous = endpoint_timestamps.get(end_point_name)
+                if newest is not None and (previous is None or newest > previous):
+                    endpoint_timestamps[end_point_name] = newest
+    last_timestamp = max(endpoint_timestamps.values(), default=checkpoint["last_timestamp"])
+
+    capture_objects = new_capture_objects(env.dataset_source, checkpoint["last_capture_object"])
+    captured_records = count_capture_records(env.dataset_source, capture_objects)
+    print(f"New capture files: {len(capture_objects)}, captured records: {captured_records}")
+    last_capture_object = capture_objects[-1] if capture_objects else checkpoint["last_capture_object"]
+
+    # The statistics are computed over the stored history, so only the new datapoints had to be fetched.
+    reports = {}
+    for end_point_name, result in fetched.items():
+        if "error" in result:
+            reports[end_point_name] = {"error": result["error"]}
+            continue
+        report = evaluate_endpoint(store, end_point_name, result["variants"], window_start, end_time, env)
+        report["summary"] = endpoint_summary(report)
+        report["fetch_seconds"] = result["fetch_seconds"]
+        reports[end_point_name] = report
+        print(f"{end_point_name} over the last {env.lookback_hours} hours:\n{format_table(report['summaries'])}")
+        for variant_name, decision in report["decisions"].items():
+            print(f"{end_point_name} {variant_name} vs {report['baseline_variant']}: {decision['decision']}, "
+                  f"{'; '.join(decision['reasons'])}")
+    fleet = fleet_summary(reports)
+    print(f"Fleet:\n{format_fleet_table(reports)}")
+    print(f"{fleet['evaluated']}/{fleet['endpoints']} endpoints evaluated, {fleet['invocations']:.0f} invocations, "
+          f"with violations: {fleet['with_violations']}, rollbacks: {fleet['rollbacks']}")
+
+    with open(os.path.join(env.output_path, FLEET_REPORT_FILE), "w") as outfile:
+        outfile.write(json.dumps({
+            "window_start": window_start.isoformat(),
+            "window_end": end_time.isoformat(),
+            "fleet": fleet,
+            "endpoints": reports,
+        }, indent=4))
 
     print("Checking for constraint violations...")
-    violations = []
-    if avg_model_latency > env.max_ratio_threshold:
-        violations.append({
-            "feature_name": "ModelLatency",
-            "constraint_check_type": "baseline_infra_drift_check",
-            "description": "Model Latency actual {:.2f}% in seconds : Exceeded {:.2f}% threshold".format(
-                avg_model_latency,
-                env.max_ratio_threshold,
-            ),
-        })
+    violations = [violation for report in reports.values() for violation in report.get("violations", [])]
+    avg_model_latency = fleet["max_latency"] or 0.0
 
     print("Writing violations file...")
     with open(os.path.join(env.output_path, "constraints_violations.json"), "w") as outfile:
@@ -188,9 +169,13 @@ if __name__ == "__main__":
         ))
 
     print("Writing overall status output...")
-    with open("/opt/ml/output/message", "w") as outfile:
+    with open(os.path.join(env.job_output_dir, "message"), "w") as outfile:
         if len(violations):
             msg = f"CompletedWithViolations: {violations[0]['description']}"
+            if len(violations) > 1:
+                msg += f" (and {len(violations) - 1} more, see {FLEET_REPORT_FILE})"
+        elif fleet["failed"]:
+            msg = f"CompletedWithViolations: Unable to fetch the metrics of {', '.join(fleet['failed'])}"
         else:
             msg = "Completed: Job completed successfully with no violations."
         outfile.write(msg)
@@ -198,32 +183,56 @@ if __name__ == "__main__":
 
     if env.publish_cloudwatch_metrics:
         print("Writing CloudWatch metrics...")
-        with open("/opt/ml/output/metrics/cloudwatch/cloudwatch_metrics.jsonl", "a+") as outfile:
+        os.makedirs(os.path.join(env.job_output_dir, "metrics", "cloudwatch"), exist_ok=True)
+        with open(os.path.join(env.job_output_dir, "metrics", "cloudwatch", "cloudwatch_metrics.jsonl"),
+                  "a+") as outfile:
             # One metric per line (JSONLines list of dictionaries)
             # Remember these metrics are aggregated in graphs, so we report them as statistics on our dataset
-            json.dump(
-                {
-                    "MetricName": f"Average CPU Utlization",
-                    "Timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    "Dimensions": [
-                        {"Name": "Endpoint",
-                            "Value": env.sagemaker_endpoint_name or "unknown"},
-                        {
-                            "Name": "MonitoringSchedule",
-                            "Value": env.sagemaker_monitoring_schedule_name or "unknown",
-                        },
-                    ],
-                    "StatisticValues": {
-                        "Average": avg_cpu_util
+            for end_point_name, report in reports.items():
+                for variant_name, summary in report.get("summaries", {}).items():
+                    for metric_name, metric_key in (("Average CPU Utlization", "CPUUtilization"),
+                                                    ("Average Mememory Utlization", "MemoryUtilization")):
+                        json.dump(
+                            {
+                                "MetricName": metric_name,
+                                "Timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                "Dimensions": [
+                                    {"Name": "Endpoint", "Value": end_point_name},
+                                    {
+                                        "Name": "MonitoringSchedule",
+                                        "Value": env.sagemaker_monitoring_schedule_name or "unknown",
+                                    },
+                                    {"Name": "Variant", "Value": variant_name},
+                                ],
+                                "StatisticValues": {
+                                    "Average": summary[metric_key]["mean"] or 0.0
+                                },
+                            },
+                            outfile
+                        )
+                        outfile.write("\n")
+
+            for metric_name, value in (("Fleet Max Model Latency", fleet["max_latency"] or 0.0),
+                                       ("Fleet Endpoints With Violations", len(fleet["with_violations"]))):
+                json.dump(
+                    {
+                        "MetricName": metric_name,
+                        "Timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                        "Dimensions": [
+                            {
+                                "Name": "MonitoringSchedule",
+                                "Value": env.sagemaker_monitoring_schedule_name or "unknown",
+                            },
+                        ],
+                        "Value": value,
                     },
-                },
-                outfile
-            )
-            outfile.write("\n")
+                    outfile
+                )
+                outfile.write("\n")
 
             json.dump(
                 {
-                    "MetricName": f"Average Mememory Utlization",
+                    "MetricName": f"Captured Invocations",
                     "Timestamp": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
                     "Dimensions": [
                         {"Name": "Endpoint",
@@ -234,9 +243,14 @@ if __name__ == "__main__":
                         },
                     ],
                     "StatisticValues": {
-                        "Average": avg_mem_util
+                        "Sum": captured_records
                     },
                 },
                 outfile
             )
             outfile.write("\n")
+
+    print("Saving checkpoint and metrics history...")
+    save_checkpoint(env.output_path, last_timestamp, last_capture_object, endpoint_timestamps)
+    store.close()
+    upload_state(env.state_s3_uri, env.output_path)
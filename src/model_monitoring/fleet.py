@@ -0,0 +1,193 @@
+"""Fleet-wide evaluation of several endpoints for the monitoring job"""
+# Python Built-Ins:
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from variant_comparison import variant_summaries, select_baseline, decide, ROLLBACK
+
+
+def endpoint_names(env, source=None):
+    """Lists the endpoints the job evaluates.
+
+    The list comes from ENDPOINT_NAMES (comma separated), then from the endpoint
+    the monitoring schedule is attached to, then from the endpoints of a replay file.
+
+    Args:
+        env: The job configuration, see evaluation.get_environment.
+        source: The MetricsSource, used when it knows its endpoints (replay files).
+
+    Returns:
+        A list of endpoint names.
+    """
+    if env.endpoint_names:
+        names = [name.strip() for name in env.endpoint_names.split(",") if name.strip()]
+    elif env.sagemaker_endpoint_name:
+        names = [env.sagemaker_endpoint_name]
+    elif hasattr(source, "endpoints"):
+        names = source.endpoints()
+    else:
+        names = []
+    if not names:
+        raise ValueError("No endpoint to evaluate, set ENDPOINT_NAMES or attach the job to an endpoint")
+    return list(dict.fromkeys(names))
+
+
+def fetch_endpoint(source, endpoint_name, start_time, end_time):
+    """Fetches the variants of an endpoint and their datapoints.
+
+    Returns:
+        A dictionary with the 'variants', the 'datapoints' per variant and metric
+        and the 'fetch_seconds'.
+    """
+    started = time.monotonic()
+    variants = source.variants(endpoint_name)
+    if not variants:
+        raise ValueError(f"{endpoint_name} has no production variants")
+    datapoints = {variant["name"]: source.fetch(endpoint_name, variant["name"], start_time, end_time)
+                  for variant in variants}
+    return {"variants": variants, "datapoints": datapoints, "fetch_seconds": time.monotonic() - started}
+
+
+def fetch_fleet(source, endpoints, start_times, end_time, max_workers=8):
+    """Fetches the endpoints concurrently.
+
+    Args:
+        source: The MetricsSource.
+        endpoints: A list of endpoint names.
+        start_times: A dictionary with the start of the fetch window per endpoint.
+        end_time: A datetime object representing the end of the fetch window.
+        max_workers: An integer, the endpoints fetched at the same time.
+
+    Returns:
+        A dictionary mapping the endpoint names to the result of fetch_endpoint, or to
+        {'error': message} when the endpoint could not be fetched; the other endpoints
+        are still evaluated.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(endpoints)))) as executor:
+        futures = {endpoint_name: executor.submit(fetch_endpoint, source, endpoint_name,
+                                                  start_times[endpoint_name], end_time)
+                   for endpoint_name in endpoints}
+        for endpoint_name, future in futures.items():
+            try:
+                results[endpoint_name] = future.result()
+            except Exception as e:
+                traceback.print_exc()
+                print(f"Unable to fetch the metrics of {endpoint_name}")
+                results[endpoint_name] = {"error": str(e)}
+    return results
+
+
+def evaluate_endpoint(store, endpoint_name, variants, window_start, end_time, env):
+    """Summarises the variants of an endpoint over the window and checks them against the thresholds.
+
+    Returns:
+        A dictionary with the variant 'summaries', the 'baseline_variant', the
+        promote/rollback 'decisions' of the other variants and the 'violations'.
+    """
+    summaries = variant_summaries(store, endpoint_name, variants, window_start, end_time)
+    baseline_variant = select_baseline(summaries, env.baseline_variant)
+    decisions = {}
+    for variant_name, summary in summaries.items():
+        if variant_name != baseline_variant:
+            decisions[variant_name] = decide(
+                summaries[baseline_variant], summary, env.max_ratio_threshold,
+                max_latency_regression=env.max_latency_regression, min_sample_count=env.min_sample_count,
+                max_memory_utilization=env.max_memory_utilization)
+
+    violations = []
+    for variant_name, summary in summaries.items():
+        max_model_latency = summary["ModelLatency"]["max"] or 0.0
+        if max_model_latency > env.max_ratio_threshold:
+            violations.append({
+                "feature_name": "ModelLatency",
+                "constraint_check_type": "baseline_infra_drift_check",
+                "description": "Model Latency of {}/{} actual {:.2f}% in seconds : Exceeded {:.2f}% threshold".format(
+                    endpoint_name,
+                    variant_name,
+                    max_model_latency,
+                    env.max_ratio_threshold,
+                ),
+            })
+    for variant_name, decision in decisions.items():
+        if decision["decision"] == ROLLBACK:
+            violations.append({
+                "feature_name": "ModelLatency",
+                "constraint_check_type": "variant_comparison_check",
+                "description": "Variant {} of {} should be rolled back: {}".format(
+                    variant_name, endpoint_name, "; ".join(decision["reasons"])),
+            })
+    return {"summaries": summaries, "baseline_variant": baseline_variant, "decisions": decisions,
+            "violations": violations}
+
+
+def endpoint_summary(report):
+    """Aggregates the variants of an endpoint report into one latency, CPU and memory summary.
+
+    Returns:
+        A dictionary per metric with the invocation-weighted 'mean', the 'max' and the
+        'sample_count' (for ModelLatency, the invocations) of all the variants.
+    """
+    summary = {}
+    for metric_name in ("ModelLatency", "CPUUtilization", "MemoryUtilization"):
+        stats = [variant[metric_name] for variant in report["summaries"].values()
+                 if variant[metric_name]["mean"] is not None]
+        samples = sum(stat["sample_count"] or 0 for stat in stats)
+        summary[metric_name] = {
+            "mean": sum(stat["mean"] * (stat["sample_count"] or 0) for stat in stats) / samples if samples else None,
+            "max": max((stat["max"] for stat in stats if stat["max"] is not None), default=None),
+            "sample_count": samples,
+        }
+    return summary
+
+
+def fleet_summary(reports):
+    """Summarises the evaluated endpoints of the fleet.
+
+    Args:
+        reports: A dictionary mapping the endpoint names to their report, i.e. the result of
+            evaluate_endpoint with its 'summary' (endpoint_summary), or {'error': message}.
+
+    Returns:
+        A dictionary with the endpoint counts, the invocation-weighted mean and the max
+        ModelLatency (seconds) of the fleet, the slowest endpoint and the endpoints
+        with violations or rollback decisions.
+    """
+    evaluated = {name: report for name, report in reports.items() if "error" not in report}
+    latencies = {name: report["summary"]["ModelLatency"] for name, report in evaluated.items()}
+    invocations = sum(latency["sample_count"] for latency in latencies.values())
+    with_latency = {name: latency for name, latency in latencies.items() if latency["max"] is not None}
+    return {
+        "endpoints": len(reports),
+        "evaluated": len(evaluated),
+        "failed": sorted(name for name in reports if name not in evaluated),
+        "invocations": invocations,
+        "mean_latency": sum(latency["mean"] * latency["sample_count"] for latency in with_latency.values()
+                            if latency["mean"] is not None) / invocations if invocations else None,
+        "max_latency": max((latency["max"] for latency in with_latency.values()), default=None),
+        "slowest_endpoint": max(with_latency, key=lambda name: with_latency[name]["max"], default=None),
+        "with_violations": sorted(name for name, report in evaluated.items() if report["violations"]),
+        "rollbacks": sorted(f"{name}/{variant_name}" for name, report in evaluated.items()
+                            for variant_name, decision in report["decisions"].items()
+                            if decision["decision"] == ROLLBACK),
+    }
+
+
+def format_fleet_table(reports):
+    """Formats one line per endpoint for the job log."""
+    lines = [f"{'endpoint':<40}{'variants':>9}{'latency mean/max s':>22}{'invocations':>13}{'violations':>12}"]
+    for name, report in reports.items():
+        if "error" in report:
+            lines.append(f"{name:<40}  fetch failed: {report['error']}")
+            continue
+        latency = report["summary"]["ModelLatency"]
+        lines.append(
+            f"{name:<40}{len(report['summaries']):>9}"
+            f"{_fmt(latency['mean'], '.3f') + '/' + _fmt(latency['max'], '.3f'):>22}"
+            f"{latency['sample_count']:>13.0f}{len(report['violations']):>12}")
+    return "\n".join(lines)
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
@@ -0,0 +1,159 @@
+"""Metrics sources of the monitoring job: live CloudWatch or a JSONL replay file"""
+# Python Built-Ins:
+import json
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from metrics_store import DEFAULT_VARIANT
+from variant_comparison import discover_variants
+
+# Metrics fetched for every variant, with their CloudWatch namespace and unit.
+METRIC_DEFINITIONS = (
+    {'namespace': 'AWS/SageMaker', 'unit': 'Microseconds', 'name': 'ModelLatency'},
+    {'namespace': '/aws/sagemaker/Endpoints', 'unit': 'Percent', 'name': 'CPUUtilization'},
+    {'namespace': '/aws/sagemaker/Endpoints', 'unit': 'Percent', 'name': 'MemoryUtilization'},
+)
+
+
+class MetricsSource:
+    """Interface of the sources the monitoring job reads the endpoint metrics from.
+
+    Datapoints are dictionaries with a timezone-aware 'Timestamp' datetime, the
+    'Average' and the 'SampleCount' of one minute, as returned by CloudWatch.
+    Implementations must be safe to call from several threads.
+    """
+
+    def variants(self, endpoint_name):
+        """Returns the production variants of the endpoint, see variant_comparison.discover_variants."""
+        raise NotImplementedError
+
+    def fetch(self, endpoint_name, variant_name, start_time, end_time):
+        """Returns a dictionary mapping the metric names to the datapoints of the variant within the time range."""
+        raise NotImplementedError
+
+
+class CloudWatchSource(MetricsSource):
+    """Reads the live metrics from CloudWatch and the variants from SageMaker."""
+
+    def __init__(self, cw_client, sm_client, period=60):
+        self.cw_client = cw_client
+        self.sm_client = sm_client
+        self.period = period
+
+    def variants(self, endpoint_name):
+        return discover_variants(self.sm_client, endpoint_name)
+
+    def fetch(self, endpoint_name, variant_name, start_time, end_time):
+        dimensions = [{'Name': 'EndpointName', 'Value': endpoint_name},
+                      {'Name': 'VariantName', 'Value': variant_name}]
+        datapoints = {}
+        for metric in METRIC_DEFINITIONS:
+            response = self.cw_client.get_metric_statistics(
+                Namespace=metric['namespace'],
+                MetricName=metric['name'],
+                Dimensions=dimensions,
+                StartTime=start_time,
+                EndTime=end_time,
+                Period=self.period,
+                Unit=metric['unit'],
+                Statistics=['SampleCount', 'Average']
+            )
+            datapoints[metric['name']] = response['Datapoints']
+        return datapoints
+
+
+class ReplaySource(MetricsSource):
+    """Replays datapoints from a JSONL file, for offline testing and benchmarking of the job.
+
+    Every line is one datapoint:
+    {"endpoint": ..., "variant": ..., "metric": ..., "timestamp": <ISO 8601>,
+     "average": ..., "sample_count": ..., "weight": <optional traffic weight of the variant>}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._datapoints = defaultdict(list)
+        self._weights = {}
+        with open(path, "r") as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                endpoint_name = record["endpoint"]
+                variant_name = record.get("variant") or DEFAULT_VARIANT
+                timestamp = datetime.fromisoformat(record["timestamp"])
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=timezone.utc)
+                self._datapoints[(endpoint_name, variant_name, record["metric"])].append(
+                    {'Timestamp': timestamp, 'Average': record.get("average"),
+                     'SampleCount': record.get("sample_count")})
+                self._weights.setdefault((endpoint_name, variant_name), record.get("weight"))
+
+    def endpoints(self):
+        """Returns the names of the endpoints in the replay file."""
+        return sorted({endpoint_name for endpoint_name, _ in self._weights})
+
+    def variants(self, endpoint_name):
+        names = sorted(variant_name for name, variant_name in self._weights if name == endpoint_name)
+        return [{"name": variant_name,
+                 "weight": self._weights[(endpoint_name, variant_name)] or 1.0 / len(names),
+                 "instance_count": None, "instance_type": None} for variant_name in names]
+
+    def fetch(self, endpoint_name, variant_name, start_time, end_time):
+        return {metric['name']: [point for point in self._datapoints[(endpoint_name, variant_name, metric['name'])]
+                                 if start_time <= point['Timestamp'] <= end_time]
+                for metric in METRIC_DEFINITIONS}
+
+
+class RecordingSource(MetricsSource):
+    """Wraps a source and appends everything it fetches to a JSONL file in the ReplaySource format."""
+
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+        self._weights = {}
+        self._lock = threading.Lock()
+
+    def variants(self, endpoint_name):
+        variants = self.source.variants(endpoint_name)
+        for variant in variants:
+            self._weights[(endpoint_name, variant["name"])] = variant.get("weight")
+        return variants
+
+    def fetch(self, endpoint_name, variant_name, start_time, end_time):
+        datapoints = self.source.fetch(endpoint_name, variant_name, start_time, end_time)
+        weight = self._weights.get((endpoint_name, variant_name))
+        with self._lock, open(self.path, "a") as outfile:
+            for metric_name, points in datapoints.items():
+                for point in points:
+                    outfile.write(json.dumps({
+                        "endpoint": endpoint_name, "variant": variant_name, "metric": metric_name,
+                        "timestamp": point['Timestamp'].isoformat(), "average": point.get('Average'),
+                        "sample_count": point.get('SampleCount'), "weight": weight}) + "\n")
+        return datapoints
+
+
+def create_metrics_source(env, cw_client=None, sm_client=None):
+    """Creates the source selected by the job configuration.
+
+    Args:
+        env: The job configuration, see evaluation.get_environment. 'metrics_source' is
+            'cloudwatch' or the path of a JSONL replay file; with 'metrics_record_path'
+            set, the fetched datapoints are also written to that file.
+        cw_client: A cloudwatch boto3 client, required for CloudWatch.
+        sm_client: A sagemaker boto3 client, required for CloudWatch.
+
+    Returns:
+        A MetricsSource.
+    """
+    if env.metrics_source and env.metrics_source != "cloudwatch":
+        if not os.path.exists(env.metrics_source):
+            raise ValueError(f"Metrics source {env.metrics_source} is neither 'cloudwatch' nor a replay file")
+        source = ReplaySource(env.metrics_source)
+    else:
+        source = CloudWatchSource(cw_client, sm_client)
+    if env.metrics_record_path:
+        source = RecordingSource(source, env.metrics_record_path)
+    return source
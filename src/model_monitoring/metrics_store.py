@@ -0,0 +1,220 @@
+"""Local metrics history and checkpoint handling for the monitoring job"""
+# Python Built-Ins:
+import json
+import os
+import sqlite3
+import traceback
+from datetime import datetime
+from urllib.parse import urlparse
+
+# External Dependencies:
+import boto3
+from botocore.exceptions import ClientError
+
+CHECKPOINT_FILE = "checkpoint.json"
+HISTORY_FILE = "metrics_history.db"
+DEFAULT_VARIANT = "AllTraffic"
+
+s3_client = boto3.client('s3')
+
+
+def _split_s3_uri(s3_uri):
+    parsed = urlparse(s3_uri)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def download_state(state_s3_uri, local_dir):
+    """Fetches the checkpoint and metrics history of the previous run.
+
+    Args:
+        state_s3_uri: A string representing the S3 prefix where the state of the job is persisted.
+        local_dir: A string representing the directory the state files are downloaded into.
+
+    Returns:
+        A list with the names of the state files that were found.
+    """
+    if not state_s3_uri:
+        return []
+    bucket, prefix = _split_s3_uri(state_s3_uri)
+    found = []
+    for file_name in (CHECKPOINT_FILE, HISTORY_FILE):
+        key = prefix.rstrip("/") + "/" + file_name if prefix else file_name
+        try:
+            s3_client.download_file(bucket, key, os.path.join(local_dir, file_name))
+            found.append(file_name)
+        except ClientError:
+            print(f"No previous state found at s3://{bucket}/{key}")
+    return found
+
+
+def upload_state(state_s3_uri, local_dir):
+    """Uploads the checkpoint and metrics history so the next run can resume from them."""
+    if not state_s3_uri:
+        return
+    bucket, prefix = _split_s3_uri(state_s3_uri)
+    for file_name in (CHECKPOINT_FILE, HISTORY_FILE):
+        path = os.path.join(local_dir, file_name)
+        if os.path.exists(path):
+            key = prefix.rstrip("/") + "/" + file_name if prefix else file_name
+            s3_client.upload_file(path, bucket, key)
+
+
+def load_checkpoint(local_dir):
+    """Reads the checkpoint written by the previous run.
+
+    Returns:
+        A dictionary with the keys 'last_timestamp' (datetime or None),
+        'last_capture_object' (string or None) and 'endpoint_timestamps', the newest
+        datapoint (datetime) per endpoint name.
+    """
+    checkpoint = {"last_timestamp": None, "last_capture_object": None, "endpoint_timestamps": {}}
+    path = os.path.join(local_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return checkpoint
+    try:
+        with open(path, "r") as infile:
+            saved = json.loads(infile.read())
+        if saved.get("last_timestamp"):
+            checkpoint["last_timestamp"] = datetime.fromisoformat(saved["last_timestamp"])
+        checkpoint["last_capture_object"] = saved.get("last_capture_object")
+        checkpoint["endpoint_timestamps"] = {name: datetime.fromisoformat(timestamp) for name, timestamp
+                                             in (saved.get("endpoint_timestamps") or {}).items()}
+    except Exception:
+        traceback.print_exc()
+        print("Unable to read checkpoint, starting from the default lookback window")
+    return checkpoint
+
+
+def save_checkpoint(local_dir, last_timestamp, last_capture_object, endpoint_timestamps=None):
+    """Writes the checkpoint for the next run."""
+    with open(os.path.join(local_dir, CHECKPOINT_FILE), "w") as outfile:
+        outfile.write(json.dumps({
+            "last_timestamp": last_timestamp.isoformat() if last_timestamp else None,
+            "last_capture_object": last_capture_object,
+            "endpoint_timestamps": {name: timestamp.isoformat()
+                                    for name, timestamp in (endpoint_timestamps or {}).items()},
+        }, indent=4))
+
+
+def new_capture_objects(dataset_source, last_capture_object):
+    """Lists the data capture files that arrived after the last processed one.
+
+    Capture files are laid out as <endpoint>/<variant>/yyyy/mm/dd/hh/<file>.jsonl,
+    so the relative paths sort chronologically.
+
+    Args:
+        dataset_source: A string representing the local directory holding the captured data.
+        last_capture_object: A string representing the relative path of the last processed file.
+
+    Returns:
+        A sorted list of relative paths of the new capture files.
+    """
+    capture_objects = []
+    if not dataset_source or not os.path.isdir(dataset_source):
+        return capture_objects
+    for root, _, files in os.walk(dataset_source):
+        for file_name in files:
+            relative_path = os.path.relpath(os.path.join(root, file_name), dataset_source)
+            if last_capture_object is None or relative_path > last_capture_object:
+                capture_objects.append(relative_path)
+    return sorted(capture_objects)
+
+
+def count_capture_records(dataset_source, capture_objects):
+    """Counts the captured invocation records (one JSON line each) in the given files."""
+    count = 0
+    for relative_path in capture_objects:
+        with open(os.path.join(dataset_source, relative_path), "r") as infile:
+            count += sum(1 for line in infile if line.strip())
+    return count
+
+
+class MetricsStore:
+    """Compact time-series store of the endpoint metrics, backed by SQLite.
+
+    Datapoints are keyed by (endpoint, variant, metric, timestamp) so that
+    overlapping fetch windows do not create duplicates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self._migrate()
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS datapoints (
+                endpoint TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                average REAL,
+                sample_count REAL,
+                PRIMARY KEY (endpoint, variant, metric, ts)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_datapoints_ts ON datapoints (ts);
+        """)
+
+    def _migrate(self):
+        """Moves a history written before variants were tracked to the AllTraffic variant."""
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(datapoints)")]
+        if not columns or "variant" in columns:
+            return
+        with self.connection:
+            self.connection.executescript(f"""
+                DROP INDEX IF EXISTS idx_datapoints_ts;
+                ALTER TABLE datapoints RENAME TO datapoints_v1;
+                CREATE TABLE datapoints (
+                    endpoint TEXT NOT NULL,
+                    variant TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    average REAL,
+                    sample_count REAL,
+                    PRIMARY KEY (endpoint, variant, metric, ts)
+                ) WITHOUT ROWID;
+                INSERT INTO datapoints
+                    SELECT endpoint, '{DEFAULT_VARIANT}', metric, ts, average, sample_count FROM datapoints_v1;
+                DROP TABLE datapoints_v1;
+            """)
+
+    def append(self, endpoint_name, metric_name, datapoints, variant_name=DEFAULT_VARIANT):
+        """Inserts CloudWatch datapoints, replacing the ones already stored for the same minute.
+
+        Returns:
+            The newest datapoint timestamp (datetime) or None when there were no datapoints.
+        """
+        rows = [(endpoint_name, variant_name, metric_name, int(point['Timestamp'].timestamp()),
+                 point.get('Average'), point.get('SampleCount')) for point in datapoints]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO datapoints VALUES (?, ?, ?, ?, ?, ?)", rows)
+        if not datapoints:
+            return None
+        return max(point['Timestamp'] for point in datapoints)
+
+    def max_average(self, endpoint_name, metric_name, start_time, end_time, variant_name=DEFAULT_VARIANT):
+        """Returns the maximum average value and its timestamp within the time range."""
+        row = self.connection.execute(
+            "SELECT average, ts FROM datapoints WHERE endpoint = ? AND variant = ? AND metric = ? "
+            "AND ts BETWEEN ? AND ? ORDER BY average DESC LIMIT 1",
+            (endpoint_name, variant_name, metric_name,
+             int(start_time.timestamp()), int(end_time.timestamp()))).fetchone()
+        if row is None:
+            return None, None
+        return row[0], datetime.utcfromtimestamp(row[1])
+
+    def summary(self, endpoint_name, metric_name, start_time, end_time, variant_name=DEFAULT_VARIANT):
+        """Summarises a metric of a variant over the time range.
+
+        Returns:
+            A dictionary with the sample-weighted 'mean', the 'max' of the minute
+            averages and the total 'sample_count'; the values are None without datapoints.
+        """
+        row = self.connection.execute(
+            "SELECT SUM(average * sample_count) / SUM(sample_count), MAX(average), SUM(sample_count) "
+            "FROM datapoints WHERE endpoint = ? AND variant = ? AND metric = ? AND ts BETWEEN ? AND ?",
+            (endpoint_name, variant_name, metric_name,
+             int(start_time.timestamp()), int(end_time.timestamp()))).fetchone()
+        return {"mean": row[0], "max": row[1], "sample_count": row[2]}
+
+    def close(self):
+        self.connection.close()
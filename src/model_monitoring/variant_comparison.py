@@ -0,0 +1,137 @@
+"""Per-variant comparison and promote/rollback decision for the monitoring job"""
+# Python Built-Ins:
+import traceback
+
+from metrics_store import DEFAULT_VARIANT
+
+METRICS = ("ModelLatency", "CPUUtilization", "MemoryUtilization")
+
+PROMOTE = "promote"
+ROLLBACK = "rollback"
+HOLD = "hold"
+
+
+def discover_variants(sm_client, endpoint_name):
+    """Lists the production variants of the endpoint with their traffic weight and capacity.
+
+    Args:
+        sm_client: A sagemaker boto3 client.
+        endpoint_name: A string representing the name of the SageMaker endpoint.
+
+    Returns:
+        A list of dictionaries with the keys 'name', 'weight', 'instance_count' and
+        'instance_type'. When the endpoint cannot be described the single AllTraffic
+        variant is assumed.
+    """
+    try:
+        endpoint = sm_client.describe_endpoint(EndpointName=endpoint_name)
+        endpoint_config = sm_client.describe_endpoint_config(EndpointConfigName=endpoint["EndpointConfigName"])
+    except Exception:
+        traceback.print_exc()
+        print(f"Unable to describe {endpoint_name}, assuming a single {DEFAULT_VARIANT} variant")
+        return [{"name": DEFAULT_VARIANT, "weight": 1.0, "instance_count": None, "instance_type": None}]
+    instance_types = {variant["VariantName"]: variant.get("InstanceType")
+                      for variant in endpoint_config["ProductionVariants"]}
+    return [{
+        "name": variant["VariantName"],
+        "weight": variant.get("CurrentWeight"),
+        "instance_count": variant.get("CurrentInstanceCount"),
+        "instance_type": instance_types.get(variant["VariantName"]),
+    } for variant in endpoint["ProductionVariants"]]
+
+
+def variant_summaries(store, endpoint_name, variants, start_time, end_time):
+    """Summarises latency (seconds), CPU and memory utilization (percent) of every variant.
+
+    Returns:
+        A dictionary mapping the variant names to the variant description and a
+        {'mean', 'max', 'sample_count'} summary per metric.
+    """
+    summaries = {}
+    for variant in variants:
+        summary = dict(variant)
+        for metric_name in METRICS:
+            stats = store.summary(endpoint_name, metric_name, start_time, end_time, variant_name=variant["name"])
+            if metric_name == "ModelLatency":
+                stats = {"mean": _to_seconds(stats["mean"]), "max": _to_seconds(stats["max"]),
+                         "sample_count": stats["sample_count"]}
+            summary[metric_name] = stats
+        summaries[variant["name"]] = summary
+    return summaries
+
+
+def _to_seconds(microseconds):
+    return microseconds / 1000000 if microseconds is not None else None
+
+
+def select_baseline(summaries, baseline_variant=None):
+    """Returns the configured baseline variant, or the variant receiving the most traffic."""
+    if baseline_variant and baseline_variant in summaries:
+        return baseline_variant
+    return max(summaries, key=lambda name: summaries[name].get("weight") or 0.0)
+
+
+def decide(baseline, candidate, latency_threshold, max_latency_regression=0.1, min_sample_count=1000,
+           max_memory_utilization=90.0):
+    """Decides whether a candidate variant is promoted, rolled back or kept as is.
+
+    The candidate is rolled back when its mean ModelLatency exceeds the latency
+    threshold, when it is more than max_latency_regression (a fraction) slower
+    than the baseline, or when its memory utilization peaks above
+    max_memory_utilization percent. It is promoted when it is within all limits.
+    Either way, the decision is only made once both variants served at least
+    min_sample_count invocations in the window, otherwise the result is hold.
+
+    Args:
+        baseline: The variant summary of the baseline (see variant_summaries).
+        candidate: The variant summary of the candidate.
+        latency_threshold: A float, the latency threshold of the monitoring job in seconds.
+        max_latency_regression: A float, the tolerated relative latency increase.
+        min_sample_count: An integer, the invocations each variant needs before deciding.
+        max_memory_utilization: A float, the tolerated peak memory utilization in percent.
+
+    Returns:
+        A dictionary with the 'decision', the 'latency_ratio' (candidate / baseline
+        mean latency) and the 'reasons' of the decision.
+    """
+    baseline_latency = baseline["ModelLatency"]
+    candidate_latency = candidate["ModelLatency"]
+    for summary in (baseline, candidate):
+        samples = summary["ModelLatency"]["sample_count"] or 0
+        if samples < min_sample_count:
+            return {"decision": HOLD, "latency_ratio": None,
+                    "reasons": [f"{summary['name']} served {samples:.0f} < {min_sample_count} invocations"]}
+
+    latency_ratio = candidate_latency["mean"] / baseline_latency["mean"] if baseline_latency["mean"] else None
+    reasons = []
+    if candidate_latency["mean"] > latency_threshold:
+        reasons.append(f"mean latency {candidate_latency['mean']:.3f}s above the {latency_threshold}s threshold")
+    if latency_ratio is not None and latency_ratio > 1 + max_latency_regression:
+        reasons.append(f"mean latency {latency_ratio:.2f}x the baseline, more than {1 + max_latency_regression:.2f}x")
+    peak_memory = candidate["MemoryUtilization"]["max"]
+    if peak_memory is not None and peak_memory > max_memory_utilization:
+        reasons.append(f"memory utilization peaked at {peak_memory:.1f}% above {max_memory_utilization}%")
+    if reasons:
+        return {"decision": ROLLBACK, "latency_ratio": latency_ratio, "reasons": reasons}
+    return {"decision": PROMOTE, "latency_ratio": latency_ratio,
+            "reasons": ["latency and memory within the limits of the baseline"]}
+
+
+def format_table(summaries):
+    """Formats the variant summaries side by side for the job log."""
+    header = f"{'variant':<20}{'weight':>8}{'instances':>10}{'latency mean/max s':>22}" \
+             f"{'cpu mean/max %':>18}{'mem mean/max %':>18}{'invocations':>13}"
+    lines = [header]
+    for name, summary in summaries.items():
+        latency, cpu, memory = summary["ModelLatency"], summary["CPUUtilization"], summary["MemoryUtilization"]
+        lines.append(
+            f"{name:<20}{_fmt(summary.get('weight'), '.2f'):>8}{_fmt(summary.get('instance_count'), 'd'):>10}"
+            f"{_fmt(latency['mean'], '.3f') + '/' + _fmt(latency['max'], '.3f'):>22}"
+            f"{_fmt(cpu['mean'], '.1f') + '/' + _fmt(cpu['max'], '.1f'):>18}"
+            f"{_fmt(memory['mean'], '.1f') + '/' + _fmt(memory['max'], '.1f'):>18}"
+            f"{_fmt(latency['sample_count'], '.0f'):>13}")
+    return "\n".join(lines)
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)